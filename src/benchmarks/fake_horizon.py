@@ -0,0 +1,200 @@
+"""A local stand-in of Horizon serving the resources the kin SDK reads: accounts, transactions and their operations.
+
+Payments are registered with FakeHorizon.add_payment() and every submitted transaction is accepted.
+"""
+import hashlib
+import json
+import re
+import threading
+from collections import Counter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from config import KIN_ASSET
+
+_ACCOUNT = re.compile(r'^/accounts/([^/]+)$')
+_ACCOUNT_TRANSACTIONS = re.compile(r'^/accounts/([^/]+)/transactions$')
+_TRANSACTION = re.compile(r'^/transactions/([0-9a-f]{64})$')
+_TRANSACTION_OPERATIONS = re.compile(r'^/transactions/([0-9a-f]{64})/operations$')
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeHorizon:
+    def __init__(self, balance='1000000000.0000000'):
+        self.balance = balance
+        # calls count by the requested resource
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._transactions = {}
+        self._operations = {}
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return 'http://%s:%d' % (host, port)
+
+    def start(self, host='127.0.0.1', port=0):
+        horizon = self
+
+        class Handler(_HorizonHandler):
+            pass
+
+        Handler.horizon = horizon
+        self._server = _ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=self._server.serve_forever, name='FakeHorizon')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_payment(self, tx_hash: str, from_address: str, to_address: str, amount: float):
+        created_at = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+        with self._lock:
+            paging_token = str(len(self._transactions) + 1)
+            self._transactions[tx_hash] = {
+                'id': tx_hash,
+                'paging_token': paging_token,
+                'hash': tx_hash,
+                'ledger': 1,
+                'created_at': created_at,
+                'source_account': from_address,
+                'source_account_sequence': paging_token,
+                'fee_paid': 100,
+                'operation_count': 1,
+                'memo_type': 'none',
+                'signatures': [],
+                '_links': {},
+            }
+            self._operations[tx_hash] = [{
+                'id': paging_token,
+                'paging_token': paging_token,
+                'source_account': from_address,
+                'type': 'payment',
+                'type_i': 1,
+                'created_at': created_at,
+                'transaction_hash': tx_hash,
+                'asset_type': 'credit_alphanum4' if len(KIN_ASSET.code) <= 4 else 'credit_alphanum12',
+                'asset_code': KIN_ASSET.code,
+                'asset_issuer': KIN_ASSET.issuer,
+                'from': from_address,
+                'to': to_address,
+                'amount': '%.7f' % amount,
+                '_links': {},
+            }]
+
+    def account(self, address: str) -> dict:
+        return {
+            'id': address,
+            'account_id': address,
+            'paging_token': '',
+            'sequence': '1',
+            'subentry_count': 1,
+            'thresholds': {'low_threshold': 0, 'med_threshold': 0, 'high_threshold': 0},
+            'flags': {'auth_required': False, 'auth_revocable': False},
+            'balances': [
+                {
+                    'balance': self.balance,
+                    'limit': '922337203685.4775807',
+                    'asset_type': 'credit_alphanum4' if len(KIN_ASSET.code) <= 4 else 'credit_alphanum12',
+                    'asset_code': KIN_ASSET.code,
+                    'asset_issuer': KIN_ASSET.issuer,
+                },
+                {'balance': self.balance, 'asset_type': 'native'},
+            ],
+            'signers': [{'public_key': address, 'key': address, 'type': 'ed25519_public_key', 'weight': 1}],
+            'data': {},
+            '_links': {},
+        }
+
+    def get(self, path: str) -> tuple:
+        """Returns (resource name, status code, body) for the GET request of `path`"""
+        if path == '/':
+            return 'root', 200, {'_links': {}}
+        match = _ACCOUNT.match(path)
+        if match:
+            return 'account', 200, self.account(match.group(1))
+        match = _ACCOUNT_TRANSACTIONS.match(path)
+        if match:
+            with self._lock:
+                records = [tx for tx in self._transactions.values() if tx['source_account'] == match.group(1)]
+            return 'account_transactions', 200, {'_embedded': {'records': records}, '_links': {}}
+        match = _TRANSACTION.match(path)
+        if match:
+            tx = self._transactions.get(match.group(1))
+            return ('transaction', 200, tx) if tx is not None else ('transaction', 404, _not_found())
+        match = _TRANSACTION_OPERATIONS.match(path)
+        if match:
+            operations = self._operations.get(match.group(1))
+            if operations is None:
+                return 'transaction_operations', 404, _not_found()
+            return 'transaction_operations', 200, {'_embedded': {'records': operations}, '_links': {}}
+        return 'unknown', 404, _not_found()
+
+    def count(self, resource: str):
+        with self._lock:
+            self.calls[resource] += 1
+
+    def submit(self, envelope: bytes) -> tuple:
+        tx_hash = hashlib.sha256(envelope).hexdigest()
+        return 'submit', 200, {'hash': tx_hash, 'ledger': 1, 'envelope_xdr': envelope.decode(), '_links': {}}
+
+
+def use_fake_horizon() -> FakeHorizon:
+    """Starts a fake Horizon and points the config to it with a random main account.
+    Must be called before the modules reading the config on import, transactions and payouts, are imported
+    """
+    from stellar_base.keypair import Keypair
+    import config
+
+    horizon = FakeHorizon().start()
+    keypair = Keypair.random()
+    config.HORIZON_URL = horizon.url
+    config.SECRET_KEY = keypair.seed().decode()
+    config.PUBLIC_KEY = keypair.address().decode()
+    config.PAYOUT_CHANNEL_SECRET_KEYS = []
+    # the fake doesn't stream transactions, so payments are polled
+    config.PAYMENT_DETECTION = 'poll'
+    return horizon
+
+
+def _not_found() -> dict:
+    return {
+        'type': 'https://stellar.org/horizon-errors/not_found',
+        'title': 'Resource Missing',
+        'status': 404,
+        'detail': 'The resource at the url requested was not found.',
+    }
+
+
+class _HorizonHandler(BaseHTTPRequestHandler):
+    horizon = None  # type: FakeHorizon
+    protocol_version = 'HTTP/1.1'
+
+    # noinspection PyPep8Naming
+    def do_GET(self):
+        self._respond(*self.horizon.get(self.path.split('?', 1)[0]))
+
+    # noinspection PyPep8Naming
+    def do_POST(self):
+        envelope = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self._respond(*self.horizon.submit(envelope))
+
+    def _respond(self, resource: str, status: int, body: dict):
+        self.horizon.count(resource)
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/hal+json' if status == 200 else 'application/problem+json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        pass
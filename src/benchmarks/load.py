@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""Load benchmark of the REST API: drives a mix of create, join, list and other requests at a given concurrency
+and reports throughput and p50/p99 latency per endpoint.
+
+By default the app is served in this process against a fake Horizon and the MongoDB database of --mongodb-uri,
+which is dropped before the run (mongomock://localhost keeps it in memory if mongomock is installed).
+With --url the load goes to an already running server instead, e.g. the gunicorn one.
+
+Run from the src directory: python -m benchmarks.load [--requests 10000] [--concurrency 32] [--mix join=5,list=3]
+"""
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fake_horizon import FakeHorizon, use_fake_horizon
+
+DEFAULT_MIX = 'create=1,join=4,list=3,get=2,leaderboard=1,scores=1'
+
+
+class Target:
+    """The benchmarked server and the tourneys the requests refer to"""
+
+    def __init__(self, url: str, horizon: FakeHorizon = None, public_key: str = None):
+        self.url = url.rstrip('/')
+        self.horizon = horizon
+        self.public_key = public_key
+        self.tourney_ids = []
+        self._lock = threading.Lock()
+
+    def add_tourney(self, tourney_id: str):
+        with self._lock:
+            self.tourney_ids.append(tourney_id)
+
+    def random_tourney(self, rnd: random.Random) -> str:
+        return self.tourney_ids[rnd.randrange(len(self.tourney_ids))]
+
+    def request(self, method: str, path: str, params: dict = None) -> tuple:
+        """Returns (HTTP status, parsed body or None)"""
+        data = None
+        if params and method == 'GET':
+            path += '?' + urllib.parse.urlencode(params)
+        elif params:
+            data = urllib.parse.urlencode(params).encode()
+        try:
+            with urllib.request.urlopen(urllib.request.Request(self.url + path, data=data, method=method)) as r:
+                return r.status, json.loads(r.read().decode())
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code, None
+
+    def pay(self, transaction_id: str, prize: float):
+        # the fake Horizon knows the payment by the time the transactions workers look for it
+        if self.horizon is not None:
+            self.horizon.add_payment(transaction_id, 'G' + 'A' * 55, self.public_key, prize)
+
+
+def new_tourney(target: Target, rnd: random.Random) -> dict:
+    transaction_id = '%064x' % rnd.getrandbits(256)
+    prize = float(rnd.randint(10, 1000))
+    target.pay(transaction_id, prize)
+    return {'name': 'Load tourney', 'description': 'Load benchmark', 'prize': str(prize),
+            'transaction_id': transaction_id, 'user_id': 'owner%d' % rnd.randrange(1000)}
+
+
+def new_member(rnd: random.Random) -> dict:
+    from stellar_base.utils import encode_check
+
+    n = rnd.getrandbits(64)
+    # a random key with a valid checksum, wallets are validated on join
+    wallet = encode_check('account', rnd.getrandbits(256).to_bytes(32, 'big')).decode()
+    return {'user_id': 'user%d' % n, 'alias_id': 'alias%d' % n, 'name': 'Member %d' % n, 'tag': '#%X' % n,
+            'wallet_public_key': wallet}
+
+
+def create(target: Target, rnd: random.Random) -> int:
+    status, _ = target.request('POST', '/api/v1/tourneys', new_tourney(target, rnd))
+    return status
+
+
+def join(target: Target, rnd: random.Random) -> int:
+    status, _ = target.request('POST', '/api/v1/tourneys/%s/join' % target.random_tourney(rnd),
+                               dict(new_member(rnd), members_limit=10))
+    return status
+
+
+def list_tourneys(target: Target, rnd: random.Random) -> int:
+    status, _ = target.request('GET', '/api/v1/tourneys', {
+        'status': rnd.choice(('joinable', 'previous')), 'limit': 50, 'members_limit': 10,
+    })
+    return status
+
+
+def get(target: Target, rnd: random.Random) -> int:
+    status, _ = target.request('GET', '/api/v1/tourneys/%s' % target.random_tourney(rnd), {'members_limit': 10})
+    return status
+
+
+def leaderboard(target: Target, rnd: random.Random) -> int:
+    status, _ = target.request('GET', '/api/v1/tourneys/%s/leaderboard' % target.random_tourney(rnd), {'limit': 50})
+    return status
+
+
+def scores(target: Target, rnd: random.Random) -> int:
+    status, _ = target.request('POST', '/api/v1/scores', {'scores': json.dumps([
+        {'tourney_id': target.random_tourney(rnd), 'user_id': 'user%d' % rnd.getrandbits(64),
+         'delta': rnd.randint(-30, 30)} for _ in range(50)
+    ])})
+    return status
+
+
+OPERATIONS = {
+    'create': ('POST /api/v1/tourneys', create),
+    'join': ('POST /api/v1/tourneys/<tid>/join', join),
+    'list': ('GET /api/v1/tourneys', list_tourneys),
+    'get': ('GET /api/v1/tourneys/<tid>', get),
+    'leaderboard': ('GET /api/v1/tourneys/<tid>/leaderboard', leaderboard),
+    'scores': ('POST /api/v1/scores', scores),
+}
+
+
+def parse_mix(s: str) -> dict:
+    mix = {}
+    for item in s.split(','):
+        name, _, weight = item.partition('=')
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError('Unknown operation %s, known are %s' % (name, ', '.join(OPERATIONS)))
+        mix[name] = int(weight or 1)
+    return mix
+
+
+def start_app(mongodb_uri: str, workers: bool) -> Target:
+    """Serves the app in this process against the fake Horizon and the emptied database"""
+    from werkzeug.serving import make_server
+
+    horizon = use_fake_horizon()
+    import config
+    from mongoengine.connection import get_db
+    import rest_server
+    import schema
+    import transactions
+
+    schema.connect_db(mongodb_uri)
+    db = get_db()
+    db.client.drop_database(db.name)
+    schema.ensure_indexes()
+    schema.migrate()
+    if workers:
+        thread = threading.Thread(target=transactions.main, name='Transactions')
+        thread.daemon = True
+        thread.start()
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, rest_server.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, name='RestServer')
+    thread.daemon = True
+    thread.start()
+    return Target('http://127.0.0.1:%d' % server.server_port, horizon, config.PUBLIC_KEY)
+
+
+def seed(target: Target, tourneys_count: int, members_count: int, rnd: random.Random):
+    """Creates the tourneys the load joins and reads, their creation isn't measured"""
+    bulk_size = 1000
+    failed = 0
+    for start in range(0, tourneys_count, bulk_size):
+        tourneys = [new_tourney(target, rnd) for _ in range(min(bulk_size, tourneys_count - start))]
+        status, body = target.request('POST', '/api/v1/tourneys/bulk', {'tourneys': json.dumps(tourneys)})
+        if status != 200:
+            raise RuntimeError('Can\'t seed tourneys, the server responded with %d' % status)
+        for result in body['results']:
+            # a rejected tourney has the error instead of the id
+            if '_id' in result:
+                target.add_tourney(result['_id'])
+            else:
+                failed += 1
+                logging.warning('Can\'t seed a tourney: %s', result)
+    if failed:
+        logging.warning('%d of %d tourneys aren\'t seeded', failed, tourneys_count)
+    if tourneys_count and not target.tourney_ids:
+        raise RuntimeError('Can\'t seed any of %d tourneys' % tourneys_count)
+    for tourney_id in target.tourney_ids:
+        if members_count:
+            target.request('POST', '/api/v1/tourneys/%s/join/bulk' % tourney_id,
+                           {'members': json.dumps([new_member(rnd) for _ in range(members_count)])})
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+
+def run(target: Target, mix: dict, requests_count: int, concurrency: int, rnd: random.Random) -> tuple:
+    """Returns the wall time of the run and the list of (endpoint, status, seconds) of every request"""
+    names = rnd.choices(list(mix), weights=list(mix.values()), k=requests_count)
+    # every request has its own random generator so the payloads don't depend on the threads scheduling
+    seeds = [rnd.getrandbits(64) for _ in range(requests_count)]
+
+    def call(i: int) -> tuple:
+        endpoint, func = OPERATIONS[names[i]]
+        started = time.perf_counter()
+        try:
+            status = func(target, random.Random(seeds[i]))
+        except OSError as e:
+            logging.debug('%s failed: %r', endpoint, e)
+            status = 0
+        return endpoint, status, time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(call, range(requests_count)))
+    return time.perf_counter() - started, results
+
+
+def report(wall_time: float, results: list):
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    for endpoint, status, seconds in results:
+        latencies[endpoint].append(seconds)
+        if not 200 <= status < 300:
+            errors[endpoint] += 1
+    print('%-40s %9s %7s %9s %9s %9s' % ('endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms'))
+    for endpoint, values in sorted(latencies.items()):
+        values.sort()
+        print('%-40s %9d %7d %9.1f %9.1f %9.1f' % (
+            endpoint, len(values), errors[endpoint], len(values) / wall_time,
+            percentile(values, 0.5) * 1000, percentile(values, 0.99) * 1000,
+        ))
+    everything = sorted(seconds for _, _, seconds in results)
+    print('%-40s %9d %7d %9.1f %9.1f %9.1f' % (
+        'total', len(everything), sum(errors.values()), len(everything) / wall_time,
+        percentile(everything, 0.5) * 1000, percentile(everything, 0.99) * 1000,
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load benchmark of the REST API')
+    parser.add_argument('--url', help='benchmark the running server at this URL instead of the in-process one')
+    parser.add_argument('--mongodb-uri', default='mongodb://localhost/kin_benchmark',
+                        help='database of the in-process server, it is dropped before the run')
+    parser.add_argument('--workers', action='store_true',
+                        help='run the transactions workers against the fake Horizon in the in-process server')
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help='weights of the operations (default %s)' % DEFAULT_MIX)
+    parser.add_argument('--tourneys', type=int, default=200, help='tourneys created before the run')
+    parser.add_argument('--members', type=int, default=50, help='members joined to every tourney before the run')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the requests sequence and payloads')
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    target = Target(args.url) if args.url else start_app(args.mongodb_uri, args.workers)
+    seed(target, args.tourneys, args.members, rnd)
+    wall_time, results = run(target, args.mix, args.requests, args.concurrency, rnd)
+    print('%d requests with concurrency %d in %.1f s, mix %s' % (
+        args.requests, args.concurrency, wall_time, ','.join('%s=%d' % item for item in args.mix.items())
+    ))
+    report(wall_time, results)
+    if target.horizon is not None:
+        print('fake Horizon calls: %s' % ', '.join('%s=%d' % item for item in sorted(target.horizon.calls.items())))
+
+
+if __name__ == '__main__':
+    main()
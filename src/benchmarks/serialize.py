@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Compares serialization of tourneys through mongoengine documents and through raw documents.
+
+Run from the src directory: python -m benchmarks.serialize [tourneys] [members per tourney]
+"""
+import sys
+import timeit
+from datetime import datetime, timedelta
+from random import randint
+
+from bson import ObjectId
+from flask import json
+
+from misc.myjson import CustomEncoder, dumps_plain
+from schema import Tourney, TourneyStatus, raw_tourney_as_dict
+
+
+def make_raw_tourney(members_count: int) -> dict:
+    now = datetime.utcnow().replace(microsecond=randint(0, 999) * 1000)
+    members = [
+        {
+            'user_id': 'user%d' % i,
+            'alias_id': 'alias%d' % i,
+            'name': 'Member %d' % i,
+            'tag': '#TAG%d' % i,
+            'wallet_public_key': 'G%055d' % i,
+            'joinedAt': now,
+            'currentTrophies': randint(-60, 100),
+        } for i in range(members_count)
+    ]
+    members.sort(key=lambda m: m['currentTrophies'], reverse=True)
+    return {
+        '_id': ObjectId(),
+        'name': 'Tourney',
+        'description': 'Benchmark tourney',
+        'prize': 1000.0,
+        'transaction_id': '%064x' % randint(0, 2 ** 256 - 1),
+        'user_id': 'owner',
+        'members': members,
+        'members_count': members_count,
+        'status': TourneyStatus.ENDED.value,
+        'startAt': now,
+        'endAt': now + timedelta(minutes=5),
+        'payed': now,
+        'ended': now + timedelta(minutes=5),
+        'prize_sent': 800.0,
+        'prize_sending_log': 'Prize for #1 place was sent',
+        'last_modified': now,
+    }
+
+
+def hydrated(docs: list) -> list:
+    # noinspection PyProtectedMember
+    return [json.dumps(Tourney._from_son(doc).as_dict(), cls=CustomEncoder) for doc in docs]
+
+
+def raw(docs: list) -> list:
+    return [dumps_plain(raw_tourney_as_dict(doc)) for doc in docs]
+
+
+def main(tourneys_count=200, members_count=100, repeat=5):
+    docs = [make_raw_tourney(members_count) for _ in range(tourneys_count)]
+    if hydrated(docs) != raw(docs):
+        raise AssertionError('Raw serialization differs from the hydrated one')
+
+    hydrated_time = min(timeit.repeat(lambda: hydrated(docs), number=1, repeat=repeat))
+    raw_time = min(timeit.repeat(lambda: raw(docs), number=1, repeat=repeat))
+    print('%d tourneys with %d members each' % (tourneys_count, members_count))
+    print('hydrated: %.1f ms' % (hydrated_time * 1000))
+    print('raw:      %.1f ms' % (raw_time * 1000))
+    print('speedup:  %.1fx' % (hydrated_time / raw_time))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""Simulates the transactions workers on virtual time against a simulated ledger, e.g. 100k tourneys ending in the
+same minute, and reports the backlog, the payout lag and the Horizon calls, so the workers can be planned offline.
+
+The payment checks and the tourney endings of transactions.py run step by step in this thread, interleaved by their
+virtual time. Every Horizon call takes --horizon-latency virtual seconds divided by the concurrency of its loop,
+PAYMENT_CHECK_CONCURRENCY for the checks and the number of payout channels for the endings, and MongoDB queries take
+no virtual time. Payments are detected by polling. The MongoDB database of --mongodb-uri is dropped before the run.
+
+Run from the src directory: python -m benchmarks.simulate [--tourneys 100000] [--window 60] [--horizon-latency 0.2]
+"""
+import argparse
+import hashlib
+import logging
+import random
+import time
+from collections import Counter
+from datetime import timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+
+from benchmarks.fake_horizon import use_fake_horizon
+from benchmarks.load import new_member, percentile
+from horizon import NotFoundError, BadSequenceError
+from misc import clock
+
+
+class SimulatedPayout(object):
+    def __init__(self, ledger, payments: list, account: str, sequence: int):
+        ledger.payouts_built += 1
+        self._hash = hashlib.sha256(('%d %r' % (ledger.payouts_built, payments)).encode()).hexdigest()
+        ledger.envelopes[self._hash] = (account, sequence + 1)
+
+    def hash_hex(self) -> str:
+        return self._hash
+
+    def gen_xdr(self) -> bytes:
+        # the simulated ledger identifies the envelope by its hash
+        return self._hash.encode()
+
+
+class SimulatedLedger(object):
+    """The part of the Horizon client which the workers use, on top of an in-memory ledger.
+    Every call takes `latency` virtual seconds divided by `parallelism` of the calling loop
+    """
+
+    def __init__(self, virtual_clock: clock.VirtualClock, latency: float, submit_failure_rate: float,
+                 rnd: random.Random):
+        self.clock = virtual_clock
+        self.latency = latency
+        self.parallelism = 1
+        self.submit_failure_rate = submit_failure_rate
+        self.rnd = rnd
+        self.calls = Counter()
+        self.transactions = {}
+        self.payouts_built = 0
+        # (source account, sequence) of the built payouts by their hash
+        self.envelopes = {}
+        self.sequences = Counter()
+
+    def call(self, name: str):
+        self.calls[name] += 1
+        self.clock.advance(self.latency / self.parallelism)
+
+    def add_payment(self, tx_hash: str, from_address: str, to_address: str, amount: float):
+        from config import KIN_ASSET
+
+        self.transactions[tx_hash] = SimpleNamespace(hash=tx_hash, operations=[SimpleNamespace(
+            type='payment', asset_code=KIN_ASSET.code, asset_issuer=KIN_ASSET.issuer,
+            from_address=from_address, to_address=to_address, amount=Decimal('%.7f' % amount),
+        )])
+
+    def get_transaction(self, tx_hash: str):
+        self.call('get_transaction')
+        if tx_hash not in self.transactions:
+            raise NotFoundError('Transaction %s is not found' % tx_hash, 404)
+        return self.transactions[tx_hash]
+
+    def account_sequence(self, address: str) -> int:
+        self.call('account_sequence')
+        return self.sequences[address]
+
+    def submit(self, envelope_xdr):
+        tx_hash = envelope_xdr.decode() if isinstance(envelope_xdr, bytes) else envelope_xdr
+        self.call('submit_payout')
+        failed = self.rnd.random() < self.submit_failure_rate
+        # half of the failed submissions are timeouts of transactions which are applied anyway
+        if failed and self.rnd.random() < 0.5:
+            raise RuntimeError('Simulated failure of payout %s' % tx_hash)
+        account, sequence = self.envelopes[tx_hash]
+        if sequence != self.sequences[account] + 1:
+            raise BadSequenceError('Simulated tx_bad_seq of payout %s' % tx_hash, 400)
+        self.sequences[account] = sequence
+        self.transactions[tx_hash] = SimpleNamespace(hash=tx_hash, operations=[])
+        if failed:
+            raise RuntimeError('Simulated timeout of payout %s' % tx_hash)
+
+    def build_payout(self, payments: list, channel_secret_key: str, sequence=None) -> SimulatedPayout:
+        from stellar_base.keypair import Keypair
+
+        account = Keypair.from_seed(channel_secret_key).address().decode()
+        return SimulatedPayout(self, payments, account, self.sequences[account] if sequence is None else sequence)
+
+
+def create_loop(ledger: SimulatedLedger, creations: list, members_count: int, unpaid_share: float,
+                rnd: random.Random):
+    """Creates the tourneys at their creation times and pays most of them"""
+    import config
+    from schema import Tourney
+
+    i = 0
+    while i < len(creations):
+        tourneys = []
+        while i < len(creations) and creations[i] <= clock.utcnow():
+            prize = float(rnd.randint(10, 1000))
+            tourneys.append({'name': 'Simulated tourney', 'prize': prize, 'user_id': 'owner',
+                             'transaction_id': '%064x' % rnd.getrandbits(256)})
+            if rnd.random() >= unpaid_share:
+                ledger.add_payment(tourneys[-1]['transaction_id'], new_member(rnd)['wallet_public_key'],
+                                   config.PUBLIC_KEY, prize)
+            i += 1
+        for start in range(0, len(tourneys), config.BULK_SIZE_MAX):
+            for tourney in Tourney.create_many(tourneys[start:start + config.BULK_SIZE_MAX]):
+                if members_count:
+                    Tourney.join_many(tourney.id, [new_member(rnd) for _ in range(members_count)], members_limit=0)
+        if i < len(creations):
+            yield (creations[i] - clock.utcnow()).total_seconds()
+
+
+def monitor_loop():
+    """monitor_new_tourneys() in the poll mode"""
+    import config
+    import transactions
+
+    while True:
+        tourney_ids = transactions.tourneys_to_check(check_all=True)
+        for tourney_id in tourney_ids:
+            transactions.check_tourney_payment(tourney_id)
+            yield 0
+        yield config.PAYMENT_POLL_INTERVAL if len(tourney_ids) < config.PAYMENT_CLAIM_BATCH else 0
+
+
+def control_loop():
+    """control_run_tourneys() with the endings run one by one"""
+    import config
+    import transactions
+
+    transactions.schedule_payed_tourneys()
+    last_reseed = clock.time()
+    while True:
+        tourney_id = transactions.end_scheduler.pop_due()
+        if tourney_id is not None:
+            transactions.end_tourney_by_id(tourney_id)
+            yield 0
+        elif clock.time() - last_reseed >= config.WORKER_RESEED_INTERVAL:
+            last_reseed = clock.time()
+            transactions.schedule_payed_tourneys(due_only=True)
+        else:
+            # the runner wakes the loop up earlier when a tourney is due
+            yield last_reseed + config.WORKER_RESEED_INTERVAL - clock.time()
+
+
+def report_loop(ledger: SimulatedLedger, start, interval: int):
+    from schema import Tourney, TourneyStatus
+
+    while True:
+        counts = Counter(t['status'] for t in Tourney.objects().only('status').as_pymongo())
+        overdue = Tourney.objects(status=TourneyStatus.PAYED.value, endAt__lte=clock.utcnow()).count()
+        print('t=%5ds created %7d | not payed %7d | payed %7d, overdue %7d | ended %7d | errors %5d | '
+              'horizon calls %8d' % (
+                  (clock.utcnow() - start).total_seconds(), sum(counts.values()),
+                  counts[TourneyStatus.NOT_PAYED_YET.value], counts[TourneyStatus.PAYED.value], overdue,
+                  counts[TourneyStatus.ENDED.value],
+                  counts[TourneyStatus.NOT_PAYED_ERROR.value] + counts[TourneyStatus.PAYMENT_ERROR.value],
+                  sum(ledger.calls.values()),
+              ))
+        yield interval
+
+
+def run(ledger: SimulatedLedger, loops: dict, until):
+    """Runs a step of the loop which is the earliest to wake up, until all of them sleep past `until`.
+    `loops` are (generator yielding seconds to sleep, parallelism of its Horizon calls) by name
+    """
+    from transactions import end_scheduler
+
+    ready = {name: clock.utcnow() for name in loops}
+    while ready:
+        due = end_scheduler.next_due()
+        if due is not None and 'control' in ready:
+            ready['control'] = min(ready['control'], due)
+        name = min(ready, key=ready.get)
+        if ready[name] > until:
+            return
+        clock.get_clock().advance_to(ready[name])
+        loop, parallelism = loops[name]
+        ledger.parallelism = parallelism
+        try:
+            wait = next(loop)
+        except StopIteration:
+            del ready[name]
+            continue
+        ready[name] = clock.utcnow() + timedelta(seconds=wait)
+
+
+def print_lags(title: str, lags: list):
+    if not lags:
+        print('%s: none' % title)
+        return
+    lags.sort()
+    print('%s: p50 %.1f s, p99 %.1f s, max %.1f s' % (title, percentile(lags, 0.5), percentile(lags, 0.99), lags[-1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulation of the transactions workers on virtual time')
+    parser.add_argument('--mongodb-uri', default='mongodb://localhost/kin_simulation',
+                        help='database of the simulation, it is dropped before the run')
+    parser.add_argument('--tourneys', type=int, default=100000)
+    parser.add_argument('--window', type=int, default=60, help='seconds over which the tourneys are created')
+    parser.add_argument('--members', type=int, default=3, help='members of every tourney')
+    parser.add_argument('--unpaid-share', type=float, default=0.05, help='share of tourneys which are never payed')
+    parser.add_argument('--horizon-latency', type=float, default=0.2, help='seconds of a Horizon call')
+    parser.add_argument('--submit-failures', type=float, default=0.0, help='share of failed payout submissions')
+    parser.add_argument('--duration', type=int, help='virtual seconds of the simulation, by default until every '
+                                                     'tourney could be ended')
+    parser.add_argument('--report-interval', type=int, default=60, help='virtual seconds between reports')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help='show logs of the workers')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    # the channel pool needs a valid main account, the Horizon client is replaced by the simulated ledger
+    use_fake_horizon()
+    import config
+    from mongoengine.connection import get_db
+    import schema
+    import transactions
+    from payouts import get_channel_pool
+    from schema import Tourney, TourneyStatus
+
+    virtual_clock = clock.VirtualClock()
+    clock.set_clock(virtual_clock)
+    rnd = random.Random(args.seed)
+    ledger = SimulatedLedger(virtual_clock, args.horizon_latency, args.submit_failures, rnd)
+    transactions.use_ledger(ledger, ledger.build_payout)
+
+    schema.connect_db(args.mongodb_uri)
+    db = get_db()
+    db.client.drop_database(db.name)
+    schema.ensure_indexes()
+    schema.migrate()
+
+    start = virtual_clock.utcnow()
+    creations = sorted(start + timedelta(seconds=rnd.randrange(max(1, args.window))) for _ in range(args.tourneys))
+    duration = args.duration or args.window + max(config.TOURNEY_LENGTH, config.TOURNEY_PAY_TIMEOUT) + \
+        2 * config.WORKER_RESEED_INTERVAL
+    print('%d tourneys created over %d s, %d channels, Horizon latency %.3f s, %d virtual seconds' % (
+        args.tourneys, args.window, len(get_channel_pool()), args.horizon_latency, duration
+    ))
+
+    started = time.time()
+    run(ledger, {
+        'create': (create_loop(ledger, creations, args.members, args.unpaid_share, rnd), 1),
+        'monitor': (monitor_loop(), config.PAYMENT_CHECK_CONCURRENCY),
+        'control': (control_loop(), len(get_channel_pool())),
+        'report': (report_loop(ledger, start, args.report_interval), 1),
+    }, until=start + timedelta(seconds=duration))
+    print('simulated in %.1f s' % (time.time() - started))
+    tourneys = list(Tourney.objects().only('status', 'startAt', 'endAt', 'payed', 'ended').as_pymongo())
+    print_lags('payment detection lag', [(t['payed'] - t['startAt']).total_seconds()
+                                         for t in tourneys if t.get('payed')])
+    print_lags('payout lag', [(t['ended'] - t['endAt']).total_seconds()
+                              for t in tourneys if t['status'] == TourneyStatus.ENDED.value])
+    print('horizon calls: %s' % ', '.join('%s=%d' % item for item in sorted(ledger.calls.items())))
+
+
+if __name__ == '__main__':
+    main()
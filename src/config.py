@@ -1,4 +1,6 @@
 import logging
+import os
+import tempfile
 
 import kin
 
@@ -13,6 +15,22 @@ KIN_ASSET = kin.Asset('KIN', 'GBQ3DQOA7NF52FVV7ES3CR3ZMHUEY4LTHDAQKDTO6S546JCLFP
 
 # Your database URL
 MONGODB_URI = 'mongodb://localhost/kin'
+# Size of MongoDB connections pool of every process
+MONGODB_POOL_SIZE = 50
+# How long a query waits for an available MongoDB server before it fails, the readiness check waits the same
+MONGODB_SERVER_TIMEOUT = 5
+
+# Production serving of the REST API by gunicorn, see gunicorn_conf.py
+REST_BIND = '0.0.0.0:5000'
+# Processes of a REST API replica, sized for its pod rather than the CPU cores of the host
+REST_WORKERS = 2
+REST_THREADS = 8
+# A worker is restarted after serving this number of requests
+REST_MAX_REQUESTS = 100000
+# The REST workers share their metrics through files in this directory, which is emptied on the start of gunicorn,
+# so /api/metrics of any worker renders all of them. A worker writes its metrics every METRICS_SYNC_INTERVAL seconds
+METRICS_MULTIPROCESS_DIR = os.path.join(tempfile.gettempdir(), 'kin_tourney_metrics')
+METRICS_SYNC_INTERVAL = 5
 
 # Default log level of server logs
 LOG_LEVEL_DEFAULT = logging.INFO
@@ -20,11 +38,124 @@ LOG_LEVEL_DEFAULT = logging.INFO
 SERVER_LOG_PATH = 'logs'
 # Format of the log messages
 LOG_FORMAT = '%(asctime)s %(levelname)s [%(threadName)s] %(module)s.%(funcName)s %(message)s'
+# Records are formatted and written by a background thread, the logging threads only queue them.
+# Records which don't fit into the queue of LOG_QUEUE_SIZE are dropped.
+LOG_ASYNC = True
+LOG_QUEUE_SIZE = 10000
+# A JSON object per record instead of LOG_FORMAT
+LOG_JSON = False
+# Shares of records below WARNING which are written, by logger or module name, e.g. {'rest_server': 0.01}
+LOG_SAMPLING = {}
 
 TOURNEY_URL = 'http://127.0.0.1/api/v1/tourneys/%s'
 
 TOURNEY_LENGTH = 5 * 60
 TOURNEY_PAY_TIMEOUT = 10 * 60
+# New tourneys keep their members in the tourney_member collection instead of the tourney document, so a join
+# doesn't rewrite the whole roster and a tourney isn't limited by the document size. Existing tourneys keep the
+# storage they were created with.
+MEMBERS_SEPARATE = False
+
+# How payments of new tourneys are detected:
+#  'poll' - every transaction of a not payed tourney is fetched from Horizon every PAYMENT_POLL_INTERVAL
+#  'stream' - payments to PUBLIC_KEY are streamed from Horizon, the pending tourneys are fully re-checked
+#             every PAYMENT_RECONCILE_INTERVAL only to expire them and to catch missed payments.
+#             It's opt-in, the SSE stream of account transactions isn't verified against production Horizon yet
+PAYMENT_DETECTION = 'poll'
+PAYMENT_POLL_INTERVAL = 10
+PAYMENT_RECONCILE_INTERVAL = 60
+# Delay before a broken payments stream is reopened
+PAYMENT_STREAM_RETRY_DELAY = 5
+# How many streamed transaction hashes are remembered to start tourneys created after their payment
+PAYMENT_STREAM_SEEN_SIZE = 10000
+
+# How many transactions of not payed tourneys are checked in Horizon simultaneously
+PAYMENT_CHECK_CONCURRENCY = 16
+
+# Horizon requests of the transactions workers: a keep-alive pool of HORIZON_POOL_SIZE connections, timeouts in
+# seconds, HORIZON_RETRIES retries of failed requests after random delays up to HORIZON_RETRY_BACKOFF * 2^retry.
+# After HORIZON_BREAKER_FAILURES failures in a row requests are rejected for HORIZON_BREAKER_RESET seconds.
+HORIZON_POOL_SIZE = 32
+HORIZON_CONNECT_TIMEOUT = 3
+HORIZON_READ_TIMEOUT = 10
+# a submission waits for the ledger to close
+HORIZON_SUBMIT_TIMEOUT = 30
+HORIZON_RETRIES = 2
+HORIZON_RETRY_BACKOFF = 0.5
+HORIZON_BREAKER_FAILURES = 5
+HORIZON_BREAKER_RESET = 30
+
+# Confirmed transactions never change, so up to TRANSACTION_CACHE_SIZE of them are kept in memory and, if
+# TRANSACTION_CACHE_PERSIST, in MongoDB. A not found transaction is looked up again after
+# TRANSACTION_BACKOFF_MIN seconds, the delay doubles with every miss up to TRANSACTION_BACKOFF_MAX.
+TRANSACTION_CACHE_SIZE = 10000
+TRANSACTION_CACHE_PERSIST = True
+TRANSACTION_BACKOFF_MIN = PAYMENT_POLL_INTERVAL
+TRANSACTION_BACKOFF_MAX = 2 * 60
+
+# Transactions workers lease tourneys, so any number of them can run over the same database:
+#  a checked not payed tourney isn't checked by other workers for PAYMENT_CHECK_LEASE seconds,
+#  an ended tourney is payed out by a single worker, which holds it for PAYOUT_LEASE seconds.
+PAYMENT_CHECK_LEASE = PAYMENT_POLL_INTERVAL
+PAYOUT_LEASE = 5 * 60
+# How many not payed tourneys a worker claims per scan, the rest is left to other workers
+PAYMENT_CLAIM_BATCH = 1000
+# Port of Prometheus metrics of the transactions workers process
+WORKER_METRICS_PORT = 9100
+# How often a worker looks for due tourneys payed by other workers or left by the stopped ones
+WORKER_RESEED_INTERVAL = 60
+
+# How many times the prize transaction of an ended tourney is built and submitted before giving up
+PAYOUT_MAX_ATTEMPTS = 5
+PAYOUT_RETRY_DELAY = 30
+# Secret keys of channel accounts which are sources of prizes transactions, so payouts of different tourneys are
+# submitted in parallel. The prizes are always sent from PUBLIC_KEY. Without channels payouts are sent one by one.
+# noinspection SpellCheckingInspection
+PAYOUT_CHANNEL_SECRET_KEYS = []
+# A payout leases its channel in MongoDB for PAYOUT_CHANNEL_LEASE seconds, so all workers can be configured with the
+# same keys. A worker waiting for a channel leased by another one checks it every PAYOUT_CHANNEL_POLL_INTERVAL seconds.
+PAYOUT_CHANNEL_LEASE = 2 * 60
+PAYOUT_CHANNEL_POLL_INTERVAL = 1
+
+# Finished tourneys are copied to the tourney_history collection ARCHIVE_RETENTION seconds after their end and
+# only their summaries with the prize winners are left in the tourney collection. The archival runs every
+# ARCHIVE_INTERVAL seconds by batches of ARCHIVE_BATCH tourneys.
+ARCHIVE_RETENTION = 7 * 24 * 60 * 60
+ARCHIVE_INTERVAL = 10 * 60
+ARCHIVE_BATCH = 1000
+
+# Default and maximal page sizes of GET /api/v1/tourneys
+TOURNEYS_PAGE_SIZE = 50
+TOURNEYS_PAGE_SIZE_MAX = 200
+
+# Default and maximal page sizes of GET /api/v1/tourneys/<tid>/leaderboard
+LEADERBOARD_PAGE_SIZE = 50
+LEADERBOARD_PAGE_SIZE_MAX = 500
+
+# Maximal number of members or tourneys in a single bulk request
+BULK_SIZE_MAX = 1000
+
+# Trophies updates are merged in memory of every REST process and written to MongoDB every SCORES_FLUSH_INTERVAL
+# seconds or as soon as SCORES_FLUSH_SIZE members are updated
+SCORES_FLUSH_INTERVAL = 1
+SCORES_FLUSH_SIZE = 5000
+# Maximal number of updates in a single POST /api/v1/scores
+SCORES_BATCH_MAX = 10000
+
+# Live events of GET /api/v1/tourneys/<tid>/events: every REST process polls the watched tourneys every
+# LIVE_POLL_INTERVAL seconds and pushes changes of their LIVE_LEADERS_COUNT leaders to all subscribers.
+# Every open stream holds a thread of the REST worker, so a process answers 503 to the subscribers above
+# LIVE_MAX_SUBSCRIBERS and keeps the rest of its REST_THREADS for the other requests.
+LIVE_MAX_SUBSCRIBERS = REST_THREADS // 2
+LIVE_POLL_INTERVAL = 1
+LIVE_LEADERS_COUNT = 10
+# Messages queued for a subscriber, a slower one gets a new snapshot instead
+LIVE_QUEUE_SIZE = 100
+# A comment is sent to an idle stream, so proxies don't close it
+LIVE_HEARTBEAT_INTERVAL = 15
+
+# How many serialized tourneys are kept in the response cache of every REST process
+TOURNEY_CACHE_SIZE = 10000
 
 # noinspection SpellCheckingInspection
 TEST_USER_PK = 'TEST USER PRIMARY KEY'
@@ -0,0 +1,48 @@
+# Production serving of the REST API: gunicorn -c src/gunicorn_conf.py rest_server:app
+# The transactions workers aren't started here, they run in their own process: python src/transactions.py,
+# which also creates the indexes and does the data migrations, so the REST API starts without MongoDB
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# noinspection PyPep8
+import config
+
+chdir = os.path.dirname(os.path.abspath(__file__))
+bind = config.REST_BIND
+workers = config.REST_WORKERS
+# threaded workers, so a slow MongoDB request doesn't block the whole process
+worker_class = 'gthread'
+threads = config.REST_THREADS
+max_requests = config.REST_MAX_REQUESTS
+max_requests_jitter = config.REST_MAX_REQUESTS // 10
+
+
+# noinspection PyUnusedLocal
+def on_starting(server):
+    from misc import metrics
+
+    metrics.clear_multiprocess(config.METRICS_MULTIPROCESS_DIR)
+
+
+# noinspection PyUnusedLocal
+def post_fork(server, worker):
+    from misc import metrics
+    import schema
+
+    metrics.enable_multiprocess(config.METRICS_MULTIPROCESS_DIR, config.METRICS_SYNC_INTERVAL)
+    # a single pooled client is reused by all threads of the worker, it connects on the first request
+    schema.connect_db()
+    try:
+        schema.load_migrations()
+    except Exception as e:
+        # the worker reads the data as not migrated, which is slower but correct, till it's restarted
+        server.log.warning('Can\'t load the data migrations of worker %d: %r', worker.pid, e)
+
+
+# noinspection PyUnusedLocal
+def child_exit(server, worker):
+    from misc import metrics
+
+    metrics.mark_process_dead(config.METRICS_MULTIPROCESS_DIR, worker.pid)
@@ -0,0 +1,293 @@
+import random
+import threading
+from collections import namedtuple
+from decimal import Decimal
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import TRANSACTION_CACHE_SIZE, TRANSACTION_CACHE_PERSIST, TRANSACTION_BACKOFF_MIN, \
+    TRANSACTION_BACKOFF_MAX, HORIZON_URL, HORIZON_POOL_SIZE, HORIZON_CONNECT_TIMEOUT, HORIZON_READ_TIMEOUT, \
+    HORIZON_SUBMIT_TIMEOUT, HORIZON_RETRIES, HORIZON_RETRY_BACKOFF, HORIZON_BREAKER_FAILURES, HORIZON_BREAKER_RESET
+from misc import clock, metrics
+from misc.cache import LRUCache
+from schema import LedgerTransaction
+
+OPERATION_FIELDS = ('type', 'asset_code', 'asset_issuer', 'from_address', 'to_address', 'amount')
+
+# the parts of the SDK transaction data which the workers read
+Operation = namedtuple('Operation', OPERATION_FIELDS)
+Transaction = namedtuple('Transaction', ('hash', 'operations'))
+
+HORIZON_CONNECTIONS_IN_USE = metrics.Gauge('horizon_connections_in_use',
+                                           'Horizon requests in progress, up to the pool size')
+HORIZON_CONNECTIONS_MAX = metrics.Gauge('horizon_connections_max', 'Size of the Horizon connections pool')
+HORIZON_RETRIED = metrics.Counter('horizon_retries_total', 'Retried Horizon requests')
+HORIZON_CIRCUIT_STATE = metrics.Gauge('horizon_circuit_state', 'Horizon circuit breaker: 0 closed, 1 half open, 2 open')
+HORIZON_CIRCUIT_REJECTIONS = metrics.Counter('horizon_circuit_rejections_total',
+                                             'Horizon requests rejected by the open circuit breaker')
+TRANSACTION_LOOKUPS = metrics.Counter('transaction_lookups_total', 'Transaction lookups by their source',
+                                      ('source',))
+
+
+class HorizonError(Exception):
+    def __init__(self, message, status=None, body=None):
+        super().__init__(message)
+        self.status = status
+        self.body = body
+
+
+class NotFoundError(HorizonError):
+    pass
+
+
+class CircuitOpenError(HorizonError):
+    pass
+
+
+class BadSequenceError(HorizonError):
+    """The submitted transaction doesn't have the next sequence number of its source account"""
+    pass
+
+
+class CircuitBreaker(object):
+    """Sheds the calls of a degraded service.
+
+    The circuit opens after `failures_threshold` failures in a row and rejects calls for `reset_timeout` seconds.
+    Then it's half open and lets a single trial call through, which closes the circuit or opens it again.
+    """
+    CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+    _STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, failures_threshold, reset_timeout, on_change=None):
+        self.failures_threshold = failures_threshold
+        self.reset_timeout = reset_timeout
+        self.on_change = on_change
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0
+        # when the trial call of the half open circuit started, None if there is no such call
+        self._trial_at = None
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            if self.on_change is not None:
+                self.on_change(state, self._STATE_VALUES[state])
+
+    def allow(self) -> bool:
+        with self._lock:
+            now = clock.time()
+            if self.state == self.OPEN and now - self._opened_at >= self.reset_timeout:
+                self._set_state(self.HALF_OPEN)
+                self._trial_at = None
+            if self.state == self.HALF_OPEN:
+                # a trial which neither succeeded nor failed in time is replaced by another one
+                if self._trial_at is not None and now - self._trial_at < self.reset_timeout:
+                    return False
+                self._trial_at = now
+                return True
+            return self.state == self.CLOSED
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failures_threshold:
+                self._opened_at = clock.time()
+                self._set_state(self.OPEN)
+
+
+class HorizonClient(object):
+    """Horizon requests of the workers over a bounded keep-alive connections pool.
+
+    Every request has connect and read timeouts. Connection errors, timeouts, 429 and 5xx responses are retried
+    up to `retries` times after exponential delays with full jitter, and they count as failures of the circuit
+    breaker, which rejects requests with CircuitOpenError while Horizon is degraded.
+    Submission of the same signed transaction is idempotent, so it's retried as well.
+    """
+
+    def __init__(self, url=HORIZON_URL, pool_size=HORIZON_POOL_SIZE, connect_timeout=HORIZON_CONNECT_TIMEOUT,
+                 read_timeout=HORIZON_READ_TIMEOUT, submit_timeout=HORIZON_SUBMIT_TIMEOUT, retries=HORIZON_RETRIES,
+                 retry_backoff=HORIZON_RETRY_BACKOFF, breaker=None):
+        self.url = url.rstrip('/')
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.submit_timeout = submit_timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.breaker = breaker or CircuitBreaker(
+            HORIZON_BREAKER_FAILURES, HORIZON_BREAKER_RESET,
+            on_change=lambda state, value: HORIZON_CIRCUIT_STATE.set(value)
+        )
+        self.session = requests.Session()
+        # pool_block makes the threads wait for a free connection instead of opening extra ones
+        self.session.mount(self.url, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True))
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        HORIZON_CONNECTIONS_MAX.set(pool_size)
+        HORIZON_CIRCUIT_STATE.set(0)
+
+    def state(self) -> dict:
+        return {
+            'pool_size': self.pool_size,
+            'in_flight': self._in_flight,
+            'circuit': self.breaker.state,
+            'failures': self.breaker.failures,
+        }
+
+    def _track(self, delta):
+        with self._lock:
+            self._in_flight += delta
+            HORIZON_CONNECTIONS_IN_USE.set(self._in_flight)
+
+    def request(self, method: str, path: str, timeout=None, **kwargs) -> dict:
+        """Returns the JSON body of a successful response, raises NotFoundError for 404 and HorizonError otherwise"""
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                HORIZON_CIRCUIT_REJECTIONS.inc()
+                raise CircuitOpenError('Horizon circuit is open after %d failures' % self.breaker.failures)
+            self._track(1)
+            try:
+                response = self.session.request(method, self.url + path,
+                                                timeout=(self.connect_timeout, timeout or self.read_timeout), **kwargs)
+            except requests.RequestException as e:
+                error = HorizonError('Horizon %s %s failed: %r' % (method, path, e))
+            else:
+                if response.status_code < 500 and response.status_code != 429:
+                    self.breaker.record_success()
+                    if response.status_code == 404:
+                        raise NotFoundError('Horizon %s %s is not found' % (method, path), 404)
+                    if response.status_code >= 400:
+                        raise HorizonError('Horizon %s %s responded with %d: %s' % (
+                            method, path, response.status_code, response.text
+                        ), response.status_code, response.text)
+                    return response.json()
+                error = HorizonError('Horizon %s %s responded with %d' % (method, path, response.status_code),
+                                     response.status_code, response.text)
+            finally:
+                self._track(-1)
+            self.breaker.record_failure()
+            if attempt >= self.retries:
+                raise error
+            HORIZON_RETRIED.inc()
+            clock.sleep(random.uniform(0, self.retry_backoff * 2 ** attempt))
+            attempt += 1
+
+    def get_transaction(self, tx_hash: str) -> Transaction:
+        self.request('GET', '/transactions/%s' % tx_hash)
+        records = self.request('GET', '/transactions/%s/operations' % tx_hash, params={'limit': 200})
+        return Transaction(tx_hash, [
+            Operation(record.get('type'), record.get('asset_code'), record.get('asset_issuer'), record.get('from'),
+                      record.get('to'), Decimal(record['amount']) if record.get('amount') is not None else None)
+            for record in records['_embedded']['records']
+        ])
+
+    def account_sequence(self, address: str) -> int:
+        return int(self.request('GET', '/accounts/%s' % address)['sequence'])
+
+    def submit(self, envelope_xdr) -> dict:
+        if isinstance(envelope_xdr, bytes):
+            envelope_xdr = envelope_xdr.decode()
+        try:
+            return self.request('POST', '/transactions', timeout=self.submit_timeout, data={'tx': envelope_xdr})
+        except HorizonError as e:
+            if e.status == 400 and e.body and 'tx_bad_seq' in e.body:
+                raise BadSequenceError(str(e), e.status, e.body)
+            raise
+
+
+def _from_data(tx_hash: str, tx_data) -> Transaction:
+    operations = []
+    for op in tx_data.operations:
+        op = Operation(*[getattr(op, field, None) for field in OPERATION_FIELDS])
+        # amounts are decimals whichever source the transaction comes from
+        operations.append(op._replace(amount=Decimal(str(op.amount))) if op.amount is not None else op)
+    return Transaction(tx_hash, operations)
+
+
+def _to_document(tx: Transaction) -> LedgerTransaction:
+    return LedgerTransaction(hash=tx.hash, last_modified=clock.utcnow(), operations=[
+        dict(op._asdict(), amount=str(op.amount) if op.amount is not None else None) for op in tx.operations
+    ])
+
+
+def _from_document(doc: LedgerTransaction) -> Transaction:
+    return Transaction(doc.hash, [
+        Operation(**dict(op, amount=Decimal(op['amount']) if op['amount'] is not None else None))
+        for op in doc.operations
+    ])
+
+
+class TransactionLookup(object):
+    """Looks up transactions in Horizon with `fetch(tx_hash)`, which raises NotFoundError for a missing transaction.
+
+    Found transactions are kept in an LRU cache, and in MongoDB if `persist`, since a confirmed transaction never
+    changes. A transaction which isn't found yet isn't looked up again until its backoff delay passes, the delay
+    starts with `backoff_min` seconds and doubles with every miss up to `backoff_max`.
+    """
+
+    def __init__(self, fetch, cache_size=TRANSACTION_CACHE_SIZE, persist=TRANSACTION_CACHE_PERSIST,
+                 backoff_min=TRANSACTION_BACKOFF_MIN, backoff_max=TRANSACTION_BACKOFF_MAX):
+        self.fetch = fetch
+        self.persist = persist
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self._found = LRUCache(cache_size)
+        # (misses count, time of the next lookup) by hash
+        self._missing = LRUCache(cache_size)
+
+    def is_backing_off(self, tx_hash: str) -> bool:
+        missing = self._missing.get(tx_hash)
+        return missing is not None and clock.time() < missing[1]
+
+    def backoff_left(self, tx_hash: str) -> float:
+        """Returns seconds till the not found transaction is looked up again, 0 if it isn't backed off"""
+        missing = self._missing.get(tx_hash)
+        return max(0.0, missing[1] - clock.time()) if missing is not None else 0.0
+
+    def reset(self, tx_hash: str):
+        """Forgets the misses of the transaction, e.g. when it's known to be in the ledger now"""
+        self._missing.pop(tx_hash)
+
+    def get(self, tx_hash: str, force=False):
+        """Returns the transaction or None if it isn't in the ledger.
+        None is also returned without a Horizon request while the transaction is backed off, unless `force`
+        """
+        tx = self._found.get(tx_hash)
+        if tx is not None:
+            TRANSACTION_LOOKUPS.inc('memory')
+            return tx
+        if self.persist:
+            doc = LedgerTransaction.objects(hash=tx_hash).first()
+            if doc is not None:
+                TRANSACTION_LOOKUPS.inc('mongodb')
+                tx = _from_document(doc)
+                self._found.set(tx_hash, tx)
+                return tx
+        if not force and self.is_backing_off(tx_hash):
+            TRANSACTION_LOOKUPS.inc('backoff')
+            return None
+
+        try:
+            tx_data = self.fetch(tx_hash)
+        except NotFoundError:
+            TRANSACTION_LOOKUPS.inc('not_found')
+            misses = self._missing.get(tx_hash, (0, 0))[0] + 1
+            delay = min(self.backoff_max, self.backoff_min * 2 ** (misses - 1))
+            self._missing.set(tx_hash, (misses, clock.time() + delay))
+            return None
+        TRANSACTION_LOOKUPS.inc('horizon')
+        tx = _from_data(tx_hash, tx_data)
+        self._missing.pop(tx_hash)
+        self._found.set(tx_hash, tx)
+        if self.persist:
+            _to_document(tx).save()
+        return tx
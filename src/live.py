@@ -0,0 +1,183 @@
+import json
+import logging
+import queue
+import threading
+import time
+
+from config import LIVE_POLL_INTERVAL, LIVE_LEADERS_COUNT, LIVE_QUEUE_SIZE, LIVE_MAX_SUBSCRIBERS
+from schema import Tourney, FINISHED_STATUSES, limit_members, load_members, sort_members
+
+
+class TooManySubscribersError(Exception):
+    pass
+
+
+def sse_message(event: str, data: dict) -> str:
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data, sort_keys=True))
+
+
+class _WatchedTourney(object):
+    def __init__(self, tourney: Tourney, leaders_count: int):
+        self.id = tourney.id
+        self.leaders_count = leaders_count
+        self.status = None
+        self.last_modified = None
+        self.members_count = 0
+        self.leaders = []
+        self.subscribers = set()
+        self.update(tourney)
+
+    def update(self, tourney: Tourney) -> list:
+        """Updates the state from the tourney loaded with its leaders and returns SSE messages"""
+        messages = []
+        if tourney.status != self.status:
+            messages.append(sse_message('status', {
+                '_id': str(self.id), 'status': tourney.status, 'previous_status': self.status
+            }))
+        leaders = [(m.user_id, m.name, m.currentTrophies) for m in sort_members(tourney.members)[:self.leaders_count]]
+        changes = [
+            {'place': place + 1, 'user_id': leader[0], 'name': leader[1], 'currentTrophies': leader[2]}
+            for place, leader in enumerate(leaders) if place >= len(self.leaders) or self.leaders[place] != leader
+        ]
+        if changes or tourney.members_count != self.members_count:
+            messages.append(sse_message('leaderboard', {
+                '_id': str(self.id), 'members_count': tourney.members_count, 'changes': changes
+            }))
+        self.status = tourney.status
+        self.last_modified = tourney.last_modified
+        self.members_count = tourney.members_count
+        self.leaders = leaders
+        return messages
+
+    def snapshot(self) -> str:
+        return sse_message('snapshot', {
+            '_id': str(self.id),
+            'status': self.status,
+            'members_count': self.members_count,
+            'leaders': [
+                {'place': place + 1, 'user_id': user_id, 'name': name, 'currentTrophies': trophies}
+                for place, (user_id, name, trophies) in enumerate(self.leaders)
+            ],
+        })
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATUSES
+
+
+class LiveHub(object):
+    """Pushes status transitions and leaderboard changes of tourneys to their SSE subscribers.
+
+    All subscribers of a tourney in the process share a single poll of its last_modified, and a changed tourney is
+    loaded and diffed once for all of them. A subscriber receives strings of SSE messages from its queue, and None
+    after the last message of a finished tourney. At most `max_subscribers` subscribers of running tourneys are
+    served at once.
+    """
+
+    def __init__(self, poll_interval, leaders_count, queue_size, max_subscribers):
+        self.poll_interval = poll_interval
+        self.leaders_count = leaders_count
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self._watched = {}
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _query(self, **query):
+        return limit_members(Tourney.objects(**query).only(
+            'id', 'status', 'last_modified', 'members_count', 'separate_members'
+        ), self.leaders_count)
+
+    def _load(self, tourney_ids) -> list:
+        return [load_members(tourney, self.leaders_count) for tourney in self._query(id__in=tourney_ids)]
+
+    def subscribe(self, tourney_id) -> queue.Queue:
+        with self._lock:
+            watched = self._watched.get(tourney_id)
+        if watched is None:
+            # raises DoesNotExist before anything is subscribed
+            watched = _WatchedTourney(load_members(self._query(id=tourney_id).get(), self.leaders_count),
+                                      self.leaders_count)
+        subscriber = queue.Queue(maxsize=self.queue_size)
+        if watched.finished:
+            # a finished tourney never changes, so it isn't watched
+            subscriber.put(watched.snapshot())
+            subscriber.put(None)
+            return subscriber
+        with self._lock:
+            # a watched tourney which finishes is removed by poll() under the lock
+            watched = self._watched.setdefault(watched.id, watched)
+            subscriber.put(watched.snapshot())
+            if watched.finished:
+                # poll() has removed it since it was read, so it was added again only now
+                del self._watched[watched.id]
+                subscriber.put(None)
+                return subscriber
+            if len(self._subscribers) >= self.max_subscribers:
+                if not watched.subscribers:
+                    del self._watched[watched.id]
+                raise TooManySubscribersError('%d live subscribers are served already' % len(self._subscribers))
+            self._subscribers.add(subscriber)
+            watched.subscribers.add(subscriber)
+            if self._thread is None:
+                # started lazily, so every forked web worker has its own poller
+                self._thread = threading.Thread(target=self._run, name='LiveHub')
+                self._thread.daemon = True
+                self._thread.start()
+        return subscriber
+
+    def unsubscribe(self, tourney_id, subscriber: queue.Queue):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+            watched = self._watched.get(tourney_id)
+            if watched is None:
+                return
+            watched.subscribers.discard(subscriber)
+            if not watched.subscribers:
+                del self._watched[tourney_id]
+
+    def _run(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.poll()
+            except BaseException as e:
+                logging.exception('Can\'t poll %d live tourneys: %r', len(self._watched), e)
+
+    def poll(self):
+        with self._lock:
+            last_modified = {tourney_id: watched.last_modified for tourney_id, watched in self._watched.items()}
+        if not last_modified:
+            return
+        changed = [t.id for t in Tourney.objects(id__in=list(last_modified)).only('id', 'last_modified')
+                   if t.last_modified != last_modified[t.id]]
+        if not changed:
+            return
+        for tourney in self._load(changed):
+            with self._lock:
+                watched = self._watched.get(tourney.id)
+                if watched is None:
+                    continue
+                messages = watched.update(tourney)
+                if watched.finished:
+                    messages.append(None)
+                    del self._watched[tourney.id]
+                for subscriber in list(watched.subscribers):
+                    self._publish(watched, subscriber, messages)
+
+    @staticmethod
+    def _publish(watched: _WatchedTourney, subscriber: queue.Queue, messages: list):
+        try:
+            for message in messages:
+                subscriber.put_nowait(message)
+        except queue.Full:
+            # a slow subscriber skips the diffs and catches up from the current snapshot
+            while not subscriber.empty():
+                subscriber.get_nowait()
+            subscriber.put_nowait(watched.snapshot())
+            if watched.finished:
+                subscriber.put_nowait(None)
+
+
+live_hub = LiveHub(LIVE_POLL_INTERVAL, LIVE_LEADERS_COUNT, LIVE_QUEUE_SIZE, LIVE_MAX_SUBSCRIBERS)
@@ -0,0 +1,42 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A thread-safe dictionary that keeps only `max_size` most recently used items"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return default
+            return self._items[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, default)
+
+    def keys(self) -> list:
+        """Returns the keys from the least recently used one without refreshing them"""
+        with self._lock:
+            return list(self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
@@ -0,0 +1,91 @@
+"""The time source of the tourneys and the transactions workers.
+
+The system clock is used by default, a simulation installs a VirtualClock with set_clock() to run the workers on
+virtual time. Durations measured for metrics stay on the system clock.
+"""
+import threading
+import time as _time
+from datetime import datetime, timedelta
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+class SystemClock(object):
+    @staticmethod
+    def time() -> float:
+        return _time.time()
+
+    @staticmethod
+    def utcnow() -> datetime:
+        return datetime.utcnow()
+
+    @staticmethod
+    def sleep(seconds):
+        _time.sleep(seconds)
+
+    @staticmethod
+    def wait(condition: threading.Condition, timeout=None) -> bool:
+        return condition.wait(timeout)
+
+
+class VirtualClock(object):
+    """A clock which moves only by sleep() and advance(), so waiting takes no real time"""
+
+    def __init__(self, start: datetime = None):
+        self._now = start or datetime.utcnow()
+        self._lock = threading.Lock()
+
+    def time(self) -> float:
+        return (self._now - _EPOCH).total_seconds()
+
+    def utcnow(self) -> datetime:
+        return self._now
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def wait(self, condition: threading.Condition, timeout=None) -> bool:
+        """Times out at once by advancing the clock, only a wait without timeout takes real time till a notify"""
+        if timeout is None:
+            return condition.wait()
+        self.advance(timeout)
+        return False
+
+    def advance(self, seconds):
+        with self._lock:
+            self._now += timedelta(seconds=seconds)
+
+    def advance_to(self, moment: datetime):
+        with self._lock:
+            self._now = max(self._now, moment)
+
+
+_clock = SystemClock()
+
+
+def set_clock(clock):
+    global _clock
+    _clock = clock
+
+
+def get_clock():
+    return _clock
+
+
+def time() -> float:
+    return _clock.time()
+
+
+def utcnow() -> datetime:
+    return _clock.utcnow()
+
+
+def sleep(seconds):
+    _clock.sleep(seconds)
+
+
+def wait(condition: threading.Condition, timeout=None) -> bool:
+    """Waits for a notify of the acquired `condition` for at most `timeout` seconds of the clock like
+    Condition.wait(), returns False if it timed out
+    """
+    return _clock.wait(condition, timeout)
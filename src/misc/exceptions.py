@@ -20,3 +20,7 @@ class TourneyNotJoinableError(UserError):
 
 class TransactionHashError(UserError):
     pass
+
+
+class InvalidDataError(UserError):
+    pass
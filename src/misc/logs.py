@@ -1,6 +1,10 @@
+import atexit
+import json
 import logging
 import logging.handlers
 import os.path
+import queue
+import random
 
 import config
 
@@ -19,35 +23,65 @@ skip_names = [
     'pika.channel'
 ]
 
+# the listener writing the records of the asynchronous mode
+_listener = None
+
 
 def init(log_file_prefix,
          log_file_enable=False, debug_file_enable=False,
-         debug_level=config.LOG_LEVEL_DEFAULT, log_format=config.LOG_FORMAT):
-    logging.getLogger().setLevel(logging.DEBUG)
+         debug_level=config.LOG_LEVEL_DEFAULT, log_format=config.LOG_FORMAT,
+         async_enable=config.LOG_ASYNC, json_enable=config.LOG_JSON, sampling=config.LOG_SAMPLING):
+    """Logs to stderr and optionally to daily rotated files.
+
+    With `async_enable` the logging threads only put records into a queue and a listener thread formats and writes
+    them, records are dropped while the queue is full. `json_enable` writes a JSON object per record.
+    `sampling` keeps only the given share of records below WARNING by logger name or module name.
+    """
+    global _listener
+    # records which no handler would write aren't created at all
+    logging.getLogger().setLevel(logging.DEBUG if debug_file_enable else debug_level)
+    formatter = JsonFormatter() if json_enable else logging.Formatter(log_format)
+    filters = [debug_filter]
+    if sampling:
+        filters.append(SamplingFilter(sampling))
 
+    handlers = []
     default_logger = logging.StreamHandler()
-    default_logger.setFormatter(logging.Formatter(log_format))
     default_logger.setLevel(debug_level)
-    default_logger.addFilter(debug_filter)
-    logging.getLogger().addHandler(default_logger)
+    handlers.append(default_logger)
 
     if log_file_enable:
         rotating_handler = logging.handlers.TimedRotatingFileHandler(
             os.path.join(config.SERVER_LOG_PATH, '%s.log' % log_file_prefix), 'D'
         )
-        rotating_handler.setFormatter(logging.Formatter(log_format))
         rotating_handler.setLevel(debug_level)
-        rotating_handler.addFilter(debug_filter)
-        logging.getLogger().addHandler(rotating_handler)
+        handlers.append(rotating_handler)
 
     if debug_file_enable:
         rotating_handler_debug = logging.handlers.TimedRotatingFileHandler(
             os.path.join(config.SERVER_LOG_PATH, '%s_debug.log' % log_file_prefix), 'D'
         )
-        rotating_handler_debug.setFormatter(logging.Formatter(log_format))
         rotating_handler_debug.setLevel(logging.DEBUG)
-        rotating_handler_debug.addFilter(debug_filter)
-        logging.getLogger().addHandler(rotating_handler_debug)
+        handlers.append(rotating_handler_debug)
+
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    if not async_enable:
+        for handler in handlers:
+            for f in filters:
+                handler.addFilter(f)
+            logging.getLogger().addHandler(handler)
+        return
+
+    # records are filtered once before they are queued
+    queue_handler = DroppingQueueHandler(queue.Queue(config.LOG_QUEUE_SIZE))
+    for f in filters:
+        queue_handler.addFilter(f)
+    logging.getLogger().addHandler(queue_handler)
+    _listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    # the queued records are written before exit
+    atexit.register(_listener.stop)
 
 
 def debug_filter(record):
@@ -58,3 +92,58 @@ def debug_filter(record):
     if record.module in skip_modules:
         return 0
     return 1
+
+
+class SamplingFilter(logging.Filter):
+    """Passes only a share of records below WARNING, by {logger name or module name: share}"""
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return 1
+        # the decision is made once, so every handler writes or skips the same records
+        sampled = getattr(record, 'sampled', None)
+        if sampled is None:
+            rate = self.rates.get(record.name, self.rates.get(record.module))
+            sampled = record.sampled = rate is None or random.random() < rate
+        return 1 if sampled else 0
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queues records without blocking, the records which don't fit into the full queue are dropped and counted"""
+
+    def __init__(self, records_queue):
+        super().__init__(records_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # the message is merged now as its arguments may change later, formatting is left to the listener thread
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'module': record.module,
+            'function': record.funcName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data)
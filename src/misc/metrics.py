@@ -0,0 +1,285 @@
+"""In-process metrics exposed in the Prometheus text format.
+
+Every process has its own metrics: the transactions workers start their own HTTP server by serve(), the forked REST
+workers share theirs by enable_multiprocess(), so /api/metrics of any worker renders the metrics of all of them.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from pymongo import monitoring
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(label_names, labels, extra=''):
+    pairs = ['%s="%s"' % (name, _escape(value)) for name, value in zip(label_names, labels)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def render(self):
+        return self._render(self.label_names, dict(self.snapshot()))
+
+    def snapshot(self) -> list:
+        """Returns (labels, value) of every labels combination"""
+        with self._lock:
+            return [(labels, list(value) if isinstance(value, list) else value)
+                    for labels, value in self._values.items()]
+
+    def merge(self, snapshots: dict) -> list:
+        """Renders the metric of several processes by {pid: snapshot() of the process}"""
+        values = {}
+        for pid, snapshot in snapshots.items():
+            for labels, value in snapshot:
+                labels = tuple(labels)
+                values[labels] = value if labels not in values else self._add(values[labels], value)
+        return self._render(self.label_names, values)
+
+    @staticmethod
+    def _add(total, value):
+        return total + value
+
+    def _render(self, label_names, values: dict):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s %s' % (self.name, self.type)]
+        for labels, value in sorted(values.items()):
+            lines.extend(self._render_value(label_names, labels, value))
+        return lines
+
+    def _render_value(self, label_names, labels, value):
+        return ['%s%s %s' % (self.name, _format_labels(label_names, labels), _format_value(value))]
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def merge(self, snapshots: dict) -> list:
+        # values of different processes can't be added up, so every process has its own
+        return self._render(self.label_names + ('pid',), {
+            tuple(labels) + (pid,): value for pid, snapshot in snapshots.items() for labels, value in snapshot
+        })
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                # counts of every bucket, then the sum of the values
+                counts = self._values[labels] = [0] * len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, *labels)
+
+    @staticmethod
+    def _add(total, counts):
+        return [a + b for a, b in zip(total, counts)]
+
+    def _render_value(self, label_names, labels, counts):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets, counts):
+            total += count
+            lines.append('%s_bucket%s %d' % (
+                self.name, _format_labels(label_names, labels, 'le="%s"' % _format_value(bound)), total
+            ))
+        lines.append('%s_sum%s %s' % (self.name, _format_labels(label_names, labels), _format_value(counts[-1])))
+        lines.append('%s_count%s %d' % (self.name, _format_labels(label_names, labels), total))
+        return lines
+
+
+# the directory shared by the processes, see enable_multiprocess()
+_multiprocess_dir = None
+
+
+def render() -> str:
+    lines = []
+    if _multiprocess_dir is None:
+        for metric in _registry:
+            lines.extend(metric.render())
+    else:
+        # the own snapshot is rendered fresh
+        _write_snapshot(_multiprocess_dir)
+        snapshots = _read_snapshots(_multiprocess_dir)
+        for metric in _registry:
+            lines.extend(metric.merge({pid: snapshot[metric.name]['values']
+                                       for pid, snapshot in snapshots.items() if metric.name in snapshot}))
+    return '\n'.join(lines) + '\n'
+
+
+def _snapshot_path(directory, pid) -> str:
+    return os.path.join(directory, '%d.json' % pid)
+
+
+def _dump(path, snapshot: dict):
+    # renamed into place, so readers never see a partly written file
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(path + '.tmp', path)
+
+
+def _write_snapshot(directory):
+    _dump(_snapshot_path(directory, os.getpid()),
+          {metric.name: {'type': metric.type, 'values': metric.snapshot()} for metric in _registry})
+
+
+def _read_snapshots(directory) -> dict:
+    snapshots = {}
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                snapshots[name[:-len('.json')]] = json.load(f)
+        except (OSError, ValueError):
+            # removed meanwhile
+            continue
+    return snapshots
+
+
+def clear_multiprocess(directory):
+    """Removes the metrics of the previous run, called once before the processes start"""
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+
+
+def enable_multiprocess(directory, sync_interval):
+    """Shares the metrics of the process through `directory`, where it writes them every `sync_interval` seconds.
+    The metrics of all processes are rendered summed up, except for gauges which are labeled by the process id
+    """
+    global _multiprocess_dir
+    _multiprocess_dir = directory
+    os.makedirs(directory, exist_ok=True)
+    _write_snapshot(directory)
+
+    def sync():
+        while True:
+            time.sleep(sync_interval)
+            try:
+                _write_snapshot(directory)
+            except BaseException as e:
+                logging.exception('Can\'t write metrics to %s: %r', directory, e)
+
+    thread = threading.Thread(target=sync, name='MetricsSync')
+    thread.daemon = True
+    thread.start()
+
+
+def mark_process_dead(directory, pid):
+    """Drops gauges of the exited process, its counters and histograms stay in the totals"""
+    path = _snapshot_path(directory, pid)
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return
+    _dump(path, {name: metric for name, metric in snapshot.items() if metric['type'] != Gauge.type})
+
+
+MONGO_COMMAND_SECONDS = Histogram('mongo_command_seconds', 'MongoDB commands latency', ('command',))
+MONGO_COMMAND_ERRORS = Counter('mongo_command_errors_total', 'Failed MongoDB commands', ('command',))
+
+
+class _MongoListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1000000, event.command_name)
+
+    def failed(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1000000, event.command_name)
+        MONGO_COMMAND_ERRORS.inc(event.command_name)
+
+
+_mongo_listener = None
+
+
+def register_mongo_listener():
+    """Times commands of MongoDB clients, must be called before the connection is created"""
+    global _mongo_listener
+    if _mongo_listener is None:
+        _mongo_listener = _MongoListener()
+        monitoring.register(_mongo_listener)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # noinspection PyShadowingBuiltins
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port):
+    """Serves the metrics of a process without a web server in a background thread"""
+    server = HTTPServer(('0.0.0.0', port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='Metrics')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -30,3 +30,18 @@ class CustomEncoder(json.JSONEncoder):
         elif isinstance(obj, float) and (obj == 0.0):
             return int(0)
         return json.JSONEncoder.default(self, obj)
+
+
+def format_datetime(obj: datetime.datetime) -> str:
+    """The same as default() of a datetime, without a strftime call"""
+    return '%04d%02d%02dT%02d%02d%02d.%03dZ' % (
+        obj.year, obj.month, obj.day, obj.hour, obj.minute, obj.second, obj.microsecond // 1000
+    )
+
+
+_plain_encoder = json.JSONEncoder(sort_keys=True)
+
+
+def dumps_plain(obj) -> str:
+    """Serializes an object of plain JSON types (see schema.raw_tourney_as_dict) like CustomEncoder does"""
+    return _plain_encoder.encode(obj)
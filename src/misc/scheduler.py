@@ -0,0 +1,73 @@
+import heapq
+import threading
+from datetime import datetime
+
+from misc import clock
+
+
+class Scheduler(object):
+    """A thread-safe priority queue of keys by their due time.
+
+    `pop` sleeps until the earliest key is due and is woken up by `schedule` when an earlier key is added.
+    Scheduling a key again replaces its previous due time.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._due = {}
+        self._condition = threading.Condition()
+
+    def schedule(self, key, due: datetime):
+        with self._condition:
+            self._due[key] = due
+            heapq.heappush(self._heap, (due, key))
+            self._condition.notify()
+
+    def cancel(self, key):
+        with self._condition:
+            self._due.pop(key, None)
+
+    def _skip_stale(self):
+        # skip the entries of cancelled and rescheduled keys
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def next_due(self):
+        """Returns the due time of the earliest key or None if nothing is scheduled"""
+        with self._condition:
+            self._skip_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self):
+        """Returns the earliest key if it's due or None without waiting"""
+        with self._condition:
+            self._skip_stale()
+            if self._heap and self._heap[0][0] <= clock.utcnow():
+                due, key = heapq.heappop(self._heap)
+                del self._due[key]
+                return key
+            return None
+
+    def pop(self, timeout=None):
+        """Waits for the earliest due key and returns it, returns None if `timeout` seconds passed first"""
+        started = clock.utcnow()
+        with self._condition:
+            while True:
+                self._skip_stale()
+                now = clock.utcnow()
+                if self._heap and self._heap[0][0] <= now:
+                    due, key = heapq.heappop(self._heap)
+                    del self._due[key]
+                    return key
+                wait = None
+                if self._heap:
+                    wait = (self._heap[0][0] - now).total_seconds()
+                if timeout is not None:
+                    left = timeout - (now - started).total_seconds()
+                    if left <= 0:
+                        return None
+                    wait = left if wait is None else min(wait, left)
+                clock.wait(self._condition, wait)
+
+    def __len__(self):
+        return len(self._due)
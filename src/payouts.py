@@ -0,0 +1,96 @@
+import threading
+from contextlib import contextmanager
+
+from bson import ObjectId
+from kin.stellar.builder import Builder
+from stellar_base.keypair import Keypair
+from stellar_base.network import NETWORKS
+
+from config import NETWORK, HORIZON_URL, KIN_ASSET, SECRET_KEY, PUBLIC_KEY, PAYOUT_CHANNEL_SECRET_KEYS, \
+    PAYOUT_CHANNEL_LEASE, PAYOUT_CHANNEL_POLL_INTERVAL
+from misc import clock
+from schema import PayoutChannel
+
+NETWORKS['CUSTOM'] = 'private testnet'
+
+# a text memo is limited by 28 bytes
+PAYOUT_MEMO = 'Your tourney prize'
+
+
+class ChannelPool(object):
+    """Accounts used as sources of payout transactions.
+
+    Every channel has its own sequence number, so transactions of different channels can be submitted in parallel,
+    while the money is still sent from the main account. A channel is used by a single transaction at a time.
+    With `lease_seconds` the channels are also leased in MongoDB, so processes configured with the same keys never
+    use a channel at the same time.
+    """
+
+    def __init__(self, secret_keys, lease_seconds=None):
+        self._secret_keys = {Keypair.from_seed(secret_key).address().decode(): secret_key
+                             for secret_key in secret_keys}
+        self._free = list(self._secret_keys)
+        self._condition = threading.Condition()
+        self._lease_seconds = lease_seconds
+        self._owner = str(ObjectId())
+
+    def _lease(self, address) -> bool:
+        return self._lease_seconds is None or PayoutChannel.claim(address, self._owner, self._lease_seconds)
+
+    @contextmanager
+    def acquire(self, address=None):
+        """Waits for a free channel, or for the given one if it's in the pool, and yields its (address, secret key)"""
+        if address not in self._secret_keys:
+            address = None
+        with self._condition:
+            while True:
+                candidates = [a for a in self._free if address is None or a == address]
+                leased = next((a for a in candidates if self._lease(a)), None)
+                if leased is not None:
+                    break
+                # a channel released in this process notifies, the ones leased by other processes are polled
+                clock.wait(self._condition, PAYOUT_CHANNEL_POLL_INTERVAL if candidates else None)
+            self._free.remove(leased)
+        try:
+            yield leased, self._secret_keys[leased]
+        finally:
+            if self._lease_seconds is not None:
+                PayoutChannel.release(leased, self._owner)
+            with self._condition:
+                self._free.append(leased)
+                self._condition.notify_all()
+
+    def __len__(self):
+        return len(self._secret_keys)
+
+
+_channel_pool = None
+_channel_pool_lock = threading.Lock()
+
+
+def get_channel_pool() -> ChannelPool:
+    """The pool of the configured channels, built on the first use, so the keys are parsed only by the workers"""
+    global _channel_pool
+    if _channel_pool is None:
+        with _channel_pool_lock:
+            if _channel_pool is None:
+                # without channels all payouts are sent from the main account one by one
+                _channel_pool = ChannelPool(PAYOUT_CHANNEL_SECRET_KEYS or [SECRET_KEY], PAYOUT_CHANNEL_LEASE)
+    return _channel_pool
+
+
+def build_payout(payments: list, channel_secret_key: str, sequence=None) -> Builder:
+    """Returns a signed transaction with a KIN payment operation for every (wallet, amount) of `payments`,
+    the channel is the transaction source and the main account is the source of the payments.
+    Without the current `sequence` of the channel the builder requests it from Horizon
+    """
+    builder = Builder(secret=channel_secret_key, horizon_uri=HORIZON_URL, network=NETWORK, sequence=sequence)
+    is_channel = channel_secret_key != SECRET_KEY
+    for wallet, amount in payments:
+        builder.append_payment_op(wallet, '%.7f' % amount, asset_type=KIN_ASSET.code, asset_issuer=KIN_ASSET.issuer,
+                                  source=PUBLIC_KEY if is_channel else None)
+    builder.add_text_memo(PAYOUT_MEMO)
+    builder.sign()
+    if is_channel:
+        builder.sign(SECRET_KEY)
+    return builder
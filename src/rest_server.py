@@ -1,24 +1,37 @@
 #!/usr/bin/env python3
+import hashlib
 import json
 import logging
+import queue
 import signal
 import sys
 import threading
+import time
 import traceback
 from functools import wraps
 from json import JSONDecodeError
 
-from flask import Flask, jsonify, request
-from mongoengine import connect
+from bson import ObjectId
+from flask import Flask, jsonify, request, g
+from flask.json import dumps as json_dumps
+from mongoengine.connection import get_db
 
 import config
 import misc.myjson
-import transactions
-from misc import logs
-from misc.exceptions import UserError
-from schema import Tourney, TourneyStatus
+import schema
+from live import live_hub, TooManySubscribersError
+from misc import logs, metrics
+from misc.cache import LRUCache
+from misc.exceptions import UserError, UserAlreadyJoinedError, TourneyTransactionDuplicatedError, \
+    TourneyNotJoinableError
+from scores import score_buffer
+from schema import Tourney, JOINABLE_STATUSES, FINISHED_STATUSES, raw_tourneys, raw_tourney_as_dict
 
 SESSION_STORAGE = {}
+HTTP_REQUEST_SECONDS = metrics.Histogram('http_request_seconds', 'REST API requests latency', ('endpoint', 'method'))
+HTTP_RESPONSES = metrics.Counter('http_responses_total', 'REST API responses', ('endpoint', 'method', 'status'))
+# serialized tourneys by (id, version, members_limit)
+TOURNEY_CACHE = LRUCache(config.TOURNEY_CACHE_SIZE)
 
 logs.init('rest_server')
 app = Flask(__name__)
@@ -93,19 +106,41 @@ def jsonify_with_code(data):
     return jsonify(data), status
 
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.time()
+
+
+@app.after_request
+def observe_request(response):
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unknown'
+    HTTP_REQUEST_SECONDS.observe(time.time() - g.request_started, endpoint, request.method)
+    HTTP_RESPONSES.inc(endpoint, request.method, response.status_code)
+    return response
+
+
+# errors of a request which conflicts with the state of a tourney rather than being invalid
+CONFLICT_ERRORS = (UserAlreadyJoinedError, TourneyTransactionDuplicatedError, TourneyNotJoinableError)
+
+
+def user_error_info(e: UserError) -> dict:
+    return {'status': 'failed', 'errorCode': e.__class__.__name__, 'error': e.args[0]}
+
+
 def process_exceptions(func):
     @wraps(func)
     def wrap(*args, **kwargs):
         try:
             return func(*args, **kwargs)
         except ArgumentError as e:
-            info = {'status': 'failed', 'error': '%s' % e.args}
+            info = {'status': 'failed', 'error': '%s' % e.args, 'httpStatus': 400}
             return jsonify_with_code(info)
         except Exception as e:
             traceback.print_exception(e, e, e.__traceback__)
             if isinstance(e, UserError):
-                info = {'status': 'failed', 'errorCode': e.__class__.__name__,
-                        'error': e.args[0]}
+                info = user_error_info(e)
+                if isinstance(e, CONFLICT_ERRORS):
+                    info['httpStatus'] = 409
             else:
                 info = {'status': 'failed', 'error': 'Exception %s occurred: %s' % (type(e).__name__, e.args)}
             return jsonify_with_code(info)
@@ -114,30 +149,131 @@ def process_exceptions(func):
 
 
 @app.route('/api/healthz', methods=['GET'])
+@app.route('/api/healthz/live', methods=['GET'])
 @process_exceptions
 def healthz():
+    """Liveness, the process serves requests. It doesn't depend on MongoDB, so an outage doesn't restart replicas"""
     logging.debug('receive %s', request.full_path)
     return jsonify_with_code({'status': 'ok'})
 
 
+@app.route('/api/healthz/ready', methods=['GET'])
+@process_exceptions
+def readiness():
+    """Readiness, the dependencies answer, so the replica can take traffic"""
+    logging.debug('receive %s', request.full_path)
+    started = time.time()
+    try:
+        get_db().command('ping')
+    except Exception as e:
+        mongodb = {'status': 'error', 'error': repr(e)}
+    else:
+        mongodb = {'status': 'ok'}
+    mongodb['latency_ms'] = round((time.time() - started) * 1000, 1)
+    ready = mongodb['status'] == 'ok'
+    return jsonify({'status': 'ok' if ready else 'error', 'mongodb': mongodb}), 200 if ready else 503
+
+
+def get_statuses(name: str, required=False) -> tuple:
+    s = get_str(name, required=required)
+    if not s:
+        return None
+    if s == 'joinable':
+        return JOINABLE_STATUSES
+    if s == 'previous':
+        return FINISHED_STATUSES
+    statuses = tuple(s.split(','))
+    for status in statuses:
+        if status not in JOINABLE_STATUSES + FINISHED_STATUSES:
+            raise ArgumentError('The value of parameter %s has unknown status (%s)' % (name, status))
+    return statuses
+
+
+def get_limit(name: str, default: int, maximum: int) -> int:
+    limit = get_int(name, default=default)
+    if limit is None:
+        return None
+    if limit < 0:
+        raise ArgumentError('The value of parameter %s must not be negative (%d)' % (name, limit))
+    return min(limit, maximum)
+
+
+def get_cursor(name: str, required=False) -> str:
+    s = get_str(name, required=required)
+    if not s:
+        return None
+    if not ObjectId.is_valid(s):
+        raise ArgumentError('The value of parameter %s is not a valid cursor (%s)' % (name, s))
+    return s
+
+
+def json_response(body: str, etag: str):
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+
+def not_modified_response(etag: str):
+    if not request.if_none_match.contains(etag):
+        return None
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def render_tourneys(tourneys: list, members_limit=None) -> list:
+    """Serializes tourneys that are given with id and version only, loading the ones missing in the cache"""
+    bodies = {t.id: TOURNEY_CACHE.get((t.id, t.version, members_limit)) for t in tourneys}
+    missed = [tid for tid, body in bodies.items() if body is None]
+    if missed:
+        for doc in raw_tourneys(missed, members_limit):
+            bodies[doc['_id']] = misc.myjson.dumps_plain(raw_tourney_as_dict(doc, members_limit))
+            TOURNEY_CACHE.set((doc['_id'], doc.get('version'), members_limit), bodies[doc['_id']])
+    return [bodies[t.id] for t in tourneys]
+
+
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    return app.response_class(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @app.route('/api/v1/tourneys', methods=['GET'])
 @process_exceptions
 def get_tourneys():
     logging.debug('receive %s', request.full_path)
+    limit = get_limit('limit', default=config.TOURNEYS_PAGE_SIZE, maximum=config.TOURNEYS_PAGE_SIZE_MAX)
+    if limit == 0:
+        raise ArgumentError('The value of parameter limit must be positive (%d)' % limit)
+    members_limit = get_limit('members_limit', default=None, maximum=sys.maxsize)
+    # one extra tourney tells whether there is a next page
+    tourneys = Tourney.page(statuses=get_statuses('status'), cursor=get_cursor('cursor'), limit=limit + 1,
+                            fields=('id', 'status', 'version'))
+    next_cursor = str(tourneys[limit - 1].id) if len(tourneys) > limit else None
+    tourneys = tourneys[:limit]
+
+    etag = hashlib.sha1(request.query_string)
+    # a tourney added after the last one changes only whether there is a next page
+    etag.update(('%s;' % next_cursor).encode())
+    for t in tourneys:
+        etag.update(('%s-%s;' % (t.id, t.version)).encode())
+    etag = etag.hexdigest()
+    response = not_modified_response(etag)
+    if response is not None:
+        return response
+
     joinable = []
     previous = []
-    for t in Tourney.objects():
-        if t.status in (TourneyStatus.NOT_PAYED_YET.value, TourneyStatus.PAYED.value):
-            joinable.append(t.as_dict())
+    for t, body in zip(tourneys, render_tourneys(tourneys, members_limit)):
+        if t.status in JOINABLE_STATUSES:
+            joinable.append(body)
         else:
-            previous.append(t.as_dict())
-    return jsonify_with_code(
-        {
-            "59e5c4d712082e08a857ff64": {
-                "joinable": joinable,
-                "previous": previous
-            }
-        }
+            previous.append(body)
+    # the same layout as jsonify() with sorted keys, assembled from the cached tourneys
+    return json_response(
+        '{"59e5c4d712082e08a857ff64": {"joinable": [%s], "next_cursor": %s, "previous": [%s]}}' % (
+            ', '.join(joinable), json_dumps(next_cursor), ', '.join(previous)
+        ),
+        etag
     )
 
 
@@ -155,27 +291,154 @@ def create_tourney():
     return jsonify_with_code({'status': 'ok'})
 
 
+@app.route('/api/v1/tourneys/bulk', methods=['POST'])
+@process_exceptions
+def create_tourneys():
+    logging.debug('receive %s', request.full_path)
+    tourneys = get_json('tourneys', required=True)
+    if not isinstance(tourneys, list):
+        raise ArgumentError('The parameter tourneys must be a JSON array')
+    if len(tourneys) > config.BULK_SIZE_MAX:
+        raise ArgumentError('The parameter tourneys has more than %d items' % config.BULK_SIZE_MAX)
+    results = []
+    for data, result in zip(tourneys, Tourney.create_many(tourneys)):
+        if isinstance(result, UserError):
+            info = user_error_info(result)
+        else:
+            info = {'status': 'ok', '_id': result.id}
+        info['transaction_id'] = data.get('transaction_id') if isinstance(data, dict) else None
+        results.append(info)
+    return jsonify_with_code({'status': 'ok', 'results': results})
+
+
 @app.route('/api/v1/tourneys/<tid>', methods=['GET'])
 @process_exceptions
 def get_tourney(tid):
     logging.debug('receive %s', request.full_path)
-    t = Tourney.objects.get(id=tid)
-    return jsonify_with_code(t.as_dict())
+    members_limit = get_limit('members_limit', default=None, maximum=sys.maxsize)
+    t = Tourney.objects(id=tid).only('id', 'version').get()
+    etag = '%s-%s-%s' % (t.id, t.version, members_limit)
+    response = not_modified_response(etag)
+    if response is not None:
+        return response
+    return json_response(render_tourneys([t], members_limit)[0], etag)
+
+
+@app.route('/api/v1/tourneys/<tid>/leaderboard', methods=['GET'])
+@process_exceptions
+def get_leaderboard(tid):
+    logging.debug('receive %s', request.full_path)
+    offset = get_limit('offset', default=0, maximum=sys.maxsize)
+    limit = get_limit('limit', default=config.LEADERBOARD_PAGE_SIZE, maximum=config.LEADERBOARD_PAGE_SIZE_MAX)
+    if limit == 0:
+        raise ArgumentError('The value of parameter limit must be positive (%d)' % limit)
+    t = Tourney.leaderboard(tid, offset=offset, limit=limit)
+    # noinspection PyTypeChecker
+    return jsonify_with_code({
+        '_id': t.id,
+        'members_count': t.members_count,
+        'last_modified': t.last_modified,
+        'offset': offset,
+        'limit': limit,
+        'members': [dict(m.as_dict(), place=offset + i + 1) for i, m in enumerate(t.members)],
+    })
+
+
+@app.route('/api/v1/tourneys/<tid>/events', methods=['GET'])
+@process_exceptions
+def get_tourney_events(tid):
+    logging.debug('receive %s', request.full_path)
+    if not ObjectId.is_valid(tid):
+        raise ArgumentError('Tourney id %s is invalid' % tid)
+    tourney_id = ObjectId(tid)
+    try:
+        subscriber = live_hub.subscribe(tourney_id)
+    except TooManySubscribersError as e:
+        # the other requests keep their threads, the client reconnects later
+        return jsonify_with_code({'status': 'failed', 'error': str(e), 'httpStatus': 503})
+
+    def stream():
+        try:
+            while True:
+                try:
+                    message = subscriber.get(timeout=config.LIVE_HEARTBEAT_INTERVAL)
+                except queue.Empty:
+                    yield ': heartbeat\n\n'
+                    continue
+                if message is None:
+                    return
+                yield message
+        finally:
+            live_hub.unsubscribe(tourney_id, subscriber)
+
+    return app.response_class(stream(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 @app.route('/api/v1/tourneys/<tid>/join', methods=['POST'])
 @process_exceptions
 def join_tourney(tid):
     logging.debug('receive %s', request.full_path)
-    t = Tourney.objects.get(id=tid)  # type: Tourney
-    t.join({
+    members_limit = get_limit('members_limit', default=None, maximum=sys.maxsize)
+    t = Tourney.join(tid, {
         'user_id': get_str('user_id', required=True),
         'alias_id': get_str('alias_id', required=True),
         'name': get_str('name', required=True),
         'tag': get_str('tag', required=True),
         'wallet_public_key': get_str('wallet_public_key', required=True),
-    })
-    return jsonify_with_code(t.as_dict())
+    }, members_limit=members_limit)
+    return jsonify_with_code(t.as_dict(members_limit))
+
+
+@app.route('/api/v1/tourneys/<tid>/join/bulk', methods=['POST'])
+@process_exceptions
+def join_tourney_bulk(tid):
+    logging.debug('receive %s', request.full_path)
+    members_limit = get_limit('members_limit', default=None, maximum=sys.maxsize)
+    members = get_json('members', required=True)
+    if not isinstance(members, list):
+        raise ArgumentError('The parameter members must be a JSON array')
+    if len(members) > config.BULK_SIZE_MAX:
+        raise ArgumentError('The parameter members has more than %d items' % config.BULK_SIZE_MAX)
+    t, errors = Tourney.join_many(tid, members, members_limit=members_limit)
+    results = []
+    for member, error in zip(members, errors):
+        info = user_error_info(error) if error is not None else {'status': 'ok'}
+        info['user_id'] = member.get('user_id') if isinstance(member, dict) else None
+        results.append(info)
+    return jsonify_with_code({'status': 'ok', 'results': results, 'tourney': t.as_dict(members_limit)})
+
+
+def _is_integer(value) -> bool:
+    # JSON true and false are bools, which are ints in Python
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+@app.route('/api/v1/scores', methods=['POST'])
+@process_exceptions
+def post_scores():
+    logging.debug('receive %s', request.full_path)
+    scores = get_json('scores', required=True)
+    if not isinstance(scores, list):
+        raise ArgumentError('The parameter scores must be a JSON array')
+    if len(scores) > config.SCORES_BATCH_MAX:
+        raise ArgumentError('The parameter scores has more than %d items' % config.SCORES_BATCH_MAX)
+    updates = []
+    for i, score in enumerate(scores):
+        if not isinstance(score, dict) or not ObjectId.is_valid(score.get('tourney_id')) \
+                or not isinstance(score.get('user_id'), str):
+            raise ArgumentError('The score #%d must have tourney_id and user_id' % i)
+        value, delta, seq = score.get('value'), score.get('delta'), score.get('seq')
+        if (value is None) == (delta is None) or not _is_integer(value if delta is None else delta):
+            raise ArgumentError('The score #%d must have either integer value or integer delta' % i)
+        # values sent by several clients or through several processes are ordered by their sequence numbers
+        if seq is not None and (value is None or not _is_integer(seq)):
+            raise ArgumentError('The score #%d may have an integer seq only with a value' % i)
+        updates.append((ObjectId(score['tourney_id']), score['user_id'], value, delta or 0, seq))
+    # the whole batch is validated before any update is accepted
+    for tourney_id, user_id, value, delta, seq in updates:
+        score_buffer.add(tourney_id, user_id, value=value, delta=delta, seq=seq)
+    return jsonify_with_code({'status': 'ok', 'accepted': len(updates)})
 
 
 # noinspection PyBroadException,PyUnusedLocal
@@ -184,10 +447,16 @@ def __interrupt(sig, frame):
     sys.exit(0)
 
 
+# Development server which also runs the transactions workers, see gunicorn_conf.py for the production serving
 if __name__ == '__main__':
     signal.signal(signal.SIGINT, __interrupt)
 
-    connect(host=config.MONGODB_URI)
+    # the SDK of the transactions workers is built only by the development server
+    import transactions
+
+    schema.connect_db()
+    schema.ensure_indexes()
+    schema.migrate()
 
     thread = threading.Thread(target=transactions.main, name='Transactions')
     thread.daemon = True
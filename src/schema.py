@@ -2,20 +2,33 @@ from datetime import datetime, timedelta
 from enum import Enum
 from random import randint
 
+from bson import ObjectId
 from kin.stellar.utils import is_valid_address, is_valid_transaction_hash
 from mongoengine import *
 from mongoengine import signals
+from pymongo import UpdateOne, ReplaceOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
 # noinspection PyUnusedLocal
-from config import TOURNEY_URL, TOURNEY_LENGTH
-from misc.exceptions import UserAlreadyJoinedError, TourneyTransactionDuplicatedError, WalletAddressError, \
-    TransactionHashError, TourneyNotJoinableError
+from config import TOURNEY_URL, TOURNEY_LENGTH, TOURNEYS_PAGE_SIZE, LEADERBOARD_PAGE_SIZE, MONGODB_URI, \
+    MONGODB_POOL_SIZE, MONGODB_SERVER_TIMEOUT, MEMBERS_SEPARATE
+from misc import clock, metrics
+from misc.exceptions import UserError, UserAlreadyJoinedError, TourneyTransactionDuplicatedError, \
+    WalletAddressError, TransactionHashError, TourneyNotJoinableError, InvalidDataError
+from misc.myjson import format_datetime
 
 
 # noinspection PyUnusedLocal
 def _set_last_modified(sender, **kwargs):
     doc = kwargs['document']
-    doc.last_modified = datetime.utcnow()
+    doc.last_modified = clock.utcnow()
+
+
+# noinspection PyUnusedLocal
+def _inc_version(sender, **kwargs):
+    # a save $sets the changed fields, so the version is incremented by a separate atomic update
+    if not kwargs.get('created'):
+        sender.objects(id=kwargs['document'].id).update_one(inc__version=1)
 
 
 class TourneyMemberED(EmbeddedDocument):
@@ -26,6 +39,11 @@ class TourneyMemberED(EmbeddedDocument):
     wallet_public_key = StringField(required=True)
     joinedAt = DateTimeField(required=True)
     currentTrophies = IntField(required=True)
+    # the last SCORE_BATCHES_KEPT batches of trophies updates applied to the member as 'writer id:batch number', so
+    # a retried batch isn't applied twice. It's internal to the writes and isn't loaded by the raw reads
+    score_batches = ListField(StringField())
+    # sequence number of the last absolute trophies value, older values are ignored
+    score_seq = LongField(required=False)
 
     def as_dict(self):
         # noinspection PyTypeChecker
@@ -41,6 +59,26 @@ class TourneyMemberED(EmbeddedDocument):
         }
 
 
+MEMBER_FIELDS = ('user_id', 'alias_id', 'name', 'tag', 'wallet_public_key')
+
+
+def _member_error(member) -> UserError:
+    if not isinstance(member, dict):
+        return InvalidDataError("Member %r is not an object" % (member,))
+    missing = [field for field in MEMBER_FIELDS if not member.get(field) or not isinstance(member[field], str)]
+    if missing:
+        return InvalidDataError("Member fields %s must be defined" % ', '.join(missing))
+    if not is_valid_address(member['wallet_public_key']):
+        return WalletAddressError("Wallet address %s is invalid" % member['wallet_public_key'])
+    return None
+
+
+def _new_member(member: dict, joined_at: datetime) -> dict:
+    """Returns the raw member document for the atomic push"""
+    return TourneyMemberED(joinedAt=joined_at, currentTrophies=randint(-60, 100),
+                           **{field: member[field] for field in MEMBER_FIELDS}).to_mongo()
+
+
 class TourneyStatus(Enum):
     NOT_PAYED_YET = 'not_payed_yet'
     PAYED = 'payed'
@@ -49,26 +87,82 @@ class TourneyStatus(Enum):
     PAYMENT_ERROR = 'payment_error'
 
 
+MEMBERS_ORDER = {'currentTrophies': -1}
+# requests of a single bulk write of migrations
+BULK_WRITE_SIZE = 1000
+# finished tourneys archived by a single bulk write
+ARCHIVE_CHUNK_SIZE = 100
+# a failed batch of trophies updates is retried before any newer batch of its writer, so a member has to remember
+# only the latest batches of the writers which may update it meanwhile
+SCORE_BATCHES_KEPT = 8
+# the same order of separate members, ties are ordered by joining
+SEPARATE_MEMBERS_ORDER = [('currentTrophies', -1), ('_id', 1)]
+
+JOINABLE_STATUSES = (TourneyStatus.NOT_PAYED_YET.value, TourneyStatus.PAYED.value)
+FINISHED_STATUSES = tuple(e.value for e in TourneyStatus if e.value not in JOINABLE_STATUSES)
+
+
 class Tourney(Document):
-    meta = {'collection': 'tourney'}
+    meta = {
+        'collection': 'tourney',
+        'indexes': [
+            # a status prefix serves the plain status lookups of the workers as well
+            ('status', 'endAt'),
+            ('status', '-id'),
+            # not payed tourneys by their next payment check
+            ('status', 'payment_check_due'),
+            # finished tourneys waiting for the archival
+            ('archived', 'status', 'endAt'),
+            {'fields': ['transaction_id'], 'unique': True},
+        ],
+        # indexes are created once on startup by ensure_indexes()
+        'auto_create_index': False,
+    }
     name = StringField(required=True)
     description = StringField(required=False)
     prize = FloatField(required=False)
     transaction_id = StringField(required=True)
     user_id = StringField(required=True)
+    # members are kept ordered by currentTrophies descending, so the list is the leaderboard. Trophies updates leave
+    # them unsorted for a moment, so the loaded ones are sorted again and the prizes are taken from a sorted query
     members = EmbeddedDocumentListField(document_type=TourneyMemberED)
+    members_count = IntField(required=False)
+    # members are kept in the tourney_member collection instead, `members` holds only the loaded ones
+    separate_members = BooleanField(required=False)
     status = StringField(required=True, choices=[e.value for e in TourneyStatus])
     startAt = DateTimeField(required=True)
     endAt = DateTimeField(required=True)
     payed = DateTimeField(required=False)
+    # when the payment of the not payed tourney is checked next, the longest waiting ones are checked first
+    payment_check_due = DateTimeField(required=False)
     ended = DateTimeField(required=False)
     prize_sent = FloatField(required=False)
     prize_sending_log = StringField(required=False)
+    # hashes of all transactions built to send the prizes, at most one of them can be applied
+    payout_tx_hashes = ListField(StringField())
+    # address of the channel account which is the source of the prizes transactions
+    payout_channel = StringField(required=False)
+    # the last signed prizes transaction and its sequence number, it's submitted again until the sequence is taken
+    payout_envelope = StringField(required=False)
+    payout_sequence = LongField(required=False)
+    # how many times sending the prizes was started, counted before every attempt
+    payout_attempts = IntField(required=False)
     error_message = StringField(required=False)
     fund_address = StringField(required=False)
     last_modified = DateTimeField(required=True)
+    # incremented by every change of the served fields, caches and ETags are keyed by it rather than last_modified,
+    # which doesn't tell apart changes within a millisecond
+    version = IntField(required=False)
+    # the transactions worker which exclusively processes the tourney till lease_expires
+    lease_owner = StringField(required=False)
+    lease_expires = DateTimeField(required=False)
+    # when the tourney was copied to the history and reduced to its summary
+    archived = DateTimeField(required=False)
 
-    def as_dict(self):
+    def as_dict(self, members_limit=None):
+        members = sort_members(self.members)
+        if members_limit is not None:
+            members = members[:members_limit]
         # noinspection PyTypeChecker
         return {
             '_id': self.id,
@@ -77,8 +171,9 @@ class Tourney(Document):
             'prize': self.prize,
             'transaction_id': self.transaction_id,
             'user_id': self.user_id,
-            'members': [m.as_dict() for m in sorted(self.members, key=lambda m: m.currentTrophies, reverse=True)],
-            'members_count': len(self.members),
+            'members': [m.as_dict() for m in members],
+            # tourneys created before members_count was introduced are always loaded with full members
+            'members_count': self.members_count if self.members_count is not None else len(self.members),
             'status': self.status,
             'last_modified': self.last_modified,
             'link': TOURNEY_URL % self.id,
@@ -89,42 +184,777 @@ class Tourney(Document):
             'prize_sent': self.prize_sent,
             'prize_sending_log': self.prize_sending_log,
             'error_message': self.error_message,
+            'archived': self.archived,
         }
 
-    def join(self, member: dict):
-        if self.status not in (TourneyStatus.NOT_PAYED_YET.value, TourneyStatus.PAYED.value):
-            raise TourneyNotJoinableError("Tourney is not joinable (status %s)" % self.status)
-
+    @classmethod
+    def join(cls, tourney_id, member: dict, members_limit=None):
+        """Atomically adds the member to the joinable tourney and returns the updated tourney"""
         if not is_valid_address(member['wallet_public_key']):
             raise WalletAddressError("Wallet address %s is invalid" % member['wallet_public_key'])
-        # noinspection PyTypeChecker
-        for m in self.members:
-            if member['user_id'] == m.user_id:
-                raise UserAlreadyJoinedError("User %s is already joined to tourney %s" % (member['user_id'], self.id))
-            if member['wallet_public_key'] == m.wallet_public_key:
-                raise UserAlreadyJoinedError("User with wallet %s is already joined to tourney %s" % (
-                    member['wallet_public_key'], self.id))
-        member['joinedAt'] = datetime.utcnow()
-        member['currentTrophies'] = randint(-60, 100)
-        # noinspection PyUnresolvedReferences
-        self.members.create(**member)
-        self.save()
+        # the storage of the tourney is read first only when new tourneys are likely to have separate members
+        status, separate, counted = cls._join_state(tourney_id) if MEMBERS_SEPARATE else (None, False, True)
+        while True:
+            if separate:
+                tourney, errors = cls._join_separate(tourney_id, status, [member], members_limit)
+                if errors[0] is not None:
+                    raise errors[0]
+                return tourney
+            if not counted:
+                cls._init_members_count(tourney_id)
+            joined_at = clock.utcnow()
+            # pre_save isn't called for the atomic update, so last_modified is set explicitly
+            tourney = limit_members(cls.objects(
+                id=tourney_id,
+                status__in=JOINABLE_STATUSES,
+                separate_members__ne=True,
+                members_count__ne=None,
+                members__user_id__ne=member['user_id'],
+                members__wallet_public_key__ne=member['wallet_public_key'],
+            ), members_limit).modify(
+                __raw__={
+                    '$push': {'members': {'$each': [_new_member(member, joined_at)], '$sort': MEMBERS_ORDER}},
+                    '$inc': {'members_count': 1, 'version': 1},
+                },
+                set__last_modified=joined_at,
+                new=True
+            )
+            if tourney is not None:
+                return tourney
+            status, separate, counted = cls._join_state(tourney_id)
+            if not separate and counted:
+                raise cls._join_error(tourney_id, member)
+
+    @classmethod
+    def _join_state(cls, tourney_id) -> tuple:
+        """Returns the status of the tourney, whether it has separate members and whether it has members_count"""
+        # noinspection PyProtectedMember
+        doc = cls._get_collection().find_one({'_id': ObjectId(tourney_id)},
+                                             {'status': 1, 'separate_members': 1, 'members_count': 1})
+        if doc is None:
+            raise cls.DoesNotExist('Tourney matching query does not exist.')
+        return doc['status'], bool(doc.get('separate_members')), doc.get('members_count') is not None
+
+    @classmethod
+    def _join_error(cls, tourney_id, member: dict):
+        tourney = cls.objects(id=tourney_id).only('status').get()
+        if tourney.status not in JOINABLE_STATUSES:
+            return TourneyNotJoinableError("Tourney is not joinable (status %s)" % tourney.status)
+        if cls.objects(id=tourney_id, members__user_id=member['user_id']).only('id').first() is not None:
+            return UserAlreadyJoinedError("User %s is already joined to tourney %s" % (member['user_id'], tourney_id))
+        return UserAlreadyJoinedError("User with wallet %s is already joined to tourney %s" % (
+            member['wallet_public_key'], tourney_id))
+
+    @classmethod
+    def join_many(cls, tourney_id, members: list, members_limit=None):
+        """Atomically adds all valid members to the joinable tourney in a single update.
+        Returns the updated tourney and a list with None for every added member or the UserError it was rejected with
+        """
+        errors = [_member_error(member) for member in members]
+        user_ids, wallets = set(), set()
+        for i, member in enumerate(members):
+            if errors[i] is not None:
+                continue
+            if member['user_id'] in user_ids or member['wallet_public_key'] in wallets:
+                errors[i] = UserAlreadyJoinedError("User %s with wallet %s is given more than once" % (
+                    member['user_id'], member['wallet_public_key']))
+                continue
+            user_ids.add(member['user_id'])
+            wallets.add(member['wallet_public_key'])
+
+        pending = [i for i, error in enumerate(errors) if error is None]
+        while pending:
+            status, separate, counted, joined_user_ids, joined_wallets = cls._find_joined(tourney_id, user_ids, wallets)
+            if separate:
+                tourney, joined_errors = cls._join_separate(tourney_id, status, [members[i] for i in pending],
+                                                            members_limit)
+                for i, error in zip(pending, joined_errors):
+                    errors[i] = error
+                return tourney, errors
+            if not counted:
+                cls._init_members_count(tourney_id)
+            for i in pending:
+                if status not in JOINABLE_STATUSES:
+                    errors[i] = TourneyNotJoinableError("Tourney is not joinable (status %s)" % status)
+                elif members[i]['user_id'] in joined_user_ids:
+                    errors[i] = UserAlreadyJoinedError("User %s is already joined to tourney %s" % (
+                        members[i]['user_id'], tourney_id))
+                elif members[i]['wallet_public_key'] in joined_wallets:
+                    errors[i] = UserAlreadyJoinedError("User with wallet %s is already joined to tourney %s" % (
+                        members[i]['wallet_public_key'], tourney_id))
+            pending = [i for i in pending if errors[i] is None]
+            if not pending:
+                break
+            user_ids = {members[i]['user_id'] for i in pending}
+            wallets = {members[i]['wallet_public_key'] for i in pending}
+            joined_at = clock.utcnow()
+            tourney = limit_members(cls.objects(
+                id=tourney_id,
+                status__in=JOINABLE_STATUSES,
+                separate_members__ne=True,
+                members_count__ne=None,
+                members__user_id__nin=list(user_ids),
+                members__wallet_public_key__nin=list(wallets),
+            ), members_limit).modify(
+                __raw__={
+                    '$push': {'members': {'$each': [_new_member(members[i], joined_at) for i in pending],
+                                          '$sort': MEMBERS_ORDER}},
+                    '$inc': {'members_count': len(pending), 'version': 1},
+                },
+                set__last_modified=joined_at,
+                new=True
+            )
+            if tourney is not None:
+                return tourney, errors
+            # the tourney was changed since _find_joined by a concurrent join or the workers, so check it again
+        return load_members(limit_members(cls.objects(id=tourney_id), members_limit).get(), members_limit), errors
+
+    @classmethod
+    def _init_members_count(cls, tourney_id):
+        """Counts the members of a tourney joined before members_count was kept, so joins can increment it.
+        Every join initialises the count before it adds members, so they are never counted twice
+        """
+        # noinspection PyProtectedMember
+        collection = cls._get_collection()
+        docs = list(collection.aggregate([
+            {'$match': {'_id': ObjectId(tourney_id), 'members_count': None}},
+            {'$project': {'count': {'$size': {'$ifNull': ['$members', []]}}}},
+        ]))
+        if docs:
+            collection.update_one({'_id': docs[0]['_id'], 'members_count': None},
+                                  {'$set': {'members_count': docs[0]['count']}})
+
+    @classmethod
+    def _join_separate(cls, tourney_id, status: str, members: list, members_limit=None):
+        """Adds valid members to the tourney with separate members if its `status` is joinable. Duplicates are rejected
+        by the unique indexes of the members collection, so the tourney document is only counted and never rewritten.
+        Returns the updated tourney and a list with None for every added member or the UserError it was rejected with
+        """
+        if status not in JOINABLE_STATUSES:
+            error = TourneyNotJoinableError("Tourney is not joinable (status %s)" % status)
+            return load_members(limit_members(cls.objects(id=tourney_id), members_limit).get(), members_limit), \
+                [error] * len(members)
+        joined_at = clock.utcnow()
+        docs = [dict(_new_member(member, joined_at), tourney=ObjectId(tourney_id)) for member in members]
+        errors = [None] * len(members)
+        try:
+            # noinspection PyProtectedMember
+            TourneyMember._get_collection().insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                i, member = error['index'], members[error['index']]
+                if error['code'] != 11000:
+                    errors[i] = InvalidDataError("User %s isn't joined: %s" % (member['user_id'], error['errmsg']))
+                elif 'wallet_public_key' in error['errmsg']:
+                    errors[i] = UserAlreadyJoinedError("User with wallet %s is already joined to tourney %s" % (
+                        member['wallet_public_key'], tourney_id))
+                else:
+                    errors[i] = UserAlreadyJoinedError("User %s is already joined to tourney %s" % (
+                        member['user_id'], tourney_id))
+        inserted = [i for i, error in enumerate(errors) if error is None]
+        tourney = None
+        if inserted:
+            # pre_save isn't called for the atomic update, so last_modified is set explicitly
+            tourney = limit_members(cls.objects(id=tourney_id, status__in=JOINABLE_STATUSES), members_limit).modify(
+                inc__members_count=len(inserted),
+                inc__version=1,
+                set__last_modified=joined_at,
+                new=True
+            )
+        if tourney is None:
+            tourney = limit_members(cls.objects(id=tourney_id), members_limit).get()
+        if inserted and tourney.status not in JOINABLE_STATUSES:
+            # the tourney finished after its status was read
+            # noinspection PyProtectedMember
+            TourneyMember._get_collection().delete_many({'_id': {'$in': [docs[i]['_id'] for i in inserted]}})
+            cls.objects(id=tourney_id).update_one(inc__version=1)
+            for i in inserted:
+                errors[i] = TourneyNotJoinableError("Tourney is not joinable (status %s)" % tourney.status)
+        return load_members(tourney, members_limit), errors
+
+    @classmethod
+    def _find_joined(cls, tourney_id, user_ids: set, wallets: set):
+        """Returns the status of the tourney, whether it has separate members, whether it has members_count, and user
+        ids and wallets of its embedded members which are among the given
+        """
+        # noinspection PyProtectedMember
+        docs = list(cls._get_collection().aggregate([
+            {'$match': {'_id': ObjectId(tourney_id)}},
+            {'$project': {'status': 1, 'separate_members': 1, 'members_count': 1, 'members': {'$filter': {
+                'input': '$members',
+                'as': 'm',
+                'cond': {'$or': [{'$in': ['$$m.user_id', list(user_ids)]},
+                                 {'$in': ['$$m.wallet_public_key', list(wallets)]}]}
+            }}}},
+        ]))
+        if not docs:
+            raise cls.DoesNotExist('Tourney matching query does not exist.')
+        members = docs[0].get('members') or []
+        return docs[0]['status'], bool(docs[0].get('separate_members')), docs[0].get('members_count') is not None, \
+            {m['user_id'] for m in members}, {m['wallet_public_key'] for m in members}
+
+    @classmethod
+    def apply_scores(cls, updates: dict, writer_id: str, batch: int):
+        """Applies trophies of members by {(tourney id, user id): [absolute value or None, delta, sequence number or
+        None]} in bulk writes. The updates are the `batch` of the `writer_id` buffer, and a member skips a batch
+        which it has already got, so a failed batch can be applied again. An absolute value is ignored when the member
+        got one with a greater or equal sequence number.
+        Only running tourneys are updated and their members are sorted again afterwards, even if some updates failed,
+        separate members are updated in their collection which is always sorted by its index
+        """
+        now = clock.utcnow()
+        tourney_ids = {tourney_id for tourney_id, user_id in updates}
+        # noinspection PyProtectedMember
+        separate = {doc['_id'] for doc in cls._get_collection().find({
+            '_id': {'$in': list(tourney_ids)}, 'status': {'$in': JOINABLE_STATUSES}, 'separate_members': True,
+        }, {'_id': 1})}
+        requests = []
+        member_requests = []
+        token = '%s:%d' % (writer_id, batch)
+        for (tourney_id, user_id), (value, delta, seq) in updates.items():
+            member = {'user_id': user_id, 'score_batches': {'$ne': token}}
+            update = {'$push': {'score_batches': {'$each': [token], '$slice': -SCORE_BATCHES_KEPT}}}
+            if value is not None:
+                update['$set'] = {'currentTrophies': value + delta}
+                if seq is not None:
+                    member['score_seq'] = {'$not': {'$gte': seq}}
+                    update['$set']['score_seq'] = seq
+            else:
+                update['$inc'] = {'currentTrophies': delta}
+            if tourney_id in separate:
+                member_requests.append(UpdateOne(dict(member, tourney=tourney_id), update))
+            else:
+                # the positional operator updates the member matched by $elemMatch
+                requests.append(UpdateOne(
+                    {'_id': tourney_id, 'status': {'$in': JOINABLE_STATUSES}, 'members': {'$elemMatch': member}},
+                    {operator: {'members.$.' + field: v for field, v in fields.items()}
+                     for operator, fields in update.items()}
+                ))
+        rejected = None
+        try:
+            # noinspection PyProtectedMember
+            for collection, bulk in ((TourneyMember._get_collection(), member_requests),
+                                     (cls._get_collection(), requests)):
+                if not bulk:
+                    continue
+                try:
+                    collection.bulk_write(bulk, ordered=False)
+                except BulkWriteError as e:
+                    # updates of the other collection are applied anyway
+                    rejected = rejected or e
+        finally:
+            # pushing nothing with $sort reorders the members, it's done after all updates which were applied.
+            # A join in between sorts them too, so readers see unsorted members only for a moment
+            requests = []
+            for tourney_id in tourney_ids:
+                update = {'$set': {'last_modified': now}, '$inc': {'version': 1}}
+                if tourney_id not in separate:
+                    update['$push'] = {'members': {'$each': [], '$sort': MEMBERS_ORDER}}
+                requests.append(UpdateOne({'_id': tourney_id, 'status': {'$in': JOINABLE_STATUSES}}, update))
+            # noinspection PyProtectedMember
+            cls._get_collection().bulk_write(requests, ordered=False)
+        if rejected is not None:
+            raise rejected
+
+    @staticmethod
+    def not_leased(worker_id=None) -> Q:
+        """Query of the tourneys which aren't leased, or are leased by `worker_id`"""
+        query = Q(lease_expires=None) | Q(lease_expires__lte=clock.utcnow())
+        return query | Q(lease_owner=worker_id) if worker_id is not None else query
+
+    @classmethod
+    def claim(cls, worker_id, lease_seconds, members_limit=None, reclaim=True, **query):
+        """Atomically leases the tourney matching `query` to the worker for `lease_seconds` and returns it.
+        Returns None if there is no such tourney or it's leased by another worker, or by this one unless `reclaim`
+        """
+        # a lease is internal to the workers, so last_modified isn't changed
+        return load_members(limit_members(cls.objects(cls.not_leased(worker_id if reclaim else None), **query),
+                                          members_limit).modify(
+            set__lease_owner=worker_id,
+            set__lease_expires=clock.utcnow() + timedelta(seconds=lease_seconds),
+            new=True
+        ), members_limit)
+
+    @classmethod
+    def leaderboard(cls, tourney_id, offset=0, limit=LEADERBOARD_PAGE_SIZE):
+        """Returns the tourney with only `limit` members loaded, starting from the place `offset`"""
+        # until migrate() is done the stored members may be unsorted, so all of them are loaded and sorted here
+        page = [offset, limit] if _members_sorted else _ALL_MEMBERS
+        tourney = cls.objects(id=tourney_id).only(
+            'id', 'members_count', 'last_modified', 'archived', 'separate_members'
+        ).fields(slice__members=page).get()
+        if tourney.separate_members:
+            return load_members(tourney, limit, offset)
+        if tourney.archived is not None:
+            # the summary keeps only the leaders, the whole leaderboard is in the history
+            doc = tourney_history().find_one({'_id': tourney.id}, {'members': {'$slice': page}})
+            if doc is not None:
+                # noinspection PyProtectedMember
+                tourney.members = [TourneyMemberED._from_son(m) for m in doc.get('members') or []]
+        members = sort_members(tourney.members)
+        tourney.members = members if _members_sorted else members[offset:offset + limit]
+        return tourney
+
+    @classmethod
+    def archive(cls, ended_before: datetime, limit: int, members_kept: int) -> int:
+        """Copies up to `limit` finished tourneys which ended before `ended_before` to the history and reduces them
+        to summaries with `members_kept` leaders and without the payout details. Returns the number of archived ones.
+        Separate members are copied to their history and only the leaders stay in their collection
+        """
+        # noinspection PyProtectedMember
+        collection = cls._get_collection()
+        # the tourneys are read and archived by chunks, so a batch with big tourneys isn't held in memory
+        cursor = collection.find({
+            'archived': None, 'status': {'$in': FINISHED_STATUSES}, 'endAt': {'$lte': ended_before},
+        }).limit(limit).batch_size(ARCHIVE_CHUNK_SIZE)
+        archived = 0
+        docs = []
+        for doc in cursor:
+            docs.append(doc)
+            if len(docs) == ARCHIVE_CHUNK_SIZE:
+                cls._archive_docs(docs, members_kept)
+                archived += len(docs)
+                docs = []
+        if docs:
+            cls._archive_docs(docs, members_kept)
+            archived += len(docs)
+        return archived
+
+    @classmethod
+    def _archive_docs(cls, docs: list, members_kept: int):
+        now = clock.utcnow()
+        # a copy is replaced by a repeated archival, so an interrupted one is completed by the next run
+        tourney_history().bulk_write([ReplaceOne({'_id': doc['_id']}, dict(doc, archived=now), upsert=True)
+                                      for doc in docs], ordered=False)
+        for doc in docs:
+            if doc.get('separate_members'):
+                _archive_separate_members(doc['_id'], members_kept)
+        requests = []
+        for doc in docs:
+            members_count = doc.get('members_count')
+            requests.append(UpdateOne({'_id': doc['_id'], 'archived': None}, {
+                # pushing nothing with $sort and $slice keeps only the leaders
+                '$push': {'members': {'$each': [], '$sort': MEMBERS_ORDER, '$slice': members_kept}},
+                '$set': {
+                    'archived': now,
+                    'last_modified': now,
+                    'members_count': members_count if members_count is not None else len(doc.get('members') or []),
+                },
+                '$unset': {field: '' for field in _ARCHIVE_DROPPED_FIELDS},
+                '$inc': {'version': 1},
+            }))
+        # noinspection PyProtectedMember
+        cls._get_collection().bulk_write(requests, ordered=False)
+
+    @classmethod
+    def page(cls, statuses=None, cursor=None, limit=TOURNEYS_PAGE_SIZE, fields=None):
+        """Returns up to `limit` tourneys newest first, starting after the `cursor` id"""
+        query = cls.objects()
+        if fields:
+            query = query.only(*fields)
+        if statuses:
+            query = query.filter(status__in=statuses)
+        if cursor:
+            query = query.filter(id__lt=cursor)
+        return list(query.order_by('-id').limit(limit))
+
+    @classmethod
+    def _new(cls, name, description, prize, transaction_id, user_id):
+        start_at = clock.utcnow()
+        return Tourney(
+            name=name, description=description, prize=prize, transaction_id=transaction_id, user_id=user_id,
+            startAt=start_at, endAt=start_at + timedelta(seconds=TOURNEY_LENGTH),
+            status=TourneyStatus.NOT_PAYED_YET.value, payment_check_due=start_at, members_count=0,
+            separate_members=MEMBERS_SEPARATE, last_modified=start_at, version=0
+        )
 
     @classmethod
     def create(cls, name, description, prize, transaction_id, user_id):
         if not is_valid_transaction_hash(transaction_id):
             raise TransactionHashError("Transaction hash %s is invalid" % transaction_id)
-        if len(Tourney.objects(transaction_id=transaction_id)) > 0:
+        if Tourney.objects(transaction_id=transaction_id).only('id').first() is not None:
             raise TourneyTransactionDuplicatedError("Tourney for transaction %s is already created" % transaction_id)
 
-        start_at = datetime.utcnow()
-        tourney = Tourney(
-            name=name, description=description, prize=prize, transaction_id=transaction_id, user_id=user_id,
-            startAt=start_at, endAt=start_at + timedelta(seconds=TOURNEY_LENGTH),
-            status=TourneyStatus.NOT_PAYED_YET.value
-        )
-        tourney.save()
+        tourney = cls._new(name, description, prize, transaction_id, user_id)
+        try:
+            tourney.save()
+        except NotUniqueError:
+            raise TourneyTransactionDuplicatedError("Tourney for transaction %s is already created" % transaction_id)
         return tourney
 
+    @classmethod
+    def create_many(cls, tourneys: list) -> list:
+        """Creates tourneys with a single query for duplicated transactions and a single batch insert.
+        Returns a list with the created tourney or the UserError it was rejected with for every item of `tourneys`
+        """
+        results = []
+        transaction_ids = set()
+        for data in tourneys:
+            if not isinstance(data, dict):
+                results.append(InvalidDataError("Tourney %r is not an object" % (data,)))
+                continue
+            transaction_id = data.get('transaction_id')
+            if not isinstance(transaction_id, str) or not is_valid_transaction_hash(transaction_id):
+                results.append(TransactionHashError("Transaction hash %s is invalid" % transaction_id))
+                continue
+            if transaction_id in transaction_ids:
+                results.append(TourneyTransactionDuplicatedError(
+                    "Tourney for transaction %s is given more than once" % transaction_id))
+                continue
+            tourney = cls._new(data.get('name'), data.get('description'), data.get('prize'), transaction_id,
+                               data.get('user_id'))
+            try:
+                tourney.validate()
+            except ValidationError as e:
+                results.append(InvalidDataError("Tourney for transaction %s is invalid: %s" % (transaction_id, e)))
+                continue
+            transaction_ids.add(transaction_id)
+            results.append(tourney)
+
+        existing = {t.transaction_id for t in cls.objects(transaction_id__in=list(transaction_ids)).only(
+            'transaction_id')}
+        for i, tourney in enumerate(results):
+            if isinstance(tourney, cls) and tourney.transaction_id in existing:
+                results[i] = TourneyTransactionDuplicatedError(
+                    "Tourney for transaction %s is already created" % tourney.transaction_id)
+
+        created = [(i, tourney, tourney.to_mongo()) for i, tourney in enumerate(results) if isinstance(tourney, cls)]
+        if not created:
+            return results
+        failed = {}
+        try:
+            # pre_save isn't called for the batch insert, last_modified is set by _new()
+            # noinspection PyProtectedMember
+            cls._get_collection().insert_many([doc for i, tourney, doc in created], ordered=False)
+        except BulkWriteError as e:
+            failed = {error['index']: error for error in e.details['writeErrors']}
+        for index, (i, tourney, doc) in enumerate(created):
+            if index not in failed:
+                tourney.id = doc['_id']
+            elif failed[index]['code'] == 11000:
+                results[i] = TourneyTransactionDuplicatedError(
+                    "Tourney for transaction %s is already created" % tourney.transaction_id)
+            else:
+                results[i] = InvalidDataError("Tourney for transaction %s isn't created: %s" % (
+                    tourney.transaction_id, failed[index]['errmsg']))
+        return results
+
+
+class TourneyMember(Document):
+    """A member of a tourney with separate members"""
+    meta = {
+        'collection': 'tourney_member',
+        'indexes': [
+            {'fields': ['tourney', 'user_id'], 'unique': True},
+            {'fields': ['tourney', 'wallet_public_key'], 'unique': True},
+            # the leaderboard, in SEPARATE_MEMBERS_ORDER
+            ('tourney', '-currentTrophies', 'id'),
+        ],
+        'auto_create_index': False,
+    }
+    tourney = ObjectIdField(required=True)
+    user_id = StringField(required=True)
+    alias_id = StringField(required=True)
+    name = StringField(required=True)
+    tag = StringField(required=True)
+    wallet_public_key = StringField(required=True)
+    joinedAt = DateTimeField(required=True)
+    currentTrophies = IntField(required=True)
+    score_batches = ListField(StringField())
+    score_seq = LongField(required=False)
+
+    as_dict = TourneyMemberED.as_dict
+
+
+class LedgerTransaction(Document):
+    """A confirmed transaction, which never changes, with the operations the workers read"""
+    meta = {'collection': 'ledger_transaction'}
+    hash = StringField(primary_key=True)
+    operations = ListField(DictField())
+    last_modified = DateTimeField(required=True)
+
+
+class Migration(Document):
+    """A one-off data migration which is done, see migrate()"""
+    meta = {'collection': 'migration'}
+    name = StringField(primary_key=True)
+    applied = DateTimeField(required=True)
+
+
+class StreamCursor(Document):
+    """The last processed paging token of a Horizon stream, so a restarted stream resumes from it"""
+    meta = {'collection': 'stream_cursor'}
+    name = StringField(primary_key=True)
+    cursor = StringField(required=True)
+    last_modified = DateTimeField(required=True)
+
+    @classmethod
+    def load(cls, name):
+        stream_cursor = cls.objects(name=name).first()
+        return stream_cursor.cursor if stream_cursor is not None else None
+
+    @classmethod
+    def store(cls, name, cursor):
+        cls.objects(name=name).update_one(set__cursor=cursor, set__last_modified=clock.utcnow(), upsert=True)
+
+
+class PayoutChannel(Document):
+    """The lease of a channel account of payouts, so all workers sharing the channel submit one transaction at a time"""
+    meta = {'collection': 'payout_channel'}
+    address = StringField(primary_key=True)
+    lease_owner = StringField(required=False)
+    lease_expires = DateTimeField(required=False)
+
+    @classmethod
+    def claim(cls, address, owner, lease_seconds) -> bool:
+        """Atomically leases the channel to `owner` for `lease_seconds`, returns False if another owner holds it"""
+        now = clock.utcnow()
+        try:
+            # the upsert of a leased channel conflicts with its document instead of matching it
+            # noinspection PyProtectedMember
+            cls._get_collection().update_one(
+                {'_id': address, '$or': [{'lease_expires': None}, {'lease_expires': {'$lte': now}}]},
+                {'$set': {'lease_owner': owner, 'lease_expires': now + timedelta(seconds=lease_seconds)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    @classmethod
+    def release(cls, address, owner):
+        # noinspection PyProtectedMember
+        cls._get_collection().update_one({'_id': address, 'lease_owner': owner},
+                                         {'$unset': {'lease_owner': '', 'lease_expires': ''}})
+
 
 signals.pre_save.connect(_set_last_modified, sender=Tourney)
+signals.post_save.connect(_inc_version, sender=Tourney)
+
+
+# fields of a tourney which are kept only in its history copy
+_ARCHIVE_DROPPED_FIELDS = ('prize_sending_log', 'payment_check_due', 'payout_tx_hashes', 'payout_channel',
+                           'payout_envelope', 'payout_sequence', 'payout_attempts', 'fund_address', 'lease_owner',
+                           'lease_expires')
+
+
+def tourney_history():
+    """The collection of full copies of archived tourneys"""
+    # noinspection PyProtectedMember
+    return Tourney._get_db()['tourney_history']
+
+
+def tourney_member_history():
+    """The collection of all separate members of archived tourneys"""
+    # noinspection PyProtectedMember
+    return Tourney._get_db()['tourney_member_history']
+
+
+def _archive_separate_members(tourney_id, members_kept: int):
+    """Copies the separate members of the tourney to the history, then deletes all of them but the leaders.
+    A copy is replaced by a repeated archival, and the deleted members are already in the history
+    """
+    # noinspection PyProtectedMember
+    collection = TourneyMember._get_collection()
+    requests = []
+    for doc in collection.find({'tourney': tourney_id}):
+        requests.append(ReplaceOne({'_id': doc['_id']}, doc, upsert=True))
+        if len(requests) == BULK_WRITE_SIZE:
+            tourney_member_history().bulk_write(requests, ordered=False)
+            requests = []
+    if requests:
+        tourney_member_history().bulk_write(requests, ordered=False)
+    leaders = [doc['_id'] for doc in collection.find({'tourney': tourney_id}, {'_id': 1}).sort(
+        SEPARATE_MEMBERS_ORDER).limit(members_kept)] if members_kept else []
+    collection.delete_many({'tourney': tourney_id, '_id': {'$nin': leaders}})
+
+
+# $slice of all members
+_ALL_MEMBERS = 2 ** 31 - 1
+
+# whether the embedded members of all tourneys are stored sorted. Members joined before they were kept sorted are
+# sorted once by migrate() on startup, until then they are loaded whole and ordered by sort_members(). Trophies
+# updates leave them unsorted for a moment till they are sorted again, so the loaded members are sorted anyway
+_members_sorted = False
+
+MEMBERS_SORTED_MIGRATION = 'members_sorted'
+
+
+def sort_members(members: list) -> list:
+    """Returns the loaded members, documents or raw ones, in MEMBERS_ORDER"""
+    # the sort is stable, so members with the same trophies keep the stored order, and it's linear for sorted ones
+    return sorted(members, key=lambda m: m['currentTrophies'], reverse=True)
+
+
+def limit_members(query, members_limit=None):
+    """Loads only `members_limit` leaders of the tourneys, all members if `members_limit` is None.
+    The leaders are cut by sort_members() and a slice of the result until migrate() is done
+    """
+    if members_limit is None:
+        return query
+    return query.fields(slice__members=members_limit if _members_sorted else _ALL_MEMBERS)
+
+
+# fields of separate members which aren't loaded as TourneyMemberED
+_RAW_MEMBER_PROJECTION = {'_id': 0, 'tourney': 0, 'score_batches': 0, 'score_seq': 0}
+
+
+def raw_members(tourney_id, limit=None, offset=0, archived=False) -> list:
+    """Returns raw documents of `limit` leaders of the tourney with separate members starting from the place `offset`,
+    all of them if `limit` is None. Members of an `archived` tourney are read from their history
+    """
+    if limit == 0:
+        return []
+    # noinspection PyProtectedMember
+    collection = tourney_member_history() if archived else TourneyMember._get_collection()
+    cursor = collection.find({'tourney': tourney_id}, _RAW_MEMBER_PROJECTION).sort(
+        SEPARATE_MEMBERS_ORDER).skip(offset)
+    return list(cursor.limit(limit) if limit is not None else cursor)
+
+
+def load_members(tourney, members_limit=None, offset=0):
+    """Loads the members of the tourney with separate members the same as limit_members() does. Returns the tourney"""
+    if tourney is not None and tourney.separate_members:
+        # noinspection PyProtectedMember
+        tourney.members = [TourneyMemberED._from_son(m)
+                           for m in raw_members(tourney.id, members_limit, offset, tourney.archived is not None)]
+        # the loaded members are never saved into the tourney document
+        # noinspection PyProtectedMember
+        tourney._clear_changed_fields()
+    return tourney
+
+
+def load_leaders(tourney, count: int) -> list:
+    """Returns `count` leaders of the tourney in MEMBERS_ORDER with ties ordered by joining. They are sorted by the
+    query rather than taken from the stored order like limit_members() does, so the prizes never depend on it
+    """
+    if tourney.separate_members:
+        docs = raw_members(tourney.id, count, archived=tourney.archived is not None)
+    else:
+        # noinspection PyProtectedMember
+        collection = tourney_history() if tourney.archived is not None else Tourney._get_collection()
+        docs = [doc['members'] for doc in collection.aggregate([
+            {'$match': {'_id': tourney.id}},
+            {'$unwind': '$members'},
+            {'$sort': {'members.currentTrophies': -1, 'members.joinedAt': 1}},
+            {'$limit': count},
+            {'$project': {'_id': 0, 'members.score_batches': 0, 'members.score_seq': 0}},
+        ])]
+    # noinspection PyProtectedMember
+    return [TourneyMemberED._from_son(doc) for doc in docs]
+
+
+# Tourney.as_dict() keys by the db fields, grouped by their conversion
+_RAW_TOURNEY_FIELDS = (
+    ('name', 'title'), ('description', 'description'), ('transaction_id', 'transaction_id'), ('user_id', 'user_id'),
+    ('status', 'status'), ('prize_sending_log', 'prize_sending_log'), ('error_message', 'error_message'),
+)
+_RAW_TOURNEY_FLOAT_FIELDS = (('prize', 'prize'), ('prize_sent', 'prize_sent'))
+_RAW_TOURNEY_DATETIME_FIELDS = (
+    ('last_modified', 'last_modified'), ('startAt', 'startAt'), ('endAt', 'endAt'), ('payed', 'payed'),
+    ('ended', 'ended'), ('archived', 'archived'),
+)
+_RAW_TOURNEY_PROJECTION = {field: 1 for fields in (_RAW_TOURNEY_FIELDS, _RAW_TOURNEY_FLOAT_FIELDS,
+                                                   _RAW_TOURNEY_DATETIME_FIELDS)
+                           for field, key in fields}
+_RAW_TOURNEY_PROJECTION.update(members=1, members_count=1, separate_members=1, version=1)
+
+
+def raw_tourneys(ids, members_limit=None):
+    """Returns raw documents of the tourneys with only the fields of Tourney.as_dict()"""
+    projection = dict(_RAW_TOURNEY_PROJECTION)
+    if members_limit is not None and _members_sorted:
+        projection['members'] = {'$slice': members_limit}
+    # noinspection PyProtectedMember
+    docs = list(Tourney._get_collection().find({'_id': {'$in': list(ids)}}, projection))
+    for doc in docs:
+        if doc.get('separate_members'):
+            doc['members'] = raw_members(doc['_id'], members_limit, archived=doc.get('archived') is not None)
+    return docs
+
+
+def raw_tourney_as_dict(doc: dict, members_limit=None) -> dict:
+    """The same as Tourney.as_dict() made of a raw document without its hydration.
+    ObjectIds and datetimes are already converted to strings of misc.myjson, so it's serialized by dumps_plain()
+    """
+    get = doc.get
+    tid = str(doc['_id'])
+    members = sort_members(get('members') or [])
+    # tourneys created before members_count was introduced are always loaded with full members
+    members_count = get('members_count')
+    if members_count is None:
+        members_count = len(members)
+    if members_limit is not None:
+        members = members[:members_limit]
+    result = {key: get(field) for field, key in _RAW_TOURNEY_FIELDS}
+    for field, key in _RAW_TOURNEY_FLOAT_FIELDS:
+        value = get(field)
+        result[key] = float(value) if value is not None else None
+    for field, key in _RAW_TOURNEY_DATETIME_FIELDS:
+        value = get(field)
+        result[key] = format_datetime(value) if value is not None else None
+    result['_id'] = tid
+    result['link'] = TOURNEY_URL % tid
+    result['members_count'] = members_count
+    result['members'] = [
+        {
+            'user_id': m.get('user_id'),
+            'cpUserId': m.get('user_id'),
+            'name': m.get('name'),
+            'tag': m.get('tag'),
+            'startTrophies': 0,
+            'currentTrophies': m.get('currentTrophies'),
+            'alias_id': m.get('alias_id'),
+            'wallet_public_key': m.get('wallet_public_key')
+        } for m in members
+    ]
+    return result
+
+
+def connect_db(host=MONGODB_URI):
+    """Registers the pooled MongoDB client of this process, it connects on the first query"""
+    metrics.register_mongo_listener()
+    return connect(host=host, maxPoolSize=MONGODB_POOL_SIZE, serverSelectionTimeoutMS=MONGODB_SERVER_TIMEOUT * 1000,
+                   connect=False)
+
+
+def ensure_indexes():
+    Tourney.ensure_indexes()
+    TourneyMember.ensure_indexes()
+    # the leaderboards of archived tourneys, in SEPARATE_MEMBERS_ORDER
+    tourney_member_history().create_index([('tourney', 1), ('currentTrophies', -1), ('_id', 1)])
+
+
+def migrate():
+    """Does the data migrations which aren't done yet, once on startup after ensure_indexes()"""
+    global _members_sorted
+    if Migration.objects(name=MEMBERS_SORTED_MIGRATION).first() is None:
+        _sort_stored_members()
+        Migration(name=MEMBERS_SORTED_MIGRATION, applied=clock.utcnow()).save()
+    _members_sorted = True
+
+
+def load_migrations():
+    """Learns which data migrations are done by another process, so the data is read as migrated only after them"""
+    global _members_sorted
+    _members_sorted = Migration.objects(name=MEMBERS_SORTED_MIGRATION).first() is not None
+
+
+def _sort_stored_members():
+    """Sorts the members of tourneys joined before they were kept sorted and counts the ones without members_count.
+    Repeating it is harmless, so migrations interrupted or run by several processes at once are completed
+    """
+    # noinspection PyProtectedMember
+    for collection in (Tourney._get_collection(), tourney_history()):
+        # pushing nothing with $sort reorders the members
+        collection.update_many({'members.1': {'$exists': True}},
+                               {'$push': {'members': {'$each': [], '$sort': MEMBERS_ORDER}}, '$inc': {'version': 1}})
+        requests = [
+            UpdateOne({'_id': doc['_id'], 'members_count': None}, {'$set': {'members_count': doc['count']}})
+            for doc in collection.aggregate([
+                {'$match': {'members_count': None}},
+                {'$project': {'count': {'$size': {'$ifNull': ['$members', []]}}}},
+            ])
+        ]
+        for start in range(0, len(requests), BULK_WRITE_SIZE):
+            collection.bulk_write(requests[start:start + BULK_WRITE_SIZE], ordered=False)
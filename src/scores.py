@@ -0,0 +1,103 @@
+import atexit
+import logging
+import os
+import threading
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+from config import SCORES_FLUSH_INTERVAL, SCORES_FLUSH_SIZE
+from schema import Tourney
+
+
+class ScoreBuffer(object):
+    """Merges trophies updates of tourney members in memory and flushes them to MongoDB with bulk writes.
+
+    An update either sets the absolute value or adds a delta. An absolute value may have a sequence number given by
+    the client, a value with a lower number than the merged one is stale and ignored. The merged updates are flushed
+    every `flush_interval` seconds, or as soon as `flush_size` members are updated, by a background thread started on
+    the first update. Flushed updates are a numbered batch of the process, a failed batch is retried as is before any
+    newer updates, and MongoDB skips the members which have already got it, so no delta is applied twice.
+    """
+
+    def __init__(self, flush_interval, flush_size):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        # (tourney id, user id) -> [absolute value or None, delta, sequence number of the value or None]
+        self._updates = {}
+        self._lock = threading.Lock()
+        self._flush_needed = threading.Event()
+        self._thread = None
+        # the batch which wasn't surely applied, (number, updates)
+        self._failed = None
+        self._flush_lock = threading.Lock()
+        # forked processes get their own writer id, see _next_batch()
+        self._pid = None
+        self._writer_id = None
+        self._batches = 0
+
+    def add(self, tourney_id: ObjectId, user_id: str, value=None, delta=0, seq=None):
+        with self._lock:
+            self._merge((tourney_id, user_id), value, delta, seq)
+            if len(self._updates) >= self.flush_size:
+                self._flush_needed.set()
+            if self._thread is None:
+                # started lazily, so every forked web worker has its own flusher
+                self._thread = threading.Thread(target=self._run, name='ScoreBuffer')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _merge(self, key, value, delta, seq):
+        update = self._updates.get(key)
+        if value is not None:
+            if update is None or seq is None or update[2] is None or update[2] < seq:
+                self._updates[key] = [value, delta, seq]
+        elif update is None:
+            self._updates[key] = [None, delta, None]
+        else:
+            update[1] += delta
+
+    def _next_batch(self) -> int:
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._writer_id = str(ObjectId())
+            self._batches = 0
+        self._batches += 1
+        return self._batches
+
+    def flush(self):
+        with self._flush_lock:
+            if self._failed is not None:
+                self._apply(*self._failed)
+            with self._lock:
+                updates, self._updates = self._updates, {}
+            if updates:
+                self._failed = (self._next_batch(), updates)
+                self._apply(*self._failed)
+
+    def _apply(self, batch: int, updates: dict):
+        try:
+            Tourney.apply_scores(updates, self._writer_id, batch)
+        except BulkWriteError as e:
+            if not e.details.get('writeErrors'):
+                raise
+            # updates rejected by MongoDB would be rejected again
+            logging.error('Dropped trophies updates of batch %d, %d of them are rejected: %s', batch,
+                          len(e.details['writeErrors']), e.details['writeErrors'][0].get('errmsg'))
+        self._failed = None
+
+    def _run(self):
+        while True:
+            self._flush_needed.wait(self.flush_interval)
+            self._flush_needed.clear()
+            try:
+                self.flush()
+            except BaseException as e:
+                logging.exception('Can\'t flush %d trophies updates: %r', len(self), e)
+
+    def __len__(self):
+        return len(self._updates) + (len(self._failed[1]) if self._failed is not None else 0)
+
+
+score_buffer = ScoreBuffer(SCORES_FLUSH_INTERVAL, SCORES_FLUSH_SIZE)
+atexit.register(score_buffer.flush)
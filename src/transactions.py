@@ -1,23 +1,89 @@
 # !/usr/bin/env python3
+import json
 import logging
+import os
+import socket
 import threading
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
 
 import kin
-from mongoengine import connect
+from mongoengine import Q
 from stellar_base.network import NETWORKS
 
-from config import NETWORK, HORIZON_URL, KIN_ASSET, SECRET_KEY, MONGODB_URI, PUBLIC_KEY, TOURNEY_PAY_TIMEOUT
-from misc import logs
-from schema import Tourney, TourneyStatus, TourneyMemberED
+from config import NETWORK, HORIZON_URL, KIN_ASSET, SECRET_KEY, PUBLIC_KEY, TOURNEY_PAY_TIMEOUT, \
+    PAYMENT_CHECK_CONCURRENCY, PAYMENT_DETECTION, PAYMENT_POLL_INTERVAL, \
+    PAYMENT_RECONCILE_INTERVAL, PAYMENT_STREAM_RETRY_DELAY, PAYMENT_STREAM_SEEN_SIZE, PAYOUT_MAX_ATTEMPTS, \
+    PAYOUT_RETRY_DELAY, PAYMENT_CHECK_LEASE, PAYOUT_LEASE, PAYMENT_CLAIM_BATCH, WORKER_RESEED_INTERVAL, \
+    WORKER_METRICS_PORT, ARCHIVE_RETENTION, ARCHIVE_INTERVAL, ARCHIVE_BATCH
+from horizon import HorizonClient, TransactionLookup, BadSequenceError
+from misc import clock, logs, metrics
+from misc.cache import LRUCache
+from misc.scheduler import Scheduler
+from payouts import build_payout, get_channel_pool
+from schema import Tourney, TourneyStatus, StreamCursor, connect_db, ensure_indexes, \
+    migrate, load_leaders
 
 NETWORKS['CUSTOM'] = 'private testnet'
 
-sdk = kin.SDK(network=NETWORK,
-              horizon_endpoint_uri=HORIZON_URL,
-              secret_key=SECRET_KEY,
-              kin_asset=KIN_ASSET)
+PAYMENTS_STREAM = 'payments'
+# identifies leases of this process
+WORKER_ID = '%s-%d' % (socket.gethostname(), os.getpid())
+
+# (place index, percent of the prize)
+PRIZE_PLACES = [(0, 40), (1, 25), (2, 15)]
+
+# built on the first use by get_sdk(), so importing the module doesn't wait for Horizon, it only streams payments
+sdk = None
+_sdk_lock = threading.Lock()
+# all other Horizon requests go through the pooled client with timeouts and the circuit breaker
+horizon_client = HorizonClient()
+# builds signed payout transactions which are submitted by horizon_client.submit(builder.gen_xdr())
+payout_builder = build_payout
+
+
+def get_sdk():
+    global sdk
+    if sdk is None:
+        with _sdk_lock:
+            if sdk is None:
+                sdk = kin.SDK(network=NETWORK,
+                              horizon_endpoint_uri=HORIZON_URL,
+                              secret_key=SECRET_KEY,
+                              kin_asset=KIN_ASSET)
+    return sdk
+
+
+def use_ledger(ledger_client, ledger_payout_builder):
+    """Replaces the Horizon client and the payouts builder, e.g. by a simulated ledger.
+    The workers use get_transaction(), account_sequence() and submit() of the client and hash_hex() and gen_xdr()
+    of the built payouts
+    """
+    global horizon_client, payout_builder
+    horizon_client = ledger_client
+    payout_builder = ledger_payout_builder
+
+
+HORIZON_REQUEST_SECONDS = metrics.Histogram('horizon_request_seconds', 'Horizon requests latency', ('call',))
+HORIZON_ERRORS = metrics.Counter('horizon_errors_total', 'Failed Horizon requests', ('call', 'error'))
+WORKER_LOOP_SECONDS = metrics.Histogram('worker_loop_seconds', 'Duration of a pass of a transactions loop', ('loop',))
+WORKER_LAG_SECONDS = metrics.Gauge('worker_lag_seconds', 'How late a transactions loop processes its work', ('loop',))
+TOURNEY_END_LAG_SECONDS = metrics.Histogram('tourney_end_lag_seconds', 'Delay of tourney ending after its endAt')
+
+# confirmed transactions and backoff of the not found ones, the client is read on every lookup as it may be replaced
+transaction_lookup = TransactionLookup(
+    lambda tx_hash: horizon_call('get_transaction', horizon_client.get_transaction, tx_hash)
+)
+# ids of payed tourneys by their endAt
+end_scheduler = Scheduler()
+# ids of tourneys submitted to the ending executor, so a reseed doesn't schedule them again, and ids of tourneys which
+# payouts are retried, so their retry renews the lease of this worker
+ending_tourneys = set()
+payout_retries = set()
+_ending_lock = threading.Lock()
+# hashes of streamed transactions which tourneys weren't created yet
+streamed_transactions = LRUCache(PAYMENT_STREAM_SEEN_SIZE)
 
 
 # TX_HASH = 'e3f4b6167243118d60284cd18c7d9e16be776a4cec0713516239d49c680928c7'
@@ -27,19 +93,32 @@ sdk = kin.SDK(network=NETWORK,
 # print(tx_dat)
 #
 
+def horizon_call(call: str, func, *args, **kwargs):
+    """Calls Horizon through `func`, measuring its latency and errors by the `call` name"""
+    started = time.time()
+    try:
+        return func(*args, **kwargs)
+    except BaseException as e:
+        HORIZON_ERRORS.inc(call, type(e).__name__)
+        raise
+    finally:
+        HORIZON_REQUEST_SECONDS.observe(time.time() - started, call)
+
+
 def store_tourney_err(tourney, err_msg, status):
     logging.info(err_msg)
     tourney.status = status
-    tourney.ended = datetime.utcnow()
+    tourney.ended = clock.utcnow()
     tourney.error_message = err_msg
     tourney.save()
 
 
 def try_start_tourney(tourney: Tourney):
-    try:
-        tx_data = sdk.get_transaction_data(tourney.transaction_id)
-    except kin.errors.ResourceNotFoundError:
-        if (datetime.utcnow() - tourney.startAt).total_seconds() < TOURNEY_PAY_TIMEOUT:
+    expired = (clock.utcnow() - tourney.startAt).total_seconds() >= TOURNEY_PAY_TIMEOUT
+    # Horizon is always asked before the tourney is stopped as not payed
+    tx_data = transaction_lookup.get(tourney.transaction_id, force=expired)
+    if tx_data is None:
+        if not expired:
             logging.info('Transaction %s isn\'t exist yet' % tourney.transaction_id)
         else:
             store_tourney_err(
@@ -72,45 +151,201 @@ def try_start_tourney(tourney: Tourney):
         )
     )
     tourney.prize = float(total_amount)
-    tourney.payed = datetime.utcnow()
+    tourney.payed = clock.utcnow()
     tourney.status = TourneyStatus.PAYED.value
     tourney.save()
+    end_scheduler.schedule(tourney.id, tourney.endAt)
+
+
+def check_tourney_payment(tourney_id) -> bool:
+    """Checks the payment of the not payed tourney, returns False if the tourney is claimed by another worker"""
+    tourney = Tourney.claim(WORKER_ID, PAYMENT_CHECK_LEASE, members_limit=0,
+                            id=tourney_id, status=TourneyStatus.NOT_PAYED_YET.value)
+    if tourney is None:
+        return False
+    try:
+        try_start_tourney(tourney)
+    except BaseException as e:
+        logging.exception('Can\'t check payment of tourney %s (transaction %s): %r',
+                          tourney.id, tourney.transaction_id, e)
+    if tourney.status == TourneyStatus.NOT_PAYED_YET.value:
+        # a transaction which isn't found is looked up again only after its backoff
+        delay = max(PAYMENT_POLL_INTERVAL, transaction_lookup.backoff_left(tourney.transaction_id))
+        Tourney.objects(id=tourney.id, status=TourneyStatus.NOT_PAYED_YET.value).update_one(
+            set__payment_check_due=clock.utcnow() + timedelta(seconds=delay)
+        )
+    return True
+
+
+def tourneys_to_check(check_all: bool) -> list:
+    """Returns ids of at most PAYMENT_CLAIM_BATCH not payed tourneys to check, all of them which are due or only
+    those which transactions were streamed. The longest waiting ones come first, so every tourney gets its turn
+    """
+    query = Tourney.objects(Tourney.not_leased(WORKER_ID), status=TourneyStatus.NOT_PAYED_YET.value)
+    if check_all:
+        query = query.filter(Q(payment_check_due=None) | Q(payment_check_due__lte=clock.utcnow()))
+    else:
+        query = query.filter(transaction_id__in=streamed_transactions.keys())
+    tourneys = list(query.only('id', 'payment_check_due').order_by('payment_check_due').limit(PAYMENT_CLAIM_BATCH))
+    if check_all:
+        # how long the most overdue check has been waiting
+        due = next((t.payment_check_due for t in tourneys if t.payment_check_due is not None), None)
+        WORKER_LAG_SECONDS.set(max(0.0, (clock.utcnow() - due).total_seconds()) if due is not None else 0.0,
+                               'monitor_new_tourneys')
+    return [tourney.id for tourney in tourneys]
 
 
 def monitor_new_tourneys():
+    last_reconcile = 0
+    with ThreadPoolExecutor(max_workers=PAYMENT_CHECK_CONCURRENCY, thread_name_prefix='payment_check') as executor:
+        while True:
+            started = time.time()
+            check_all = PAYMENT_DETECTION != 'stream' or clock.time() - last_reconcile >= PAYMENT_RECONCILE_INTERVAL
+            if check_all:
+                last_reconcile = clock.time()
+            # every tourney is claimed and saved by its own check as soon as its transaction is fetched
+            tourney_ids = tourneys_to_check(check_all)
+            wait([executor.submit(check_tourney_payment, tourney_id) for tourney_id in tourney_ids])
+            # a pass longer than PAYMENT_POLL_INTERVAL delays the next check of every tourney
+            WORKER_LOOP_SECONDS.observe(time.time() - started, 'monitor_new_tourneys')
+            # a full batch means more tourneys are due right now
+            if len(tourney_ids) < PAYMENT_CLAIM_BATCH:
+                clock.sleep(PAYMENT_POLL_INTERVAL)
+
+
+def stream_payments():
+    """Starts tourneys as soon as their transactions to PUBLIC_KEY appear in the Horizon stream"""
     while True:
-        for tourney in Tourney.objects(status=TourneyStatus.NOT_PAYED_YET.value):
-            try_start_tourney(tourney)
-        time.sleep(10)
+        cursor = StreamCursor.load(PAYMENTS_STREAM) or 'now'
+        try:
+            for event in get_sdk().horizon.account_transactions(PUBLIC_KEY, params={'cursor': cursor}, sse=True):
+                if event.data == '"hello"':
+                    continue
+                tx = json.loads(event.data)
+                transaction_lookup.reset(tx['hash'])
+                WORKER_LAG_SECONDS.set(
+                    (clock.utcnow() - datetime.strptime(tx['created_at'], '%Y-%m-%dT%H:%M:%SZ')).total_seconds(),
+                    'stream_payments'
+                )
+                # the lookup goes through the unique transaction_id index
+                tourney = Tourney.objects(
+                    transaction_id=tx['hash'], status=TourneyStatus.NOT_PAYED_YET.value
+                ).only('id').first()
+                if tourney is None or not check_tourney_payment(tourney.id):
+                    # the tourney may be created after its payment or be leased by another worker now,
+                    # monitor_new_tourneys will start it
+                    streamed_transactions.set(tx['hash'], True)
+                StreamCursor.store(PAYMENTS_STREAM, tx['paging_token'])
+        except BaseException as e:
+            logging.exception('Payments stream from cursor %s is broken: %r', cursor, e)
+        clock.sleep(PAYMENT_STREAM_RETRY_DELAY)
+
+
+def applied_payout(tourney: Tourney):
+    """Returns the hash of the prizes transaction of the tourney which is in the ledger, None if none of them is"""
+    for tx_hash in tourney.payout_tx_hashes:
+        if transaction_lookup.get(tx_hash, force=True) is not None:
+            return tx_hash
+    return None
+
+
+def send_payout(tourney: Tourney, payments: list) -> str:
+    """Sends all prizes in a single transaction and returns its hash.
+
+    The signed transaction is stored in the tourney before the submission. A retry looks up the stored hashes in the
+    ledger, so a payout which was applied despite an error is never sent again, and submits the same envelope again
+    while its sequence number isn't taken, so it can be applied only once. A new transaction is built only after the
+    channel took that sequence by another transaction.
+    """
+    with get_channel_pool().acquire(tourney.payout_channel) as (channel_address, channel_secret_key):
+        sequence_taken = True
+        if tourney.payout_envelope is not None:
+            # the sequence is read before the lookup, so a payout applied in between is found by the lookup
+            sequence_taken = horizon_call('account_sequence', horizon_client.account_sequence,
+                                          tourney.payout_channel) >= tourney.payout_sequence
+        tx_hash = applied_payout(tourney)
+        if tx_hash is not None:
+            return tx_hash
+        if not sequence_taken:
+            horizon_call('submit_payout', horizon_client.submit, tourney.payout_envelope)
+            return tourney.payout_tx_hashes[-1]
+        sequence = horizon_call('account_sequence', horizon_client.account_sequence, channel_address)
+        builder = payout_builder(payments, channel_secret_key, sequence)
+        tx_hash = builder.hash_hex()
+        tourney.payout_channel = channel_address
+        tourney.payout_envelope = builder.gen_xdr().decode()
+        # the transaction takes the sequence next to the one of the account
+        tourney.payout_sequence = sequence + 1
+        tourney.payout_tx_hashes.append(tx_hash)
+        tourney.save()
+        horizon_call('submit_payout', horizon_client.submit, tourney.payout_envelope)
+    return tx_hash
+
+
+def retry_payout(tourney_id):
+    """Schedules the next payout attempt of the tourney leased by this worker"""
+    with _ending_lock:
+        payout_retries.add(tourney_id)
+    end_scheduler.schedule(tourney_id, clock.utcnow() + timedelta(seconds=PAYOUT_RETRY_DELAY))
 
 
 def end_tourney(tourney: Tourney):
     prize_sending_log = []
     total_sent = 0
-    sorted_members = sorted(tourney.members, key=lambda m: m.currentTrophies, reverse=True)
-    for i, percent in [(0, 40), (1, 25), (2, 15)]:
+    prizes = []
+    sorted_members = load_leaders(tourney, len(PRIZE_PLACES))
+    for i, percent in PRIZE_PLACES:
         if i >= len(sorted_members):
             err = 'Member #%d does not exist, don\'t send %d%% of prize %f KIN' % (i + 1, percent, tourney.prize)
             prize_sending_log.append(err)
             logging.error(err)
             continue
-        member = sorted_members[i]  # type:TourneyMemberED
+        prizes.append((i, percent, sorted_members[i], tourney.prize * percent / 100))
+    if prizes:
+        # counted before the attempt, so attempts failed before anything was submitted are counted too
+        tourney.payout_attempts = (tourney.payout_attempts or 0) + 1
+        tourney.save()
         try:
-            prize_amount = tourney.prize * percent / 100
-            sdk.send_kin(member.wallet_public_key, prize_amount, memo_text='Your prize for #%d place' % (i + 1))
-            total_sent += prize_amount
-            msg = 'Prize for #%d place %f KIN (%d %%) was sent to %s (wallet %s)' % (
-                i + 1, prize_amount, percent, member.user_id, member.wallet_public_key
-            )
-            prize_sending_log.append(msg)
-            logging.info(msg)
+            tx_hash = send_payout(tourney, [(member.wallet_public_key, amount)
+                                            for i, percent, member, amount in prizes])
         except BaseException as e:
-            err = 'Can\'t send prize to user_id=%s (wallet %s): %r' % (member.user_id, member.wallet_public_key, e)
-            prize_sending_log.append(err)
-            logging.error(err)
+            if isinstance(e, BadSequenceError):
+                # another transaction took the sequence of the channel, so the payout wasn't really attempted
+                tourney.payout_attempts -= 1
+                tourney.save()
+            if tourney.payout_attempts < PAYOUT_MAX_ATTEMPTS:
+                logging.error('Can\'t send prizes of tourney %s (attempt %d), retry in %d seconds: %r' % (
+                    tourney.id, tourney.payout_attempts, PAYOUT_RETRY_DELAY, e
+                ))
+                retry_payout(tourney.id)
+                return
+            try:
+                # the last submission may have been applied despite its error
+                tx_hash = applied_payout(tourney)
+            except BaseException as lookup_error:
+                logging.error('Can\'t check prizes of tourney %s after the last attempt, retry in %d seconds: %r' % (
+                    tourney.id, PAYOUT_RETRY_DELAY, lookup_error
+                ))
+                retry_payout(tourney.id)
+                return
+            if tx_hash is None:
+                for i, percent, member, amount in prizes:
+                    err = 'Can\'t send prize to user_id=%s (wallet %s): %r' % (
+                        member.user_id, member.wallet_public_key, e
+                    )
+                    prize_sending_log.append(err)
+                    logging.error(err)
+        if tx_hash is not None:
+            for i, percent, member, amount in prizes:
+                total_sent += amount
+                msg = 'Prize for #%d place %f KIN (%d %%) was sent to %s (wallet %s) in transaction %s' % (
+                    i + 1, amount, percent, member.user_id, member.wallet_public_key, tx_hash
+                )
+                prize_sending_log.append(msg)
+                logging.info(msg)
     tourney.prize_sent = total_sent
     tourney.prize_sending_log = '\n'.join(prize_sending_log)
-    tourney.ended = datetime.utcnow()
+    tourney.ended = clock.utcnow()
     tourney.status = TourneyStatus.ENDED.value
     tourney.save()
     logging.info(
@@ -120,26 +355,83 @@ def end_tourney(tourney: Tourney):
     )
 
 
+def end_tourney_by_id(tourney_id):
+    with _ending_lock:
+        retry = tourney_id in payout_retries
+        payout_retries.discard(tourney_id)
+    try:
+        # the lease outlives payout retries, so the prizes are sent by this worker only. Only a retry renews the lease
+        # of this worker, so a tourney which is already being ended isn't ended again.
+        # The winners are loaded sorted by end_tourney(), so no members are loaded here
+        tourney = Tourney.claim(WORKER_ID, PAYOUT_LEASE, members_limit=0, reclaim=retry,
+                                id=tourney_id, status=TourneyStatus.PAYED.value)  # type:Tourney
+        if tourney is not None:
+            lag = (clock.utcnow() - tourney.endAt).total_seconds()
+            TOURNEY_END_LAG_SECONDS.observe(lag)
+            WORKER_LAG_SECONDS.set(lag, 'control_run_tourneys')
+            end_tourney(tourney)
+    except BaseException as e:
+        logging.exception('Can\'t end tourney %s: %r', tourney_id, e)
+    finally:
+        with _ending_lock:
+            ending_tourneys.discard(tourney_id)
+
+
+def schedule_payed_tourneys(due_only=False):
+    """Schedules endings of payed tourneys. With `due_only` these are the overdue tourneys which aren't leased,
+    tourneys payed by other workers are scheduled there and get here only if that worker has stopped. Tourneys leased
+    by this worker are being ended or wait for their payout retry already
+    """
+    query = Tourney.objects(status=TourneyStatus.PAYED.value)
+    if due_only:
+        query = query.filter(Tourney.not_leased(), endAt__lte=clock.utcnow())
+    for tourney in query.only('id', 'endAt'):
+        with _ending_lock:
+            # a submitted tourney may wait in the executor before it's claimed
+            if tourney.id in ending_tourneys:
+                continue
+        end_scheduler.schedule(tourney.id, tourney.endAt)
+
+
 def control_run_tourneys():
+    schedule_payed_tourneys()
+    last_reseed = clock.time()
+    # every payout holds a channel until its transaction is submitted
+    with ThreadPoolExecutor(max_workers=len(get_channel_pool()), thread_name_prefix='end_tourney') as executor:
+        while True:
+            tourney_id = end_scheduler.pop(timeout=max(0, last_reseed + WORKER_RESEED_INTERVAL - clock.time()))
+            if tourney_id is not None:
+                with _ending_lock:
+                    ending_tourneys.add(tourney_id)
+                executor.submit(end_tourney_by_id, tourney_id)
+                continue
+            last_reseed = clock.time()
+            schedule_payed_tourneys(due_only=True)
+
+
+def archive_tourneys():
+    """Moves finished tourneys to the history after ARCHIVE_RETENTION, leaving their summaries with the winners"""
     while True:
-        next_start = None  # type:datetime
-        for tourney in Tourney.objects(status=TourneyStatus.PAYED.value):  # type:Tourney
-            if datetime.utcnow() >= tourney.endAt:
-                end_tourney(tourney)
-            else:
-                if next_start is None or tourney.endAt < next_start:
-                    next_start = tourney.endAt
-        if next_start is None:
-            time.sleep(10)
-        else:
-            time.sleep((next_start - datetime.utcnow()).total_seconds())
+        try:
+            archived = Tourney.archive(clock.utcnow() - timedelta(seconds=ARCHIVE_RETENTION), ARCHIVE_BATCH,
+                                       members_kept=len(PRIZE_PLACES))
+            if archived:
+                logging.info('%d tourneys were archived', archived)
+            if archived == ARCHIVE_BATCH:
+                continue
+        except BaseException as e:
+            logging.exception('Can\'t archive tourneys: %r', e)
+        clock.sleep(ARCHIVE_INTERVAL)
 
 
 def main():
     available_commands = {
         'monitor_new_tourneys': monitor_new_tourneys,
         'control_run_tourneys': control_run_tourneys,
+        'archive_tourneys': archive_tourneys,
     }
+    if PAYMENT_DETECTION == 'stream':
+        available_commands['stream_payments'] = stream_payments
 
     threads = []
     for name, proc in available_commands.items():
@@ -155,5 +447,8 @@ def main():
 if __name__ == '__main__':
     logs.init('transactions')
 
-    connect(host=MONGODB_URI)
+    metrics.serve(WORKER_METRICS_PORT)
+    connect_db()
+    ensure_indexes()
+    migrate()
     main()
@@ -0,0 +1,59 @@
+"""Fixtures of the tests, run from the repository root: python -m pytest -q
+
+The modules are imported from src like the servers do. Tests of MongoDB queries use the database of
+TEST_MONGODB_URI (mongodb://localhost/kin_test by default), which is dropped around every test, and are skipped
+when the server isn't reachable or the kin SDK isn't installed.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+TEST_MONGODB_URI = os.environ.get('TEST_MONGODB_URI', 'mongodb://localhost/kin_test')
+
+
+@pytest.fixture
+def virtual_clock():
+    from misc import clock
+
+    virtual = clock.VirtualClock()
+    clock.set_clock(virtual)
+    yield virtual
+    clock.set_clock(clock.SystemClock())
+
+
+@pytest.fixture
+def db():
+    pytest.importorskip('kin')
+    pytest.importorskip('mongoengine')
+    from mongoengine import disconnect
+    from mongoengine.connection import get_db
+    from pymongo.errors import ServerSelectionTimeoutError
+    import schema
+
+    schema.connect_db(TEST_MONGODB_URI)
+    database = get_db()
+    try:
+        database.client.drop_database(database.name)
+    except ServerSelectionTimeoutError:
+        disconnect()
+        pytest.skip('MongoDB of %s is not reachable' % TEST_MONGODB_URI)
+    schema.ensure_indexes()
+    schema.migrate()
+    yield database
+    database.client.drop_database(database.name)
+    disconnect()
+
+
+def new_member(n: int) -> dict:
+    """A member with a valid wallet"""
+    from stellar_base.keypair import Keypair
+
+    return {'user_id': 'user%d' % n, 'alias_id': 'alias%d' % n, 'name': 'Member %d' % n, 'tag': '#%d' % n,
+            'wallet_public_key': Keypair.random().address().decode()}
+
+
+def transaction_id(n: int) -> str:
+    return '%064x' % n
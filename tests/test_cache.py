@@ -0,0 +1,42 @@
+from misc.cache import LRUCache
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_set_replaces_and_refreshes():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.set('a', 10)
+    cache.set('c', 3)
+    assert cache.get('a') == 10
+    assert cache.get('b', 'missing') == 'missing'
+
+
+def test_pop_and_clear():
+    cache = LRUCache(3)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.pop('a') == 1
+    assert cache.pop('a', 'missing') == 'missing'
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_keys_dont_refresh():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.keys() == ['a', 'b']
+    cache.set('c', 3)
+    assert cache.keys() == ['b', 'c']
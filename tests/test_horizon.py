@@ -0,0 +1,93 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('kin')
+
+from horizon import CircuitBreaker, NotFoundError, TransactionLookup  # noqa: E402
+
+
+class Fetch(object):
+    """Horizon lookups which find only the transactions in `found`"""
+
+    def __init__(self):
+        self.found = set()
+        self.calls = 0
+
+    def __call__(self, tx_hash):
+        self.calls += 1
+        if tx_hash not in self.found:
+            raise NotFoundError('Transaction %s is not found' % tx_hash, 404)
+        return SimpleNamespace(hash=tx_hash, operations=[])
+
+
+def test_missing_transaction_backs_off(virtual_clock):
+    fetch = Fetch()
+    lookup = TransactionLookup(fetch, cache_size=10, persist=False, backoff_min=10, backoff_max=25)
+    assert lookup.get('a') is None
+    assert lookup.is_backing_off('a')
+    assert lookup.backoff_left('a') == 10
+    # backed off lookups don't reach Horizon unless forced
+    assert lookup.get('a') is None
+    assert fetch.calls == 1
+    assert lookup.get('a', force=True) is None
+    assert fetch.calls == 2
+    # the delay doubles up to the maximum
+    assert lookup.backoff_left('a') == 20
+    virtual_clock.advance(20)
+    lookup.get('a')
+    assert lookup.backoff_left('a') == 25
+
+
+def test_found_transaction_is_cached(virtual_clock):
+    fetch = Fetch()
+    lookup = TransactionLookup(fetch, cache_size=10, persist=False, backoff_min=10, backoff_max=60)
+    lookup.get('a')
+    fetch.found.add('a')
+    lookup.reset('a')
+    assert not lookup.is_backing_off('a')
+    assert lookup.get('a').hash == 'a'
+    assert lookup.get('a', force=True).hash == 'a'
+    assert fetch.calls == 2
+
+
+def test_breaker_opens_after_failures_in_a_row(virtual_clock):
+    changes = []
+    breaker = CircuitBreaker(failures_threshold=2, reset_timeout=30,
+                             on_change=lambda state, value: changes.append(state))
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+    assert changes == [CircuitBreaker.OPEN]
+
+
+def test_half_open_breaker_lets_a_single_trial_through(virtual_clock):
+    breaker = CircuitBreaker(failures_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    virtual_clock.advance(30)
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+    # a failed trial opens the circuit again
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    virtual_clock.advance(30)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_stuck_trial_is_replaced(virtual_clock):
+    breaker = CircuitBreaker(failures_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    virtual_clock.advance(30)
+    assert breaker.allow()
+    virtual_clock.advance(30)
+    assert breaker.allow()
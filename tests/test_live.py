@@ -0,0 +1,98 @@
+import pytest
+
+from conftest import transaction_id
+
+
+def create_tourney():
+    from schema import Tourney
+
+    return Tourney.create_many([{'name': 'Live', 'user_id': 'owner', 'transaction_id': transaction_id(0)}])[0]
+
+
+def test_finished_tourney_isnt_watched(db):
+    from live import LiveHub
+    from schema import Tourney, TourneyStatus
+
+    tourney = create_tourney()
+    Tourney.objects(id=tourney.id).update_one(set__status=TourneyStatus.ENDED.value)
+    hub = LiveHub(poll_interval=3600, leaders_count=3, queue_size=10, max_subscribers=10)
+    subscriber = hub.subscribe(tourney.id)
+    assert 'event: snapshot' in subscriber.get_nowait()
+    assert subscriber.get_nowait() is None
+    assert hub._watched == {}
+    assert hub._thread is None
+
+
+def test_running_tourney_is_watched_until_unsubscribed(db):
+    from live import LiveHub
+
+    tourney = create_tourney()
+    hub = LiveHub(poll_interval=3600, leaders_count=3, queue_size=10, max_subscribers=10)
+    subscriber = hub.subscribe(tourney.id)
+    assert 'event: snapshot' in subscriber.get_nowait()
+    assert list(hub._watched) == [tourney.id]
+    hub.unsubscribe(tourney.id, subscriber)
+    assert hub._watched == {}
+
+
+def test_snapshot_has_separate_leaders(db, monkeypatch):
+    import json
+    import schema
+    from conftest import new_member
+    from live import LiveHub
+    from schema import Tourney
+
+    monkeypatch.setattr(schema, 'MEMBERS_SEPARATE', True)
+    tourney = create_tourney()
+    Tourney.join_many(tourney.id, [new_member(n) for n in range(3)])
+    Tourney.apply_scores({(tourney.id, 'user%d' % n): [trophies, 0, None] for n, trophies in enumerate([5, 9, 1])},
+                         'writer', 1)
+    hub = LiveHub(poll_interval=3600, leaders_count=2, queue_size=10, max_subscribers=10)
+    snapshot = hub.subscribe(tourney.id).get_nowait()
+    leaders = json.loads(snapshot.split('data: ', 1)[1])['leaders']
+    assert [leader['user_id'] for leader in leaders] == ['user1', 'user0']
+
+
+def test_subscribers_above_the_limit_are_rejected(db):
+    from live import LiveHub, TooManySubscribersError
+
+    tourney = create_tourney()
+    hub = LiveHub(poll_interval=3600, leaders_count=3, queue_size=10, max_subscribers=1)
+    subscriber = hub.subscribe(tourney.id)
+    with pytest.raises(TooManySubscribersError):
+        hub.subscribe(tourney.id)
+    hub.unsubscribe(tourney.id, subscriber)
+    hub.unsubscribe(tourney.id, hub.subscribe(tourney.id))
+    assert hub._watched == {}
+
+
+def test_tourney_finished_while_subscribing_isnt_watched_again(db):
+    import threading
+    from live import LiveHub
+    from schema import TourneyStatus
+
+    tourney = create_tourney()
+    hub = LiveHub(poll_interval=3600, leaders_count=3, queue_size=10, max_subscribers=10)
+    hub.subscribe(tourney.id)
+
+    class RacingLock(object):
+        """Finishes the tourney like poll() does between the two lock sections of subscribe()"""
+
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.entered = 0
+
+        def __enter__(self):
+            self.entered += 1
+            if self.entered == 2:
+                hub._watched.pop(tourney.id).status = TourneyStatus.ENDED.value
+            return self.lock.__enter__()
+
+        def __exit__(self, *exc_info):
+            return self.lock.__exit__(*exc_info)
+
+    hub._lock = RacingLock()
+    subscriber = hub.subscribe(tourney.id)
+    assert 'event: snapshot' in subscriber.get_nowait()
+    assert subscriber.get_nowait() is None
+    assert hub._watched == {}
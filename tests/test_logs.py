@@ -0,0 +1,59 @@
+import json
+import logging
+import queue
+import sys
+
+import pytest
+
+pytest.importorskip('kin')
+
+from misc import logs  # noqa: E402
+
+
+def new_record(name='app', level=logging.INFO, msg='message %d', args=(1,), exc_info=None) -> logging.LogRecord:
+    return logging.getLogger(name).makeRecord(name, level, __file__, 1, msg, args, exc_info, func='handle')
+
+
+def test_sampling_filter_keeps_the_share_of_records(monkeypatch):
+    sampling = logs.SamplingFilter({'noisy': 0.25, 'silent': 0.0})
+    draws = iter([0.1, 0.3, 0.2, 0.9, 0.0])
+    monkeypatch.setattr(logs.random, 'random', lambda: next(draws))
+    assert [sampling.filter(new_record('noisy')) for _ in range(4)] == [1, 0, 1, 0]
+    assert sampling.filter(new_record('silent')) == 0
+    assert sampling.filter(new_record('other')) == 1
+    # warnings are never sampled
+    assert sampling.filter(new_record('silent', level=logging.WARNING)) == 1
+
+
+def test_sampling_is_decided_once_per_record(monkeypatch):
+    sampling = logs.SamplingFilter({'noisy': 0.5})
+    draws = iter([0.1, 0.9])
+    monkeypatch.setattr(logs.random, 'random', lambda: next(draws))
+    record = new_record('noisy')
+    # every handler of the record gets the same decision
+    assert sampling.filter(record) == 1
+    assert sampling.filter(record) == 1
+
+
+def test_queue_handler_drops_records_of_the_full_queue():
+    handler = logs.DroppingQueueHandler(queue.Queue(maxsize=2))
+    for n in range(5):
+        handler.handle(new_record(args=(n,)))
+    assert handler.dropped == 3
+    queued = [handler.queue.get_nowait() for _ in range(2)]
+    # the message is merged before the record is queued
+    assert [(record.msg, record.args) for record in queued] == [('message 0', None), ('message 1', None)]
+
+
+def test_json_formatter_writes_a_json_object_per_record():
+    try:
+        raise ValueError('broken')
+    except ValueError:
+        exc_info = sys.exc_info()
+    data = json.loads(logs.JsonFormatter().format(new_record('app', logging.ERROR, exc_info=exc_info)))
+    assert {key: data[key] for key in ('level', 'logger', 'function', 'message')} == {
+        'level': 'ERROR', 'logger': 'app', 'function': 'handle', 'message': 'message 1'
+    }
+    assert data['module'] == 'test_logs'
+    assert data['time'] and data['thread']
+    assert 'ValueError: broken' in data['exception']
@@ -0,0 +1,68 @@
+import os
+
+import pytest
+
+from misc import metrics
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """An empty registry of the test metrics"""
+    monkeypatch.setattr(metrics, '_registry', [])
+    monkeypatch.setattr(metrics, '_multiprocess_dir', None)
+
+
+def test_render(registry):
+    requests = metrics.Counter('requests_total', 'Requests', ('method',))
+    latency = metrics.Histogram('latency_seconds', 'Latency', buckets=(1, 5))
+    requests.inc('GET')
+    requests.inc('GET', amount=2)
+    latency.observe(0.5)
+    latency.observe(3)
+    lines = metrics.render().splitlines()
+    assert 'requests_total{method="GET"} 3.0' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 1' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 2' in lines
+    assert 'latency_seconds_sum 3.5' in lines
+    assert 'latency_seconds_count 2' in lines
+
+
+def test_processes_are_merged(registry, tmpdir):
+    directory = str(tmpdir)
+    requests = metrics.Counter('requests_total', 'Requests', ('method',))
+    latency = metrics.Histogram('latency_seconds', 'Latency', buckets=(1,))
+    lag = metrics.Gauge('lag_seconds', 'Lag')
+    requests.inc('GET')
+    latency.observe(0.5)
+    lag.set(2)
+    # a snapshot of another worker
+    other = os.getpid() + 1
+    requests.inc('GET')
+    latency.observe(3)
+    lag.set(7)
+    metrics._write_snapshot(directory)
+    os.replace(metrics._snapshot_path(directory, os.getpid()), metrics._snapshot_path(directory, other))
+    requests._values.clear()
+    latency._values.clear()
+    requests.inc('GET')
+    latency.observe(0.5)
+    lag.set(2)
+
+    metrics._multiprocess_dir = directory
+    lines = metrics.render().splitlines()
+    assert 'requests_total{method="GET"} 3.0' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 2' in lines
+    assert 'latency_seconds_count 3' in lines
+    assert 'lag_seconds{pid="%d"} 2.0' % os.getpid() in lines
+    assert 'lag_seconds{pid="%d"} 7.0' % other in lines
+
+    metrics.mark_process_dead(directory, other)
+    lines = metrics.render().splitlines()
+    assert 'requests_total{method="GET"} 3.0' in lines
+    assert 'lag_seconds{pid="%d"} 7.0' % other not in lines
+
+
+def test_clear_multiprocess(tmpdir):
+    tmpdir.join('1.json').write('{}')
+    metrics.clear_multiprocess(str(tmpdir))
+    assert os.listdir(str(tmpdir)) == []
@@ -0,0 +1,87 @@
+import threading
+
+import pytest
+
+pytest.importorskip('kin')
+pytest.importorskip('mongoengine')
+
+from stellar_base.keypair import Keypair  # noqa: E402
+
+import payouts  # noqa: E402
+from payouts import ChannelPool, build_payout  # noqa: E402
+
+
+def new_seed() -> str:
+    return Keypair.random().seed().decode()
+
+
+def address(seed: str) -> str:
+    return Keypair.from_seed(seed).address().decode()
+
+
+def test_pool_is_built_on_first_use(monkeypatch):
+    seeds = [new_seed(), new_seed()]
+    monkeypatch.setattr(payouts, '_channel_pool', None)
+    monkeypatch.setattr(payouts, 'PAYOUT_CHANNEL_SECRET_KEYS', seeds)
+    pool = payouts.get_channel_pool()
+    assert len(pool) == 2
+    assert payouts.get_channel_pool() is pool
+
+
+def test_acquire_prefers_the_given_channel():
+    seeds = [new_seed(), new_seed()]
+    pool = ChannelPool(seeds)
+    with pool.acquire(address(seeds[1])) as (channel, secret_key):
+        assert (channel, secret_key) == (address(seeds[1]), seeds[1])
+        with pool.acquire(address(seeds[1]) + 'unknown') as (other, _):
+            assert other == address(seeds[0])
+
+
+def test_acquire_waits_for_a_released_channel():
+    pool = ChannelPool([new_seed()])
+    acquired = []
+    with pool.acquire() as (channel, _):
+        thread = threading.Thread(target=lambda: acquired.append(pool.acquire().__enter__()[0]))
+        thread.start()
+        thread.join(0.1)
+        assert acquired == []
+    thread.join(1)
+    assert acquired == [channel]
+
+
+def test_channel_leased_by_another_process_is_waited_for(db, monkeypatch):
+    monkeypatch.setattr(payouts, 'PAYOUT_CHANNEL_POLL_INTERVAL', 0.01)
+    seeds = [new_seed(), new_seed()]
+    # pools of two processes configured with the same keys
+    pool, other = ChannelPool(seeds, lease_seconds=60), ChannelPool(seeds, lease_seconds=60)
+    acquired = []
+    with pool.acquire(address(seeds[0])):
+        with other.acquire() as (channel, _):
+            assert channel == address(seeds[1])
+        thread = threading.Thread(target=lambda: acquired.append(other.acquire(address(seeds[0])).__enter__()[0]))
+        thread.start()
+        thread.join(0.1)
+        assert acquired == []
+    thread.join(1)
+    assert acquired == [address(seeds[0])]
+
+
+def test_build_payout_sends_from_the_main_account(monkeypatch):
+    main, channel = new_seed(), new_seed()
+    monkeypatch.setattr(payouts, 'SECRET_KEY', main)
+    monkeypatch.setattr(payouts, 'PUBLIC_KEY', address(main))
+    wallets = [address(new_seed()) for _ in range(3)]
+    builder = build_payout([(wallet, 10.5) for wallet in wallets], channel, sequence=41)
+    assert len(builder.ops) == 3
+    assert {op.source for op in builder.ops} == {address(main)}
+    # signed by the channel, the source of the transaction, and by the main account, the source of the payments
+    assert len(builder.te.signatures) == 2
+    assert len(builder.hash_hex()) == 64
+
+
+def test_build_payout_from_the_main_account(monkeypatch):
+    main = new_seed()
+    monkeypatch.setattr(payouts, 'SECRET_KEY', main)
+    builder = build_payout([(address(new_seed()), 1.0)], main, sequence=1)
+    assert [op.source for op in builder.ops] == [None]
+    assert len(builder.te.signatures) == 1
@@ -0,0 +1,170 @@
+import pytest
+
+from conftest import new_member, transaction_id
+
+
+@pytest.fixture
+def client(db):
+    pytest.importorskip('flask')
+    import rest_server
+
+    rest_server.TOURNEY_CACHE.clear()
+    return rest_server.app.test_client()
+
+
+def create_tourneys(count: int) -> list:
+    from schema import Tourney
+
+    return Tourney.create_many([{'name': 'Tourney %d' % i, 'prize': 100.0, 'user_id': 'owner',
+                                 'transaction_id': transaction_id(i)} for i in range(count)])
+
+
+def test_unchanged_tourneys_are_not_modified(client):
+    from schema import Tourney
+
+    tourney = create_tourneys(1)[0]
+    response = client.get('/api/v1/tourneys')
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert client.get('/api/v1/tourneys', headers={'If-None-Match': etag}).status_code == 304
+
+    Tourney.join(tourney.id, new_member(0))
+    response = client.get('/api/v1/tourneys', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_etag_tells_whether_there_is_a_next_page(client):
+    tourneys = create_tourneys(3)
+    url = '/api/v1/tourneys?limit=1&cursor=%s' % tourneys[2].id
+    response = client.get(url)
+    assert str(tourneys[1].id) in response.data.decode()
+    etag = response.headers['ETag']
+
+    # the page of the older tourney stays the same, only the next cursor goes away
+    tourneys[0].delete()
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_tourney_is_served_from_cache_until_changed(client, monkeypatch):
+    import rest_server
+    from schema import Tourney
+
+    tourney = create_tourneys(1)[0]
+    first = client.get('/api/v1/tourneys/%s' % tourney.id)
+    assert first.status_code == 200
+    assert client.get('/api/v1/tourneys/%s' % tourney.id, headers={'If-None-Match': first.headers['ETag']}
+                      ).status_code == 304
+
+    loaded = []
+    raw_tourneys = rest_server.raw_tourneys
+    monkeypatch.setattr(rest_server, 'raw_tourneys', lambda ids, *args: loaded.append(ids) or raw_tourneys(ids, *args))
+    assert client.get('/api/v1/tourneys/%s' % tourney.id).data == first.data
+    assert loaded == []
+
+    Tourney.join(tourney.id, new_member(0))
+    changed = client.get('/api/v1/tourneys/%s' % tourney.id)
+    assert changed.headers['ETag'] != first.headers['ETag']
+    assert b'user0' in changed.data
+    assert loaded == [[tourney.id]]
+
+
+def test_bulk_create_reports_every_tourney(client):
+    import json
+
+    response = client.post('/api/v1/tourneys/bulk', data={'tourneys': json.dumps([
+        {'name': 'New', 'prize': 10.0, 'user_id': 'owner', 'transaction_id': transaction_id(0)},
+        {'name': 'Twice', 'prize': 10.0, 'user_id': 'owner', 'transaction_id': transaction_id(0)},
+        {'name': 'Invalid', 'prize': 10.0, 'user_id': 'owner', 'transaction_id': 'not a hash'},
+        'not an object',
+    ])})
+    assert response.status_code == 200
+    results = json.loads(response.data.decode())['results']
+    assert [r['status'] for r in results] == ['ok', 'failed', 'failed', 'failed']
+    assert [r.get('errorCode') for r in results[1:]] == [
+        'TourneyTransactionDuplicatedError', 'TransactionHashError', 'InvalidDataError'
+    ]
+    assert results[0]['_id'] and results[0]['transaction_id'] == transaction_id(0)
+
+    # a single tourney of the same transaction conflicts with the created one
+    response = client.post('/api/v1/tourneys', data={'name': 'Again', 'prize': '10', 'user_id': 'owner',
+                                                     'transaction_id': transaction_id(0)})
+    assert response.status_code == 409
+
+
+def test_bulk_requests_are_validated_as_a_whole(client, monkeypatch):
+    import json
+    import config
+
+    tourney = create_tourneys(1)[0]
+    monkeypatch.setattr(config, 'BULK_SIZE_MAX', 2)
+    assert client.post('/api/v1/tourneys/bulk', data={'tourneys': '{}'}).status_code == 400
+    assert client.post('/api/v1/tourneys/bulk', data={'tourneys': 'not json'}).status_code == 400
+    assert client.post('/api/v1/tourneys/bulk', data={'tourneys': json.dumps([{}] * 3)}).status_code == 400
+    assert client.post('/api/v1/tourneys/%s/join/bulk' % tourney.id, data={'members': '{}'}).status_code == 400
+    response = client.post('/api/v1/tourneys/%s/join/bulk' % tourney.id,
+                           data={'members': json.dumps([new_member(n) for n in range(3)])})
+    assert response.status_code == 400
+    assert json.loads(client.get('/api/v1/tourneys/%s' % tourney.id).data.decode())['members_count'] == 0
+
+
+def test_bulk_join_reports_every_member(client):
+    import json
+    from schema import Tourney, TourneyStatus
+
+    tourney = create_tourneys(1)[0]
+    member = new_member(0)
+    response = client.post('/api/v1/tourneys/%s/join/bulk' % tourney.id, data={'members': json.dumps([
+        member, dict(new_member(1), user_id=member['user_id']), dict(new_member(2), wallet_public_key='invalid'), 7,
+    ])})
+    assert response.status_code == 200
+    body = json.loads(response.data.decode())
+    assert [(r['status'], r.get('errorCode'), r['user_id']) for r in body['results']] == [
+        ('ok', None, 'user0'),
+        ('failed', 'UserAlreadyJoinedError', 'user0'),
+        ('failed', 'WalletAddressError', 'user2'),
+        ('failed', 'InvalidDataError', None),
+    ]
+    assert body['tourney']['members_count'] == 1
+
+    # a single join of a joined member conflicts with the tourney
+    assert client.post('/api/v1/tourneys/%s/join' % tourney.id, data=member).status_code == 409
+    Tourney.objects(id=tourney.id).update_one(set__status=TourneyStatus.ENDED.value)
+    response = client.post('/api/v1/tourneys/%s/join/bulk' % tourney.id, data={'members': json.dumps([new_member(3)])})
+    assert json.loads(response.data.decode())['results'][0]['errorCode'] == 'TourneyNotJoinableError'
+
+
+def test_scores_are_accepted_only_if_all_are_valid(client, monkeypatch):
+    import json
+    import rest_server
+    from bson import ObjectId
+    from scores import ScoreBuffer
+
+    buffer = ScoreBuffer(flush_interval=60, flush_size=100)
+    monkeypatch.setattr(rest_server, 'score_buffer', buffer)
+    tourney_id = str(ObjectId())
+    valid = [{'tourney_id': tourney_id, 'user_id': 'user0', 'value': 10, 'seq': 1},
+             {'tourney_id': tourney_id, 'user_id': 'user1', 'delta': -2}]
+    for invalid in ({'tourney_id': 'not an id', 'user_id': 'user2', 'delta': 1},
+                    {'tourney_id': tourney_id, 'user_id': 'user2', 'value': 1, 'delta': 1},
+                    {'tourney_id': tourney_id, 'user_id': 'user2', 'value': True},
+                    {'tourney_id': tourney_id, 'user_id': 'user2', 'delta': 1, 'seq': 1}):
+        response = client.post('/api/v1/scores', data={'scores': json.dumps(valid + [invalid])})
+        assert response.status_code == 400
+        assert len(buffer) == 0
+    assert client.post('/api/v1/scores', data={'scores': '{}'}).status_code == 400
+
+    response = client.post('/api/v1/scores', data={'scores': json.dumps(valid)})
+    assert response.status_code == 200
+    assert json.loads(response.data.decode()) == {'status': 'ok', 'accepted': 2}
+    assert len(buffer) == 2
+
+
+def test_live_events_above_the_limit_are_unavailable(client, monkeypatch):
+    import rest_server
+
+    tourney = create_tourneys(1)[0]
+    monkeypatch.setattr(rest_server.live_hub, 'max_subscribers', 0)
+    assert client.get('/api/v1/tourneys/%s/events' % tourney.id).status_code == 503
@@ -0,0 +1,55 @@
+from datetime import timedelta
+
+from misc.scheduler import Scheduler
+
+
+def test_pops_due_keys_in_order(virtual_clock):
+    scheduler = Scheduler()
+    now = virtual_clock.utcnow()
+    scheduler.schedule('late', now + timedelta(seconds=20))
+    scheduler.schedule('early', now + timedelta(seconds=10))
+    assert scheduler.pop_due() is None
+    assert scheduler.next_due() == now + timedelta(seconds=10)
+
+    virtual_clock.advance(30)
+    assert scheduler.pop_due() == 'early'
+    assert scheduler.pop_due() == 'late'
+    assert scheduler.pop_due() is None
+    assert len(scheduler) == 0
+
+
+def test_reschedule_replaces_due_time(virtual_clock):
+    scheduler = Scheduler()
+    now = virtual_clock.utcnow()
+    scheduler.schedule('a', now + timedelta(seconds=5))
+    scheduler.schedule('b', now + timedelta(seconds=10))
+    scheduler.schedule('a', now + timedelta(seconds=15))
+    assert len(scheduler) == 2
+    assert scheduler.next_due() == now + timedelta(seconds=10)
+
+    virtual_clock.advance(20)
+    assert [scheduler.pop_due(), scheduler.pop_due(), scheduler.pop_due()] == ['b', 'a', None]
+
+
+def test_cancel(virtual_clock):
+    scheduler = Scheduler()
+    now = virtual_clock.utcnow()
+    scheduler.schedule('a', now)
+    scheduler.schedule('b', now + timedelta(seconds=1))
+    scheduler.cancel('a')
+    scheduler.cancel('missing')
+    assert scheduler.next_due() == now + timedelta(seconds=1)
+    virtual_clock.advance(1)
+    assert scheduler.pop(timeout=0) == 'b'
+    assert scheduler.next_due() is None
+
+
+def test_pop_waits_on_the_clock(virtual_clock):
+    scheduler = Scheduler()
+    start = virtual_clock.utcnow()
+    scheduler.schedule('a', start + timedelta(seconds=30))
+    # the virtual clock is advanced instead of a real wait
+    assert scheduler.pop() == 'a'
+    assert virtual_clock.utcnow() == start + timedelta(seconds=30)
+    assert scheduler.pop(timeout=10) is None
+    assert virtual_clock.utcnow() == start + timedelta(seconds=40)
@@ -0,0 +1,203 @@
+import pytest
+
+from conftest import transaction_id
+
+
+def create_tourneys(count: int) -> list:
+    from schema import Tourney
+
+    return Tourney.create_many([{'name': 'Tourney %d' % i, 'prize': 100.0, 'user_id': 'owner',
+                                 'transaction_id': transaction_id(i)} for i in range(count)])
+
+
+def test_page_follows_cursor_newest_first(db):
+    from schema import Tourney
+
+    ids = [t.id for t in create_tourneys(5)]
+    first = Tourney.page(limit=2)
+    assert [t.id for t in first] == ids[:-3:-1]
+    second = Tourney.page(cursor=str(first[-1].id), limit=2)
+    assert [t.id for t in second] == ids[2:0:-1]
+    last = Tourney.page(cursor=str(second[-1].id), limit=2)
+    assert [t.id for t in last] == ids[:1]
+
+
+def test_page_filters_statuses(db):
+    from schema import Tourney, TourneyStatus
+
+    tourneys = create_tourneys(4)
+    for tourney in tourneys[::2]:
+        tourney.status = TourneyStatus.ENDED.value
+        tourney.save()
+    page = Tourney.page(statuses=[TourneyStatus.ENDED.value], limit=10, fields=('id', 'status'))
+    assert [t.id for t in page] == [tourneys[2].id, tourneys[0].id]
+
+
+def test_create_many_rejects_duplicates(db):
+    from misc.exceptions import TourneyTransactionDuplicatedError
+    from schema import Tourney
+
+    create_tourneys(1)
+    results = Tourney.create_many([
+        {'name': 'Again', 'user_id': 'owner', 'transaction_id': transaction_id(0)},
+        {'name': 'New', 'user_id': 'owner', 'transaction_id': transaction_id(1)},
+        {'name': 'Twice', 'user_id': 'owner', 'transaction_id': transaction_id(1)},
+    ])
+    assert isinstance(results[0], TourneyTransactionDuplicatedError)
+    assert isinstance(results[1], Tourney) and results[1].id is not None
+    assert isinstance(results[2], TourneyTransactionDuplicatedError)
+
+
+def test_join_keeps_members_sorted(db):
+    from conftest import new_member
+    from schema import Tourney
+
+    tourney = create_tourneys(1)[0]
+    for n in range(3):
+        Tourney.join(tourney.id, new_member(n))
+    Tourney.apply_scores({(tourney.id, 'user%d' % n): [trophies, 0, None] for n, trophies in enumerate([1, 10, 3])},
+                         'writer', 1)
+    leaders = Tourney.leaderboard(tourney.id, limit=2).members
+    assert [m.user_id for m in leaders] == ['user1', 'user2']
+
+
+def test_migration_sorts_and_counts_legacy_members(db, monkeypatch):
+    import schema
+    from conftest import new_member
+    from schema import Tourney, Migration
+
+    tourney = create_tourneys(1)[0]
+    members = [dict(new_member(n), joinedAt=tourney.startAt, currentTrophies=trophies)
+               for n, trophies in enumerate([1, 7, 3])]
+    Tourney._get_collection().update_one({'_id': tourney.id},
+                                         {'$set': {'members': members}, '$unset': {'members_count': 1}})
+    monkeypatch.setattr(schema, '_members_sorted', False)
+    # until the migration is done the members are sorted when they are loaded
+    assert [m['user_id'] for m in Tourney.objects.get(id=tourney.id).as_dict(2)['members']] == ['user1', 'user2']
+    assert [m.user_id for m in Tourney.leaderboard(tourney.id, offset=1, limit=1).members] == ['user2']
+
+    Migration.drop_collection()
+    schema.migrate()
+    doc = Tourney._get_collection().find_one({'_id': tourney.id})
+    assert [m['currentTrophies'] for m in doc['members']] == [7, 3, 1]
+    assert doc['members_count'] == 3
+
+
+def test_join_counts_legacy_members(db):
+    from conftest import new_member
+    from schema import Tourney
+
+    tourney = create_tourneys(1)[0]
+    Tourney._get_collection().update_one({'_id': tourney.id}, {
+        '$set': {'members': [dict(new_member(0), joinedAt=tourney.startAt, currentTrophies=0)]},
+        '$unset': {'members_count': 1},
+    })
+    assert Tourney.join(tourney.id, new_member(1)).members_count == 2
+    tourney, errors = Tourney.join_many(tourney.id, [new_member(2), new_member(3)])
+    assert errors == [None, None]
+    assert tourney.members_count == 4
+
+
+@pytest.fixture
+def separate(monkeypatch):
+    import schema
+
+    monkeypatch.setattr(schema, 'MEMBERS_SEPARATE', True)
+
+
+def test_join_separate_members(db, separate):
+    from conftest import new_member
+    from misc.exceptions import UserAlreadyJoinedError
+    from schema import Tourney, TourneyMember
+
+    tourney = create_tourneys(1)[0]
+    assert tourney.separate_members
+    member = new_member(0)
+    Tourney.join(tourney.id, member)
+    with pytest.raises(UserAlreadyJoinedError):
+        Tourney.join(tourney.id, dict(new_member(1), user_id=member['user_id']))
+    tourney, errors = Tourney.join_many(tourney.id, [new_member(1), dict(new_member(2), user_id='user1')])
+    assert errors[0] is None and isinstance(errors[1], UserAlreadyJoinedError)
+    assert tourney.members_count == 2
+    assert TourneyMember.objects(tourney=tourney.id).count() == 2
+    # the tourney document itself has no members
+    assert not Tourney._get_collection().find_one({'_id': tourney.id}).get('members')
+
+
+def test_finished_tourney_isnt_joined(db, separate):
+    from conftest import new_member
+    from misc.exceptions import TourneyNotJoinableError
+    from schema import Tourney, TourneyMember, TourneyStatus
+
+    tourney = create_tourneys(1)[0]
+    Tourney.objects(id=tourney.id).update_one(set__status=TourneyStatus.ENDED.value)
+    with pytest.raises(TourneyNotJoinableError):
+        Tourney.join(tourney.id, new_member(0))
+    tourney, errors = Tourney.join_many(tourney.id, [new_member(1)])
+    assert isinstance(errors[0], TourneyNotJoinableError)
+    assert TourneyMember.objects(tourney=tourney.id).count() == 0
+
+
+def test_archive_keeps_leaders_of_separate_members(db, separate, virtual_clock):
+    from datetime import timedelta
+    from conftest import new_member
+    from schema import Tourney, TourneyMember, TourneyStatus, tourney_member_history
+
+    tourney = create_tourneys(1)[0]
+    Tourney.join_many(tourney.id, [new_member(n) for n in range(3)])
+    Tourney.apply_scores({(tourney.id, 'user%d' % n): [trophies, 0, None] for n, trophies in enumerate([5, 9, 1])},
+                         'writer', 1)
+    Tourney.objects(id=tourney.id).update_one(set__status=TourneyStatus.ENDED.value)
+    virtual_clock.advance(1)
+    assert Tourney.archive(virtual_clock.utcnow() + timedelta(days=365), limit=10, members_kept=1) == 1
+    assert [m.user_id for m in TourneyMember.objects(tourney=tourney.id)] == ['user1']
+    assert len(list(tourney_member_history().find({'tourney': tourney.id}))) == 3
+    assert [m.user_id for m in Tourney.leaderboard(tourney.id, offset=1, limit=2).members] == ['user0', 'user2']
+
+
+@pytest.mark.parametrize('members_limit', [None, 2])
+def test_raw_tourney_as_dict_is_as_dict(db, monkeypatch, members_limit):
+    pytest.importorskip('flask')
+    from datetime import timedelta
+    from flask import json
+    import schema
+    from conftest import new_member
+    from misc import clock
+    from misc.myjson import CustomEncoder, dumps_plain
+    from schema import Tourney, TourneyStatus, limit_members, load_members, raw_tourneys, raw_tourney_as_dict
+
+    embedded, legacy, archived = create_tourneys(3)
+    monkeypatch.setattr(schema, 'MEMBERS_SEPARATE', True)
+    separate = Tourney.create_many([{'name': 'Separate', 'prize': 0.0, 'user_id': 'owner',
+                                     'transaction_id': transaction_id(3)}])[0]
+    for tourney in (embedded, legacy, archived, separate):
+        Tourney.join_many(tourney.id, [new_member(n) for n in range(3)])
+        Tourney.apply_scores({(tourney.id, 'user%d' % n): [trophies, 0, None] for n, trophies in enumerate([4, 8, 2])},
+                             'writer', 1)
+    Tourney.objects(id=archived.id).update_one(set__status=TourneyStatus.ENDED.value)
+    Tourney.archive(clock.utcnow() + timedelta(days=1), limit=10, members_kept=2)
+    Tourney._get_collection().update_one({'_id': legacy.id}, {'$unset': {'members_count': 1}})
+    # the members of a tourney without members_count are loaded whole until the migration
+    monkeypatch.setattr(schema, '_members_sorted', False)
+
+    for tourney in (embedded, legacy, archived, separate):
+        loaded = load_members(limit_members(Tourney.objects(id=tourney.id), members_limit).get(), members_limit)
+        doc = raw_tourneys([tourney.id], members_limit)[0]
+        assert json.loads(dumps_plain(raw_tourney_as_dict(doc, members_limit))) == \
+            json.loads(json.dumps(loaded.as_dict(members_limit), cls=CustomEncoder))
+
+
+def test_archive_goes_by_chunks_up_to_the_limit(db, monkeypatch):
+    from datetime import timedelta
+    import schema
+    from misc import clock
+    from schema import Tourney, TourneyStatus, tourney_history
+
+    monkeypatch.setattr(schema, 'ARCHIVE_CHUNK_SIZE', 2)
+    create_tourneys(5)
+    Tourney.objects().update(set__status=TourneyStatus.ENDED.value)
+    ended_before = clock.utcnow() + timedelta(days=365)
+    assert Tourney.archive(ended_before, limit=4, members_kept=1) == 4
+    assert Tourney.archive(ended_before, limit=4, members_kept=1) == 1
+    assert len(list(tourney_history().find())) == 5
+    assert Tourney.objects(archived=None).count() == 0
@@ -0,0 +1,119 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('kin')
+
+from bson import ObjectId  # noqa: E402
+from pymongo.errors import AutoReconnect  # noqa: E402
+
+import scores  # noqa: E402
+from conftest import new_member, transaction_id  # noqa: E402
+from scores import ScoreBuffer  # noqa: E402
+
+TOURNEY_ID = ObjectId()
+
+
+@pytest.fixture
+def applied(monkeypatch):
+    """Batches passed to Tourney.apply_scores, the calls fail while `failures` has items"""
+    applied = SimpleNamespace(calls=[], failures=[])
+
+    def apply_scores(updates, writer_id, batch):
+        applied.calls.append((writer_id, batch, dict(updates)))
+        if applied.failures:
+            raise applied.failures.pop(0)
+
+    monkeypatch.setattr(scores.Tourney, 'apply_scores', apply_scores)
+    return applied
+
+
+def new_buffer() -> ScoreBuffer:
+    buffer = ScoreBuffer(flush_interval=3600, flush_size=1000)
+    # no background flushes
+    buffer._thread = object()
+    return buffer
+
+
+def test_merges_values_and_deltas(applied):
+    buffer = new_buffer()
+    buffer.add(TOURNEY_ID, 'a', delta=2)
+    buffer.add(TOURNEY_ID, 'a', delta=3)
+    buffer.add(TOURNEY_ID, 'b', delta=2)
+    buffer.add(TOURNEY_ID, 'b', value=10)
+    buffer.add(TOURNEY_ID, 'b', delta=1)
+    buffer.flush()
+    assert applied.calls[0][2] == {(TOURNEY_ID, 'a'): [None, 5, None], (TOURNEY_ID, 'b'): [10, 1, None]}
+
+
+def test_stale_values_are_ignored(applied):
+    buffer = new_buffer()
+    buffer.add(TOURNEY_ID, 'a', value=10, seq=2)
+    buffer.add(TOURNEY_ID, 'a', value=5, seq=1)
+    buffer.flush()
+    assert applied.calls[0][2] == {(TOURNEY_ID, 'a'): [10, 0, 2]}
+
+
+def test_failed_batch_is_retried_as_is(applied):
+    buffer = new_buffer()
+    applied.failures.append(AutoReconnect('connection lost'))
+    buffer.add(TOURNEY_ID, 'a', delta=2)
+    with pytest.raises(AutoReconnect):
+        buffer.flush()
+    buffer.add(TOURNEY_ID, 'a', delta=3)
+    assert len(buffer) == 2
+    buffer.flush()
+    writer_id, batch, updates = applied.calls[0]
+    # the same batch again, then the newer updates in the next one
+    assert applied.calls[1] == (writer_id, batch, {(TOURNEY_ID, 'a'): [None, 2, None]})
+    assert applied.calls[2] == (writer_id, batch + 1, {(TOURNEY_ID, 'a'): [None, 3, None]})
+    assert len(buffer) == 0
+
+
+def test_batch_is_applied_once(db):
+    from schema import Tourney
+
+    tourney = Tourney.create_many([{'name': 'Scores', 'user_id': 'owner', 'transaction_id': transaction_id(0)}])[0]
+    Tourney.join_many(tourney.id, [new_member(n) for n in range(2)])
+    Tourney.apply_scores({(tourney.id, 'user0'): [10, 0, 5], (tourney.id, 'user1'): [0, 0, None]}, 'writer', 1)
+    updates = {(tourney.id, 'user0'): [None, 1, None], (tourney.id, 'user1'): [None, 2, None]}
+    Tourney.apply_scores(updates, 'writer', 2)
+    Tourney.apply_scores(updates, 'writer', 2)
+    # a stale value
+    Tourney.apply_scores({(tourney.id, 'user0'): [50, 0, 4]}, 'other', 1)
+    members = Tourney.objects.get(id=tourney.id).members
+    assert [(m.user_id, m.currentTrophies) for m in members] == [('user0', 11), ('user1', 2)]
+
+
+def test_members_are_sorted_after_a_rejected_update(db):
+    from pymongo.errors import BulkWriteError
+    from schema import Tourney
+
+    tourney = Tourney.create_many([{'name': 'Scores', 'user_id': 'owner', 'transaction_id': transaction_id(0)}])[0]
+    Tourney.join_many(tourney.id, [new_member(n) for n in range(3)])
+    Tourney.apply_scores({(tourney.id, 'user%d' % n): [30 - 10 * n, 0, None] for n in range(3)}, 'writer', 1)
+    # noinspection PyProtectedMember
+    collection = Tourney._get_collection()
+    collection.update_one({'_id': tourney.id}, {'$set': {'members.2.currentTrophies': 'not a number'}})
+    with pytest.raises(BulkWriteError):
+        Tourney.apply_scores({(tourney.id, 'user1'): [50, 0, None], (tourney.id, 'user2'): [None, 1, None]},
+                             'writer', 2)
+    members = collection.find_one({'_id': tourney.id})['members']
+    assert [m['user_id'] for m in members if m['user_id'] != 'user2'] == ['user1', 'user0']
+
+
+def test_applied_batches_are_bounded(db, monkeypatch):
+    import schema
+    from schema import Tourney, raw_tourneys
+
+    monkeypatch.setattr(schema, 'MEMBERS_SEPARATE', True)
+    tourney = Tourney.create_many([{'name': 'Scores', 'user_id': 'owner', 'transaction_id': transaction_id(0)}])[0]
+    Tourney.join_many(tourney.id, [new_member(0)])
+    for batch in range(schema.SCORE_BATCHES_KEPT + 2):
+        Tourney.apply_scores({(tourney.id, 'user0'): [None, 1, None]}, 'writer', batch)
+    # noinspection PyProtectedMember
+    doc = schema.TourneyMember._get_collection().find_one({'tourney': tourney.id})
+    assert len(doc['score_batches']) == schema.SCORE_BATCHES_KEPT
+    assert doc['score_batches'][-1] == 'writer:%d' % (schema.SCORE_BATCHES_KEPT + 1)
+    # the raw reads don't load them
+    assert 'score_batches' not in raw_tourneys([tourney.id])[0]['members'][0]
@@ -0,0 +1,236 @@
+import hashlib
+from types import SimpleNamespace
+
+import pytest
+
+from conftest import new_member, transaction_id
+
+
+class FakeLedger(object):
+    """Applies submitted payouts of a single channel by their sequence numbers like Horizon does.
+    The next submissions fail by `failures`: 'lost' ones aren't applied, 'timeout' ones are applied anyway,
+    'taken' ones find their sequence taken by another transaction of the channel
+    """
+
+    def __init__(self):
+        self.sequence = 0
+        self.envelopes = {}
+        self.applied = {}
+        self.submitted = []
+        self.failures = []
+
+    def get_transaction(self, tx_hash: str):
+        from horizon import NotFoundError
+
+        if tx_hash not in self.applied:
+            raise NotFoundError('Transaction %s is not found' % tx_hash, 404)
+        return self.applied[tx_hash]
+
+    def account_sequence(self, address: str) -> int:
+        return self.sequence
+
+    def submit(self, envelope_xdr):
+        from horizon import BadSequenceError
+
+        tx_hash = envelope_xdr.decode() if isinstance(envelope_xdr, bytes) else envelope_xdr
+        self.submitted.append(tx_hash)
+        failure = self.failures.pop(0) if self.failures else None
+        if failure == 'lost':
+            raise RuntimeError('lost %s' % tx_hash)
+        if failure == 'taken':
+            self.sequence += 1
+        if self.envelopes[tx_hash] != self.sequence + 1:
+            raise BadSequenceError('tx_bad_seq %s' % tx_hash, 400)
+        self.sequence += 1
+        self.applied[tx_hash] = SimpleNamespace(hash=tx_hash, operations=[])
+        if failure == 'timeout':
+            raise RuntimeError('timeout %s' % tx_hash)
+
+    def build_payout(self, payments: list, channel_secret_key: str, sequence: int):
+        tx_hash = hashlib.sha256(('%d %r' % (len(self.envelopes), payments)).encode()).hexdigest()
+        self.envelopes[tx_hash] = sequence + 1
+        # the envelope is identified by the hash
+        return SimpleNamespace(hash_hex=lambda: tx_hash, gen_xdr=lambda: tx_hash.encode())
+
+
+@pytest.fixture
+def ledger(db, monkeypatch):
+    from stellar_base.keypair import Keypair
+    from misc.scheduler import Scheduler
+    import payouts
+    import transactions
+
+    fake = FakeLedger()
+    monkeypatch.setattr(payouts, '_channel_pool', payouts.ChannelPool([Keypair.random().seed().decode()]))
+    monkeypatch.setattr(transactions, 'horizon_client', fake)
+    monkeypatch.setattr(transactions, 'payout_builder', fake.build_payout)
+    monkeypatch.setattr(transactions, 'end_scheduler', Scheduler())
+    return fake
+
+
+def ended_tourney(n=0):
+    from schema import Tourney, TourneyStatus
+
+    tourney = Tourney.create_many([{'name': 'Payout', 'prize': 100.0, 'user_id': 'owner',
+                                    'transaction_id': transaction_id(n)}])[0]
+    Tourney.join_many(tourney.id, [new_member(n) for n in range(2)])
+    Tourney.objects(id=tourney.id).update_one(set__status=TourneyStatus.PAYED.value)
+    return tourney.id
+
+
+def end(tourney_id):
+    import transactions
+    from schema import Tourney
+
+    transactions.end_tourney(Tourney.objects.get(id=tourney_id))
+    return Tourney.objects.get(id=tourney_id)
+
+
+def test_prizes_go_to_leaders_of_unsorted_members(ledger):
+    from schema import Tourney
+
+    tourney_id = ended_tourney()
+    Tourney.join(tourney_id, new_member(2))
+    # trophies changed in place leave the stored members unsorted
+    # noinspection PyProtectedMember
+    Tourney._get_collection().update_one({'_id': tourney_id}, {'$set': {
+        'members.0.currentTrophies': 1, 'members.1.currentTrophies': 2, 'members.2.currentTrophies': 3,
+    }})
+    order = [m.user_id for m in Tourney.objects.get(id=tourney_id).members]
+    tourney = end(tourney_id)
+    assert [line.split(' was sent to ')[1].split()[0] for line in tourney.prize_sending_log.splitlines()] == \
+        order[::-1]
+
+
+def test_payout_lost_before_submission_is_counted(ledger, monkeypatch):
+    import transactions
+    from schema import TourneyStatus
+
+    def unreachable(address):
+        raise RuntimeError('Horizon is unreachable')
+
+    tourney_id = ended_tourney()
+    monkeypatch.setattr(ledger, 'account_sequence', unreachable)
+    tourney = end(tourney_id)
+    assert tourney.payout_attempts == 1
+    assert tourney.payout_tx_hashes == []
+    assert tourney.status == TourneyStatus.PAYED.value
+    assert transactions.end_scheduler.next_due() is not None
+
+
+def test_payout_retry_resubmits_the_same_envelope(ledger):
+    from schema import TourneyStatus
+
+    tourney_id = ended_tourney()
+    ledger.failures = ['lost']
+    tourney = end(tourney_id)
+    assert tourney.status == TourneyStatus.PAYED.value
+    assert len(tourney.payout_tx_hashes) == 1
+
+    tourney = end(tourney_id)
+    assert tourney.status == TourneyStatus.ENDED.value
+    assert tourney.payout_attempts == 2
+    # the retry sent the stored transaction again instead of a new one with the next sequence
+    assert ledger.submitted == tourney.payout_tx_hashes * 2
+    assert list(ledger.applied) == tourney.payout_tx_hashes
+    assert tourney.prize_sent > 0
+
+
+def test_taken_sequence_isnt_counted_as_an_attempt(ledger, monkeypatch):
+    import transactions
+    from schema import TourneyStatus
+
+    monkeypatch.setattr(transactions, 'PAYOUT_MAX_ATTEMPTS', 1)
+    tourney_id = ended_tourney()
+    ledger.failures = ['taken']
+    tourney = end(tourney_id)
+    assert tourney.status == TourneyStatus.PAYED.value
+    assert tourney.payout_attempts == 0
+    assert transactions.end_scheduler.next_due() is not None
+
+    tourney = end(tourney_id)
+    assert tourney.status == TourneyStatus.ENDED.value
+    assert len(tourney.payout_tx_hashes) == 2
+    assert tourney.prize_sent > 0
+
+
+def test_payout_applied_despite_an_error_isnt_sent_again(ledger):
+    from schema import TourneyStatus
+
+    tourney_id = ended_tourney()
+    ledger.failures = ['timeout']
+    end(tourney_id)
+    tourney = end(tourney_id)
+    assert tourney.status == TourneyStatus.ENDED.value
+    assert len(ledger.submitted) == 1
+    assert tourney.prize_sent > 0
+
+
+def test_last_payout_attempt_is_checked_before_failing(ledger, monkeypatch):
+    import transactions
+    from schema import TourneyStatus
+
+    monkeypatch.setattr(transactions, 'PAYOUT_MAX_ATTEMPTS', 1)
+    tourney_id = ended_tourney()
+    ledger.failures = ['timeout']
+    tourney = end(tourney_id)
+    assert tourney.status == TourneyStatus.ENDED.value
+    assert tourney.prize_sent > 0
+
+    tourney_id = ended_tourney(1)
+    ledger.failures = ['lost']
+    tourney = end(tourney_id)
+    assert tourney.status == TourneyStatus.ENDED.value
+    assert tourney.prize_sent == 0
+    assert 'Can\'t send prize' in tourney.prize_sending_log
+
+
+def test_tourney_being_ended_is_ended_again_only_by_its_retry(ledger):
+    import transactions
+    from schema import Tourney, TourneyStatus
+
+    tourney_id = ended_tourney()
+    # the tourney scheduled twice is being ended by the first call
+    Tourney.claim(transactions.WORKER_ID, 60, members_limit=0, id=tourney_id)
+    transactions.end_tourney_by_id(tourney_id)
+    assert Tourney.objects.get(id=tourney_id).status == TourneyStatus.PAYED.value
+    assert ledger.submitted == []
+
+    transactions.retry_payout(tourney_id)
+    transactions.end_tourney_by_id(tourney_id)
+    assert Tourney.objects.get(id=tourney_id).status == TourneyStatus.ENDED.value
+    assert len(ledger.submitted) == 1
+
+
+def test_reseed_skips_tourneys_being_ended(ledger, monkeypatch):
+    import transactions
+    from misc import clock
+    from schema import Tourney
+
+    tourney_id = ended_tourney()
+    Tourney.objects(id=tourney_id).update_one(set__endAt=clock.utcnow())
+    monkeypatch.setattr(transactions, 'ending_tourneys', {tourney_id})
+    transactions.schedule_payed_tourneys(due_only=True)
+    assert transactions.end_scheduler.next_due() is None
+
+    transactions.ending_tourneys.clear()
+    transactions.schedule_payed_tourneys(due_only=True)
+    assert transactions.end_scheduler.pop_due() == tourney_id
+
+
+def test_payment_checks_take_the_longest_waiting_first(db, virtual_clock, monkeypatch):
+    from datetime import timedelta
+    import transactions
+    from schema import Tourney
+
+    monkeypatch.setattr(transactions, 'PAYMENT_CLAIM_BATCH', 2)
+    tourneys = Tourney.create_many([{'name': 'Check %d' % n, 'user_id': 'owner', 'transaction_id': transaction_id(n)}
+                                    for n in range(3)])
+    now = virtual_clock.utcnow()
+    for n, tourney in enumerate(tourneys):
+        Tourney.objects(id=tourney.id).update_one(set__payment_check_due=now - timedelta(seconds=n))
+    assert transactions.tourneys_to_check(check_all=True) == [tourneys[2].id, tourneys[1].id]
+
+    # a checked tourney waits for its next check
+    Tourney.objects(id=tourneys[2].id).update_one(set__payment_check_due=now + timedelta(seconds=10))
+    assert transactions.tourneys_to_check(check_all=True) == [tourneys[1].id, tourneys[0].id]